@@ -5,7 +5,6 @@
 
 import sys
 import os
-import openpyxl
 
 # append import path
 pardir = os.path.dirname(os.path.abspath(__file__))
@@ -13,18 +12,17 @@ utildir = os.path.join(pardir, "../")
 sys.path.append(utildir)
 import util.excelutil
 import util.excelutil_exp
+import util.xlsxreader
 
 
 filename = os.path.join(pardir, "../sampledata/exceldata2.xlsx")
 sheetName = "Sheet1"
 
-wbdata = openpyxl.load_workbook(filename=filename, data_only=True)
-wbmath = openpyxl.load_workbook(filename=filename, data_only=False)
+# ファイルを1回だけ読み込み、値と数式の両方を保持する
+book = util.xlsxreader.load_dual_workbook(filename)
 
-# データだけシート
-sheetData = wbdata[sheetName]
-# 数式のシート
-sheetMath = wbmath[sheetName]
+# データだけシート, 数式のシート
+sheetData, sheetMath = book[sheetName]
 
 tmpdic = {}
 tmpdic["studentid"] = "some identifier"
@@ -112,7 +110,7 @@ tmpdic["function4"] = oknum/cellnum
 
 
 # 作成者
-creator, modifiedby = util.excelutil.get_creator_lastmodify(wbmath)
+creator, modifiedby = util.excelutil.get_creator_lastmodify(book)
 tmpdic["creator"] = creator
 tmpdic["modifiedby"] = modifiedby
 
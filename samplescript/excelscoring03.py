@@ -0,0 +1,38 @@
+"""This is a sample script that scores assignments with a rubric written as data.
+The rubric rubric02.json has the same checks as excelscoring02.py.
+これはデータとして書いた採点基準 (ルーブリック) で課題を採点するサンプルスクリプトです。
+rubric02.json は excelscoring02.py と同じチェックをします。
+"""
+
+
+import sys
+import os
+import csv
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.rubric
+
+
+rubricfile = os.path.join(pardir, "rubric02.json")
+outfilename = os.path.join(os.getcwd(), "sampleout03.csv")
+studentfiles = {
+    "student5": os.path.join(pardir, "../sampledata/exceldata3_student5.xlsx"),
+    "student6": os.path.join(pardir, "../sampledata/exceldata3_student6.xlsx"),
+}
+
+# ルーブリックを1回だけコンパイルし、全員に同じものを使う
+plan = util.rubric.compile_rubric(util.rubric.load_rubric(rubricfile))
+
+# 出力
+with open(outfilename, "w", newline="", encoding='utf-8') as fout:
+    writer = csv.DictWriter(fout, fieldnames=["studentid"] + plan.fieldnames)
+    writer.writeheader()
+    for studentid, filename in studentfiles.items():
+        tmpdic = {}
+        tmpdic["studentid"] = studentid
+        tmpdic.update(plan.grade(filename))
+        writer.writerow(tmpdic)
+    print("outputfile = {}".format(outfilename))
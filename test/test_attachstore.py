@@ -0,0 +1,135 @@
+import sys
+import os
+import base64
+import email
+import email.message
+import email.policy
+import filecmp
+import io
+import mailbox
+import shutil
+import tempfile
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.attachstore
+import util.emailutil
+
+sampledata_dir = os.path.join(pardir, "../sampledata/email")
+attach_orig_dir = os.path.join(sampledata_dir, "attached_original")
+
+
+def make_message(attachments, cte="base64"):
+    # 添付ファイルのあるメッセージを作る
+    msg = email.message.EmailMessage()
+    msg["From"] = "student@example.com"
+    msg["Subject"] = "assignment"
+    msg.set_content("本文です。\n")
+    for filename, data in attachments:
+        maintype, subtype = ("text", "plain") if filename.endswith(".txt") else \
+            ("application", "octet-stream")
+        msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename,
+                           cte=cte)
+    return msg.as_bytes(policy=email.policy.SMTP)
+
+
+class FailingStream(io.BytesIO):
+    # limit バイトより後を読もうとすると失敗する
+    def __init__(self, data, limit):
+        super().__init__(data)
+        self.limit = limit
+
+    def readline(self, size=-1):
+        if self.tell() >= self.limit:
+            raise OSError("connection lost")
+        return super().readline(size)
+
+
+#######################################
+print("Extract attachments. 添付ファイルを取り出す")
+tmpdir = tempfile.mkdtemp()
+try:
+    storedir = os.path.join(tmpdir, "store")
+    with util.attachstore.AttachmentStore(storedir) as store:
+        filename = os.path.join(sampledata_dir, "email_data4_attached.eml")
+        records = store.extract(filename)
+        assert ([record.filename for record in records]
+                == util.emailutil.get_attached(filename, tmpdir))
+        for record in records:
+            assert (record.message == os.path.abspath(filename))
+            assert (filecmp.cmp(store.path_of(record.file_hash),
+                                os.path.join(attach_orig_dir, record.filename), shallow=False))
+        assert (store.extract(os.path.join(sampledata_dir, "email_data1.eml")) == [])
+        # 取り直しても記録は増えない
+        store.extract(filename)
+        assert (len(store.attachments()) == len(records))
+        outdir = os.path.join(tmpdir, "out")
+        os.mkdir(outdir)
+        assert (store.export(os.path.abspath(filename), outdir) == [r.filename for r in records])
+        assert (not filecmp.dircmp(attach_orig_dir, outdir).diff_files)
+
+        # 同じ名前で中身の違うファイルも、同じ中身のファイルも区別して記録する
+        binary = bytes(range(256)) * 1000
+        text = "添付ファイル\r\n=テスト\r\n".encode("utf-8") * 200
+        messages = {
+            "student1": make_message([("添付ファイル.txt", text), ("data.bin", binary)]),
+            "student2": make_message([("添付ファイル.txt", text[:-2] + b"!")],
+                                     cte="quoted-printable"),
+            "student3": make_message([("data.bin", binary), ("copy.bin", binary)]),
+        }
+        for name, data in messages.items():
+            store.extract(data, message=name)
+            parsed = email.message_from_bytes(data, policy=email.policy.default)
+            expected = [(part.get_filename(), part.get_payload(decode=True))
+                        for part in parsed.iter_attachments()]
+            records = store.attachments(message=name)
+            assert ([r.filename for r in records] == [f for f, _ in expected])
+            for record, (_, payload) in zip(records, expected):
+                with open(store.path_of(record.file_hash), "rb") as f:
+                    assert (f.read() == payload)
+                assert (record.size == len(payload))
+        objects = [f for _, _, files in os.walk(os.path.join(storedir, "objects")) for f in files]
+        # サンプルの4つと、text、text を変えたもの、binary の3つだけ
+        assert (len(objects) == 7)
+        digest = store.attachments(message="student1")[1].file_hash
+        assert ([(r.message, r.filename) for r in store.attachments(file_hash=digest)]
+                == [("student1", "data.bin"), ("student3", "data.bin"), ("student3", "copy.bin")])
+        assert (os.listdir(os.path.join(storedir, "tmp")) == [])
+
+        # 読み込みの途中で失敗しても一時ファイルを残さない
+        data = messages["student1"]
+        try:
+            store.extract(FailingStream(data, len(data) // 2), message="broken")
+        except OSError:
+            pass
+        else:
+            assert False
+        assert (os.listdir(os.path.join(storedir, "tmp")) == [])
+        assert (store.attachments(message="broken") == [])
+
+        # 転送されたメッセージの中の添付ファイルも取り出す
+        forward = email.message.EmailMessage()
+        forward["Subject"] = "Fwd: assignment"
+        forward.set_content("転送します。\n")
+        forward.add_attachment(email.message_from_bytes(messages["student2"],
+                                                        policy=email.policy.default))
+        records = store.extract(forward.as_bytes(policy=email.policy.SMTP), message="forward")
+        assert ([r.filename for r in records] == ["添付ファイル.txt"])
+        assert (records[0].file_hash == store.attachments(message="student2")[0].file_hash)
+
+        # mbox のメッセージを取り出す
+        mboxpath = os.path.join(tmpdir, "course.mbox")
+        mbox = mailbox.mbox(mboxpath)
+        for data in messages.values():
+            mbox.add(data)
+        mbox.close()
+        records = store.extract_mailbox(mboxpath)
+        assert ([r.message for r in records]
+                == [mboxpath + "#0"] * 2 + [mboxpath + "#1"] + [mboxpath + "#2"] * 2)
+        assert ([r.file_hash for r in records]
+                == [r.file_hash for name in messages for r in store.attachments(message=name)])
+finally:
+    shutil.rmtree(tmpdir)
+print("OK")
@@ -0,0 +1,172 @@
+import sys
+import os
+import shutil
+import tempfile
+import pathlib
+import email.message
+import mailbox
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.batch
+import util.gradecache
+import util.misc
+
+
+dirname = os.path.join(pardir, "../sampledata/exceldir1")
+rubric = {
+    "sheet": "Sheet1",
+    "checks": [
+        {"name": "value", "check": "is_given_value", "addr": "B1", "value": 22},
+        {"name": "formula", "check": "is_formula", "addr": "C1"},
+        {"name": ["creator", "modifiedby"], "check": "get_creator_lastmodify"},
+    ]
+}
+
+
+class InterruptingCache:
+    # 2つ目の行を保存するときに Ctrl+C で止めたことにする
+    def __init__(self):
+        self.rows = 0
+
+    def get(self, filepath, key):
+        return None
+
+    def put(self, filepath, key, row):
+        self.rows += 1
+        if self.rows == 2:
+            raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    #######################################
+    print("Grade directory. ディレクトリ以下のファイルを採点する")
+    expected_list = ["data1.xlsx", "dir11/data11.xlsx", "dir12/data12.xlsx"]
+    for workers in [1, 2]:
+        rows = list(util.batch.grade_directory(dirname, rubric, workers=workers))
+        tmplist = []
+        for row in rows:
+            tmplist.append(pathlib.Path(row["file"]).relative_to(dirname).as_posix())
+            assert (row["error"] is None)
+            assert (row["value"])
+            assert (not row["formula"])
+            assert (row["creator"] == "Creator1")
+        assert (tmplist == expected_list)
+    print("OK")
+
+    #######################################
+    print("Broken file does not stop the batch. 壊れたファイルがあっても止まらない")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shutil.copytree(src=dirname, dst=tmpdir, dirs_exist_ok=True)
+        with open(os.path.join(tmpdir, "broken.xlsx"), "wb") as f:
+            f.write(b"this is not a zip file")
+        rows = list(util.batch.grade_directory(tmpdir, rubric, workers=2))
+        assert (len(rows) == 4)
+        assert (pathlib.Path(rows[0]["file"]).name == "broken.xlsx")
+        assert (rows[0]["error"].startswith("BadZipFile"))
+        assert ([row["error"] for row in rows[1:]] == [None, None, None])
+    print("OK")
+
+    #######################################
+    print("Grade with cache. キャッシュを使った採点")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with util.gradecache.GradeCache(os.path.join(tmpdir, "cache.sqlite3")) as cache:
+            rows1 = list(util.batch.grade_directory(dirname, rubric, workers=2, cache=cache))
+            # 2回目は採点せずにキャッシュから取り出す
+            grade_one = util.batch._grade_one
+            util.batch._grade_one = None
+            rows2 = list(util.batch.grade_directory(dirname, rubric, workers=1, cache=cache))
+            util.batch._grade_one = grade_one
+            assert (rows1 == rows2)
+    print("OK")
+
+    #######################################
+    print("Grade encrypted files in memory. 暗号化されたファイルをメモリ上で復号して採点する")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shutil.copytree(src=dirname, dst=tmpdir, dirs_exist_ok=True)
+        util.misc.encrypt_directory(tmpdir, password="abc", flag_delete=True, workers=1)
+        for workers in [1, 2]:
+            rows = list(util.batch.grade_directory(tmpdir, rubric, workers=workers, password="abc"))
+            assert ([row["error"] for row in rows] == [None, None, None])
+            assert ([row["creator"] for row in rows] == ["Creator1"] * 3)
+        rows = list(util.batch.grade_directory(tmpdir, rubric, workers=1, password="wrong"))
+        assert (rows[0]["error"].startswith("InvalidKeyError"))
+        # 復号したファイルは作られない
+        assert (not [p for p in util.misc.listfiles(tmpdir) if "_dec" in p.name])
+    print("OK")
+
+    #######################################
+    print("Watch a directory. 届いたファイルから採点する")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        subdir = os.path.join(tmpdir, "submissions")
+        shutil.copytree(src=dirname, dst=subdir)
+        dbpath = os.path.join(tmpdir, "manifest.sqlite3")
+        with util.misc.FileManifest(dbpath) as manifest:
+            # 1回目のポーリングで見つけ、2回目で書き込みが終わったことを確かめて採点する
+            rows = list(util.batch.watch_directory(subdir, rubric, manifest=manifest, interval=0,
+                                                   settle=0, workers=2, max_cycles=2))
+            assert ([pathlib.Path(row["file"]).relative_to(subdir).as_posix() for row in rows]
+                    == expected_list)
+            assert ([row["error"] for row in rows] == [None, None, None])
+        # 再起動しても採点済みのファイルは採点しない
+        shutil.copy(os.path.join(dirname, "data1.xlsx"), os.path.join(subdir, "data2.xlsx"))
+        with util.misc.FileManifest(dbpath) as manifest:
+            rows = list(util.batch.watch_directory(subdir, rubric, manifest=manifest, interval=0,
+                                                   settle=0, workers=1, max_cycles=2))
+            assert ([pathlib.Path(row["file"]).name for row in rows] == ["data2.xlsx"])
+        # 採点の途中で止めても、行を渡していないファイルは再起動した後に採点する
+        shutil.copy(os.path.join(dirname, "data1.xlsx"), os.path.join(subdir, "data3.xlsx"))
+        shutil.copy(os.path.join(dirname, "data1.xlsx"), os.path.join(subdir, "data4.xlsx"))
+        cache = InterruptingCache()
+        with util.misc.FileManifest(dbpath) as manifest:
+            graded = []
+            try:
+                for row in util.batch.watch_directory(subdir, rubric, manifest=manifest, interval=0,
+                                                      settle=0, workers=1, max_cycles=2,
+                                                      cache=cache):
+                    graded.append(pathlib.Path(row["file"]).name)
+            except KeyboardInterrupt:
+                pass
+            assert (graded == ["data3.xlsx"])
+        with util.misc.FileManifest(dbpath) as manifest:
+            rows = list(util.batch.watch_directory(subdir, rubric, manifest=manifest, interval=0,
+                                                   settle=0, workers=1, max_cycles=2))
+            assert ([pathlib.Path(row["file"]).name for row in rows] == ["data4.xlsx"])
+        # 結果を CSV ファイルに追記する
+        csvpath = os.path.join(tmpdir, "results.csv")
+        for _ in range(2):
+            util.batch.append_rows(rows, csvpath, ["file", "error", "value", "formula"])
+        with open(csvpath, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        assert (lines[0] == "file,error,value,formula")
+        assert (len(lines) == 3)
+    print("OK")
+
+    #######################################
+    print("Grade attached files of a mailbox. メールボックスの添付ファイルを採点する")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mboxpath = os.path.join(tmpdir, "course.mbox")
+        mbox = mailbox.mbox(mboxpath)
+        for name in expected_list + [None]:
+            msg = email.message.EmailMessage()
+            msg["Subject"] = "assignment"
+            msg.set_content("body")
+            if name is not None:
+                with open(os.path.join(dirname, name), "rb") as f:
+                    msg.add_attachment(f.read(), maintype="application", subtype="octet-stream",
+                                       filename=pathlib.Path(name).name)
+            mbox.add(msg.as_bytes())
+        mbox.close()
+        expected = list(util.batch.grade_directory(dirname, rubric, workers=1))
+        for workers in [1, 2]:
+            rows = list(util.batch.grade_mailbox(mboxpath, rubric, workers=workers))
+            assert ([row["file"] for row in rows]
+                    == ["{}#{}/{}".format(mboxpath, i, pathlib.Path(name).name)
+                        for i, name in enumerate(expected_list)] + [mboxpath + "#3"])
+            for row, expected_row in zip(rows, expected):
+                assert ({k: v for k, v in row.items() if k != "file"}
+                        == {k: v for k, v in expected_row.items() if k != "file"})
+            assert (rows[3]["error"] == "No .xlsx attachment")
+    print("OK")
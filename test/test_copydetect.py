@@ -0,0 +1,106 @@
+import sys
+import os
+import random
+import shutil
+import tempfile
+import openpyxl
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.copydetect
+import util.xlsxreader
+
+
+#######################################
+print("Normalize formula. 数式の正規化")
+assert (util.copydetect.normalize_formula("=SUM(C4:D4)", 4, 5) == "=SUM(R[0]C[-2]:R[0]C[-1])")
+# 他のセルにコピーした数式は同じになる
+assert (util.copydetect.normalize_formula("= sum(c5:d5)", 5, 5) == "=SUM(R[0]C[-2]:R[0]C[-1])")
+assert (util.copydetect.normalize_formula("=$C$4*D$4", 6, 5) == "=R4C3*R4C[-1]")
+assert (util.copydetect.normalize_formula('=IF(A1="abc",1,0)', 1, 2) == '=IF(R[0]C[-1]="abc",1,0)')
+print("OK")
+
+
+#######################################
+print("Features of sheet. シートの特徴")
+book = util.xlsxreader.load_dual_workbook(os.path.join(pardir, "../sampledata/exceldata2.xlsx"))
+sheetData, sheetMath = book["Sheet1"]
+features = util.copydetect.sheet_features(sheetData, sheetMath, "E4:E6")
+assert ("F|=R[0]C[-2]+R[0]C[-1]" in features)
+assert ("L|4,5|f" in features)
+print("OK")
+
+
+#######################################
+print("Find copies. コピーの検出")
+def make_book(path, seed):
+    # 共通のテンプレートに、学生ごとに異なる数式を書く
+    r = random.Random(seed)
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Sheet1"
+    for row in range(1, 11):
+        ws.cell(row=row, column=1, value=row * 10)
+        ws.cell(row=row, column=2, value=row * 3)
+    for row in range(1, 11):
+        for column in range(3, 7):
+            a = r.choice("AB") + str(row)
+            b = r.choice("AB") + str(r.randint(1, 10))
+            func = r.choice(["SUM", "MAX", "MIN", "AVERAGE", ""])
+            if func:
+                formula = "={}({},{})".format(func, a, b)
+            else:
+                formula = "={}{}{}".format(a, r.choice("+-*/"), b)
+            ws.cell(row=row, column=column, value=formula)
+    wb.save(path)
+
+
+tmpdir = tempfile.mkdtemp()
+try:
+    filelist = []
+    for i in range(30):
+        path = os.path.join(tmpdir, "student{:02d}.xlsx".format(i))
+        make_book(path, i)
+        filelist.append(path)
+    # student03 を2人がコピーし、student10 を1人がコピーして1つだけ変えた
+    for name in ["copy03a.xlsx", "copy03b.xlsx"]:
+        shutil.copy(filelist[3], os.path.join(tmpdir, name))
+        filelist.append(os.path.join(tmpdir, name))
+    wb = openpyxl.load_workbook(filelist[10])
+    wb.active["C1"] = "=A1+B1+1"
+    wb.save(os.path.join(tmpdir, "copy10.xlsx"))
+    filelist.append(os.path.join(tmpdir, "copy10.xlsx"))
+    template = os.path.join(tmpdir, "template.xlsx")
+    wbt = openpyxl.Workbook()
+    for row in range(1, 11):
+        wbt.active.cell(row=row, column=1, value=row * 10)
+        wbt.active.cell(row=row, column=2, value=row * 3)
+    wbt.save(template)
+
+    result = util.copydetect.find_copies(filelist, threshold=0.6, template=template, workers=1)
+    names = [(os.path.basename(file1), os.path.basename(file2)) for file1, file2, _ in result.pairs]
+    assert (sorted(names) == [("copy03a.xlsx", "copy03b.xlsx"), ("student03.xlsx", "copy03a.xlsx"),
+                              ("student03.xlsx", "copy03b.xlsx"), ("student10.xlsx", "copy10.xlsx")])
+    assert (result.pairs[0][2] == 1.0)
+    assert ([len(cluster) for cluster in result.clusters] == [3, 2])
+    assert (result.errors == {})
+    # 推定値は実際の Jaccard 係数に近い
+    for file1, file2, score in result.pairs:
+        assert (abs(result.index.estimate(file1, file2) - score) < 0.15)
+    # 全ての組を比べた結果と同じ
+    index = result.index
+    allpairs = [(file1, file2) for i, file1 in enumerate(filelist) for file2 in filelist[i + 1:]
+                if index.similarity(file1, file2) >= 0.6]
+    assert (len(allpairs) == len(result.pairs))
+
+    # 読めないファイルはエラーとして記録する
+    broken = os.path.join(tmpdir, "broken.xlsx")
+    with open(broken, "wb") as f:
+        f.write(b"not a zip file")
+    result = util.copydetect.find_copies(filelist[:3] + [broken], workers=1)
+    assert (list(result.errors) == [broken])
+finally:
+    shutil.rmtree(tmpdir)
+print("OK")
@@ -0,0 +1,87 @@
+import sys
+import os
+import datetime
+import shutil
+import tempfile
+import docx
+import openpyxl
+import pptx
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.docprops
+import util.excelutil
+import util.misc
+import util.powerpointutil
+
+sampledir = os.path.join(pardir, "../sampledata")
+
+
+#######################################
+print("Read document properties. 文書のプロパティを読む")
+filename = os.path.join(sampledir, "exceldata1.xlsx")
+row = util.docprops.read_docprops(filename)
+wb = openpyxl.load_workbook(filename)
+assert ((row["creator"], row["lastModifiedBy"]) == util.excelutil.get_creator_lastmodify(wb))
+assert ((row["created"], row["modified"]) == util.excelutil.get_createtime_modifiedtime(wb))
+assert (row["error"] is None)
+
+filename = os.path.join(sampledir, "powerpoint/testfile1.pptx")
+row = util.docprops.read_docprops(filename, iana_key="UTC")
+prs = pptx.Presentation(filename)
+assert ((row["creator"], row["lastModifiedBy"]) == util.powerpointutil.get_creator_lastmodify(prs))
+assert ((row["created"], row["modified"]) ==
+        util.powerpointutil.get_createtime_modifiedtime(prs, iana_key="UTC"))
+
+filename = os.path.join(sampledir, "word/stu1_word.docx")
+row = util.docprops.read_docprops(filename)
+document = docx.Document(filename)
+assert ((row["creator"], row["lastModifiedBy"]) ==
+        (document.core_properties.author, document.core_properties.last_modified_by))
+assert (row["created"] == datetime.datetime(2024, 3, 19, 12, 24,
+                                            tzinfo=util.docprops._timezone("Asia/Tokyo")))
+assert (row["application"] == "Microsoft Office Word")
+assert (row["totalTime"] == 2)
+print("OK")
+
+
+#######################################
+print("Scan directory. ディレクトリの文書のプロパティ")
+rows = util.docprops.scan_directory(sampledir, workers=4)
+files = [os.path.basename(row["file"]) for row in rows]
+assert ("exceldata1.xlsx" in files)
+assert ("testfile1.pptx" in files)
+assert ("teacher_word.docx" in files)
+assert (all(row["error"] is None for row in rows
+           if os.path.basename(row["file"]) in ("exceldata1.xlsx", "testfile1.pptx", "teacher_word.docx")))
+assert (rows == sorted(rows, key=lambda row: row["file"]))
+rows = util.docprops.scan_directory(sampledir, ext=".PPTX")
+assert ([os.path.basename(row["file"]) for row in rows] == ["testfile1.pptx"])
+
+# zip でないファイル (暗号化したファイルなど) はエラーとして記録する
+tmpdir = tempfile.mkdtemp()
+try:
+    with open(os.path.join(tmpdir, "encrypted.xlsx"), "wb") as f:
+        f.write(b"\xd0\xcf\x11\xe0 not a zip")
+    shutil.copy(os.path.join(sampledir, "exceldata2.xlsx"), tmpdir)
+    rows = util.docprops.scan_directory(tmpdir)
+    assert (rows[0]["error"].startswith("BadZipFile"))
+    assert (rows[1]["error"] is None)
+
+    # パスワードを指定すると暗号化されたファイルも読める
+    util.misc.encrypt_file(os.path.join(tmpdir, "exceldata2.xlsx"), password="abc")
+    encrypted = util.docprops.read_docprops(os.path.join(tmpdir, "exceldata2_enc.xlsx"),
+                                            password="abc")
+    assert (encrypted["error"] is None)
+    assert (encrypted["creator"] == rows[1]["creator"])
+    assert (encrypted["modified"] == rows[1]["modified"])
+    wrong = util.docprops.read_docprops(os.path.join(tmpdir, "exceldata2_enc.xlsx"),
+                                        password="wrong")
+    assert (wrong["error"].startswith("InvalidKeyError"))
+    rows = util.docprops.scan_directory(tmpdir, password="abc")
+    assert ([row["error"] is None for row in rows] == [False, True, True])
+finally:
+    shutil.rmtree(tmpdir)
+print("OK")
@@ -0,0 +1,131 @@
+import sys
+import os
+import pathlib
+import tempfile
+import docx
+from docx.oxml.ns import qn
+
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.docxdiff
+
+sampledata_dir = os.path.join(pardir, "../sampledata/word")
+
+teacher_file = "teacher_word.docx"
+student_files = [
+    "stu1_word.docx",
+    "stu2_word.docx",
+    "stu3_word.docx",
+]
+
+teacher_file_path = pathlib.Path(os.path.join(sampledata_dir, teacher_file))
+student_files_path = [pathlib.Path(os.path.join(sampledata_dir, item)) for item in student_files]
+
+
+def make_document(path, paragraphs):
+    # paragraphs は (テキスト, 太字) のリスト
+    document = docx.Document()
+    for text, bold in paragraphs:
+        document.add_paragraph().add_run(text).bold = bold
+    document.save(str(path))
+    return path
+
+
+if __name__ == "__main__":
+    #######################################
+    print("Index paragraphs once. 段落の索引")
+    teacher = util.docxdiff.DocumentIndex.from_file(teacher_file_path)
+    assert (teacher.paragraphs[0].text == "レポートタイトル")
+    assert (len(teacher.keys) == len(teacher.paragraphs))
+    # ランの分け方が違っても同じ段落として扱う
+    stu1 = util.docxdiff.DocumentIndex.from_file(student_files_path[0])
+    assert (stu1.keys == teacher.keys)
+    result = util.docxdiff.diff_documents(teacher, stu1)
+    assert (result.similarity == 1.0)
+    # 見出しのスタイルだけが変わった段落
+    assert ([op.tag for op in result.ops] == ["equal", "format", "equal"])
+    assert (result.ops[1].original[0].style == "Heading 2")
+    assert (result.ops[1].revised[0].style == "Heading 3")
+    assert (result.format_changed == 1)
+    print("OK")
+
+    #######################################
+    print("Diff paragraphs and characters. 段落と文字の差分")
+    stu3 = util.docxdiff.DocumentIndex.from_file(student_files_path[2])
+    result = util.docxdiff.diff_documents(teacher, stu3)
+    replaced = [op for op in result.ops if op.tag == "replace"]
+    assert (len(replaced) == 1)
+    assert (("insert", "ABCDE. Added some sentences.") in replaced[0].segments)
+    assert (result.inserted == len("ABCDE. Added some sentences."))
+    assert (result.deleted == 0)
+    assert (0.0 < result.similarity < 1.0)
+    print("OK")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = pathlib.Path(tmpdir)
+
+        #######################################
+        print("Insert, delete and format changes. 挿入、削除、書式の変更")
+        original = make_document(tmpdir / "original.docx",
+                                 [("one", False), ("two", False), ("three", False), ("four", False)])
+        revised = make_document(tmpdir / "revised.docx",
+                                [("one", False), ("three", True), ("new paragraph", False),
+                                 ("four", False)])
+        result = util.docxdiff.diff_documents(util.docxdiff.DocumentIndex.from_file(original),
+                                              util.docxdiff.DocumentIndex.from_file(revised))
+        assert ([op.tag for op in result.ops] == ["equal", "delete", "format", "insert", "equal"])
+        assert (result.deleted == len("two"))
+        assert (result.inserted == len("new paragraph"))
+        assert (result.format_changed == 1)
+        print("OK")
+
+        #######################################
+        print("Write reports. レポートの書き出し")
+        util.docxdiff.write_html(result, tmpdir / "report.html", title="revised")
+        text = (tmpdir / "report.html").read_text(encoding="utf-8")
+        assert ("<del>two</del>" in text)
+        assert ("<ins>new paragraph</ins>" in text)
+        util.docxdiff.write_docx(result, tmpdir / "report.docx", template=original)
+        body = docx.Document(str(tmpdir / "report.docx")).element.body
+        assert ([t.text for t in body.iter(qn("w:delText"))] == ["two"])
+        assert ([t.text for ins in body.iter(qn("w:ins")) for t in ins.iter(qn("w:t"))]
+                == ["new paragraph"])
+        print("OK")
+
+        #######################################
+        print("Compare files in parallel. 並列でのファイルの比較")
+        rows = util.docxdiff.compare_files(teacher_file_path, student_files_path, outdir=tmpdir,
+                                           workers=2)
+        assert ([row["file"] for row in rows] == [str(p) for p in student_files_path])
+        assert ([row["error"] for row in rows] == [None, None, None])
+        assert ([row["similarity"] == 1.0 for row in rows] == [True, True, False])
+        for row in rows:
+            assert (pathlib.Path(row["html"]).parent == tmpdir)
+            assert (pathlib.Path(row["html"]).exists())
+            assert (pathlib.Path(row["docx"]).exists())
+        serial = util.docxdiff.compare_files(teacher_file_path, student_files_path, outdir=tmpdir,
+                                             docx_report=False, workers=1)
+        assert ([row["similarity"] for row in serial] == [row["similarity"] for row in rows])
+        assert ([row["docx"] for row in serial] == [None, None, None])
+        missing = util.docxdiff.compare_files(teacher_file_path, [tmpdir / "missing.docx"],
+                                              outdir=tmpdir, workers=1)
+        assert (missing[0]["error"] is not None)
+        # 同じ名前のファイルのレポートは上書きされない
+        same_names = []
+        for student, path in zip(["s1", "s2"], student_files_path[1:]):
+            (tmpdir / student).mkdir()
+            same_names.append(tmpdir / student / "a.docx")
+            same_names[-1].write_bytes(path.read_bytes())
+        reportdir = tmpdir / "reports"
+        reportdir.mkdir()
+        rows = util.docxdiff.compare_files(teacher_file_path, same_names, outdir=reportdir, workers=1)
+        assert ([pathlib.Path(row["html"]).name for row in rows]
+                == ["s1_a.docx_cmp.html", "s2_a.docx_cmp.html"])
+        assert ([pathlib.Path(row["docx"]).name for row in rows]
+                == ["s1_a.docx_cmp.docx", "s2_a.docx_cmp.docx"])
+        assert ("ABCDE" not in pathlib.Path(rows[0]["html"]).read_text(encoding="utf-8"))
+        assert ("ABCDE" in pathlib.Path(rows[1]["html"]).read_text(encoding="utf-8"))
+        print("OK")
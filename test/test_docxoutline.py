@@ -0,0 +1,129 @@
+import sys
+import os
+import pathlib
+import struct
+import tempfile
+import zlib
+import docx
+from docx.enum.section import WD_ORIENT
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.shared import Cm
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.docxoutline
+
+sampledata_dir = os.path.join(pardir, "../sampledata/word")
+
+teacher_file_path = pathlib.Path(os.path.join(sampledata_dir, "teacher_word.docx"))
+student_files_path = [pathlib.Path(os.path.join(sampledata_dir, item))
+                      for item in ["stu1_word.docx", "stu2_word.docx", "stu3_word.docx"]]
+
+
+def make_png(path):
+    # 1x1 ピクセルの PNG
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+    data = (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(b"\x00\xff\x00\x00")) + chunk(b"IEND", b""))
+    path.write_bytes(data)
+    return path
+
+
+def revision(tag, text, author):
+    element = OxmlElement(tag)
+    element.set(qn("w:id"), "1")
+    element.set(qn("w:author"), author)
+    run = OxmlElement("w:r")
+    t = OxmlElement("w:delText" if tag == "w:del" else "w:t")
+    t.text = text
+    run.append(t)
+    element.append(run)
+    return element
+
+
+def make_document(path, image):
+    document = docx.Document()
+    document.add_heading("Title of chapter", level=1)
+    paragraph = document.add_paragraph("Body text. ")
+    paragraph._p.append(revision("w:ins", "Inserted.", "Student"))
+    paragraph._p.append(revision("w:del", "Deleted.", "Teacher"))
+    document.add_heading("Title of section", level=2)
+    document.add_paragraph("First item", style="List Bullet")
+    document.add_paragraph("Second item", style="List Bullet")
+    table = document.add_table(rows=2, cols=3)
+    table.cell(0, 0).text = "cell"
+    table.cell(1, 0).merge(table.cell(1, 1))
+    document.add_picture(str(image), width=Cm(2))
+    document.add_comment(paragraph.runs, text="Check this", author="Teacher")
+    section = document.add_section()
+    section.orientation = WD_ORIENT.LANDSCAPE
+    section.page_width, section.page_height = section.page_height, section.page_width
+    document.add_paragraph("")
+    document.save(str(path))
+    return path
+
+
+#######################################
+print("Read the outline. 文書の概要")
+outline = util.docxoutline.read_outline(teacher_file_path)
+document = docx.Document(str(teacher_file_path))
+assert (outline.paragraph_count == len(document.paragraphs))
+assert (outline.heading_texts(level=1) == ["章タイトル1", "章タイトル2"])
+assert (outline.heading_texts(level=2) == ["節タイトル1A", "節タイトル1B", "節タイトル2A", "節タイトル2B"])
+assert (all(p.text == "" or outline.contains_paragraph(p.text) for p in document.paragraphs))
+assert (not outline.contains_paragraph("ABCDE. Added some sentences."))
+assert (outline.sections[0].orientation == "portrait")
+assert (outline.sections[0].page_width == 11906)
+assert (not outline.has_revisions)
+assert (outline.row()["headings"] == 6)
+print("OK")
+
+#######################################
+print("Differences of students. 学生の文書の違い")
+stu1 = util.docxoutline.read_outline(student_files_path[0])
+assert ([h.level for h in stu1.headings] == [1, 3, 2, 1, 2, 2])
+stu3 = util.docxoutline.read_outline(student_files_path[2])
+assert (stu3.paragraph_hashes != outline.paragraph_hashes)
+assert (sum(a != b for a, b in zip(stu3.paragraph_hashes, outline.paragraph_hashes)) == 1)
+print("OK")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = pathlib.Path(tmpdir)
+        filename = make_document(tmpdir / "outline.docx", make_png(tmpdir / "image.png"))
+
+        #######################################
+        print("Tables, images, sections and revisions. 表、画像、セクション、変更履歴")
+        outline = util.docxoutline.read_outline(filename)
+        assert ([(h.level, h.text) for h in outline.headings]
+                == [(1, "Title of chapter"), (2, "Title of section")])
+        assert (outline.contains_paragraph("Body text. Inserted."))
+        assert (outline.numbering == {"bullet": 2})
+        assert (outline.styles["List Bullet"] == 2)
+        assert ([(t.rows, t.columns, t.depth) for t in outline.tables] == [(2, 3, 0)])
+        assert (len(outline.images) == 1)
+        assert (outline.images[0].target.startswith("word/media/"))
+        assert (outline.images[0].width == Cm(2))
+        assert ([s.orientation for s in outline.sections] == ["portrait", "landscape"])
+        assert (outline.revisions == {"insertions": 1, "deletions": 1, "moves": 0, "format_changes": 0})
+        assert (outline.revision_authors == ["Student", "Teacher"])
+        assert ((outline.comments, outline.comment_authors) == (1, ["Teacher"]))
+        print("OK")
+
+        #######################################
+        print("Scan files. ファイルの一覧")
+        (tmpdir / "broken.docx").write_bytes(b"not a zip file")
+        rows = util.docxoutline.scan_directory(tmpdir, workers=2)
+        assert ([pathlib.Path(row["file"]).name for row in rows] == ["broken.docx", "outline.docx"])
+        assert (rows[0]["error"] is not None)
+        assert (rows[1]["error"] is None)
+        assert ((rows[1]["tables"], rows[1]["images"], rows[1]["sections"]) == (1, 1, 2))
+        assert (rows[1]["orientation"] == "landscape")
+        assert (rows[1] == util.docxoutline.scan_files([filename], workers=1)[0])
+        print("OK")
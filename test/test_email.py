@@ -2,7 +2,9 @@ import sys
 import os
 import filecmp
 import shutil
+import tempfile
 import pathlib
+import docx
 
 # append import path
 pardir = os.path.dirname(os.path.abspath(__file__))
@@ -103,3 +105,49 @@ assert (not dirdiff.right_only)
 assert (not dirdiff.diff_files)
 
 print("OK")
+
+#######################################
+print("#######################################")
+print("Parse once. 1回だけ解析する")
+util.emailutil.clear_cache()
+for filepath in filelist:
+    util.emailutil.get_header(filepath, ["From"])
+    util.emailutil.get_messagebody(filepath)
+info = util.emailutil._parse_file.cache_info()
+assert (info.misses == len(filelist) and info.hits == len(filelist))
+eml = util.emailutil.parse_eml(filelist[3])
+assert (eml is util.emailutil.parse_eml(str(filelist[3])))
+assert (eml.get_header(["Subject"]) == {"Subject": "attached mail"})
+# 変更されたファイルは解析し直す
+tmpdir = tempfile.mkdtemp()
+try:
+    tmpfile = os.path.join(tmpdir, "mail.eml")
+    shutil.copy(filelist[0], tmpfile)
+    assert (util.emailutil.get_header(tmpfile, ["Subject"]) == {"Subject": "hello subject"})
+    with open(filelist[1], "rb") as fin, open(tmpfile, "wb") as fout:
+        fout.write(fin.read())
+    os.utime(tmpfile, ns=(0, 0))
+    assert (util.emailutil.get_header(tmpfile, ["Subject"]) == {"Subject": "text mail"})
+    assert (util.emailutil.get_attached(tmpfile) == [])
+finally:
+    shutil.rmtree(tmpdir)
+print("OK")
+
+#######################################
+print("#######################################")
+print("Attached files in memory. メモリ上の添付ファイル")
+attachments = util.emailutil.get_attachments(filelist[3])
+assert ([a.name for a in attachments] == util.emailutil.get_attached(filelist[3], attach_out_dir))
+for attached in attachments:
+    with open(os.path.join(attach_orig_dir, attached.name), "rb") as f:
+        data = f.read()
+    assert (attached.size == len(data))
+    assert (attached.read(10) == data[:10])
+    attached.seek(0)
+    assert (attached.read() == data)
+assert (attachments[0].content_type == "text/plain")
+# 保存せずに python-docx に渡せる
+document = docx.Document(attachments[3])
+assert (attachments[3].name.endswith(".docx") and document.paragraphs is not None)
+assert (util.emailutil.get_attachments(filelist[0]) == [])
+print("OK")
@@ -0,0 +1,81 @@
+import sys
+import os
+import shutil
+import tempfile
+import pathlib
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.emailscan
+import util.emailutil
+
+sampledata_dir = os.path.join(pardir, "../sampledata/email")
+keys = ["From", "To", "Cc", "Subject"]
+
+
+#######################################
+print("Read headers only. ヘッダーだけを読む")
+filename = os.path.join(sampledata_dir, "email_data4_attached.eml")
+block = util.emailscan.read_header_block(filename)
+assert (block.startswith(b"MIME-Version: 1.0"))
+assert (len(block) < os.path.getsize(filename) // 10)
+assert (util.emailscan.read_headers(filename, keys) == util.emailutil.get_header(filename, keys))
+print("OK")
+
+#######################################
+print("Scan directory. ディレクトリのヘッダーを表にする")
+table = util.emailscan.scan_directory(sampledata_dir, keys)
+names = [pathlib.Path(f).relative_to(sampledata_dir).as_posix() for f in table.files]
+assert (names == ["email_data1.eml", "email_data2.eml", "email_data3_html.eml",
+                  "email_data4_attached.eml", "student1/assignment1.eml",
+                  "student2/Assignment1.eml"])
+for filename, row in zip(table.files, table.rows()):
+    expected = util.emailutil.get_header(filename, keys)
+    assert ({key: row[key] for key in keys} == expected)
+    assert (row["error"] is None)
+print("OK")
+
+#######################################
+print("Evaluate rules. ルールを評価する")
+rules = [
+    {"name": "sender", "header": "From", "op": "endswith", "value": "@EXAMPLE.com"},
+    {"name": "recipient", "header": "To", "op": "contains", "value": "teacher@example.com"},
+    {"name": "TA", "header": "Cc", "op": "contains", "value": "teaching_assistant@example.com"},
+    {"name": "subject", "header": "Subject", "op": "regex", "value": r"^(text|html) mail$"},
+    {"name": "exact", "header": "Subject", "op": "equals", "value": "Hello Subject",
+     "ignore_case": False},
+    {"name": "no_cc", "header": "Cc", "op": "exists", "negate": True},
+]
+results = util.emailscan.evaluate_rules(table, rules)
+rows = table.rows(results)
+for row in rows:
+    headers = {key: row[key] or "" for key in keys}
+    assert (row["sender"] == headers["From"].lower().endswith("@example.com"))
+    assert (row["recipient"] == ("teacher@example.com" in headers["To"]))
+    assert (row["TA"] == ("teaching_assistant@example.com" in headers["Cc"]))
+    assert (row["subject"] == (headers["Subject"] in ("text mail", "html mail")))
+    assert (not row["exact"])
+    assert (row["no_cc"] == (row["Cc"] is None))
+assert ([row["recipient"] for row in rows][4:] == [True, True])
+try:
+    util.emailscan.evaluate_rules(table, [{"name": "x", "header": "X-Mailer", "op": "exists"}])
+    assert (False)
+except ValueError:
+    pass
+print("OK")
+
+#######################################
+print("Missing file. 読めないファイル")
+tmpdir = tempfile.mkdtemp()
+try:
+    shutil.copy(os.path.join(sampledata_dir, "email_data1.eml"), tmpdir)
+    table = util.emailscan.scan_files([os.path.join(tmpdir, "email_data1.eml"),
+                                       os.path.join(tmpdir, "missing.eml")], keys)
+    rows = table.rows()
+    assert (rows[0]["Subject"] == "hello subject" and rows[0]["error"] is None)
+    assert (rows[1]["Subject"] is None and rows[1]["error"].startswith("FileNotFoundError"))
+finally:
+    shutil.rmtree(tmpdir)
+print("OK")
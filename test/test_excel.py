@@ -9,6 +9,9 @@ utildir = os.path.join(pardir, "../")
 sys.path.append(utildir)
 import util.excelutil
 import util.excelutil_exp
+import util.xlsxreader
+import util.sheetsnapshot
+import util.styleindex
 
 
 filename = os.path.join(pardir, "../sampledata/exceldata1.xlsx")
@@ -347,4 +350,163 @@ assert (not ret1)
 print("OK")
 
 
+#######################################
+print("Check font and border. 指定したセルの「フォント」「罫線」がｘｘである")
+assert (util.excelutil_exp.is_font(sheetdata=sheetData, sheetmath=sheetMath,
+                                   addr="C41", name="Yu Gothic", size=11, bold=False))
+assert (not util.excelutil_exp.is_font(sheetdata=sheetData, sheetmath=sheetMath,
+                                       addr="C41", bold=True))
+assert (util.excelutil_exp.get_font(sheetdata=sheetData, sheetmath=sheetMath,
+                                    addr="C41")["color"] == "theme:1")
+assert (util.excelutil_exp.is_bordered(sheetdata=sheetData, sheetmath=sheetMath,
+                                       addr="E60", border_style="thin"))
+assert (not util.excelutil_exp.is_bordered(sheetdata=sheetData, sheetmath=sheetMath,
+                                           addr="C37"))
+print("OK")
+
 
+#######################################
+print("Check styles in range. 指定したセル範囲の書式")
+countCells, countTrue = util.excelutil_exp.check_numberformat_in_range(
+    sheetdata=sheetData, sheetmath=sheetMath, range_string="E60:E67", number_format="General")
+assert (countCells == 8)
+assert (countTrue == 1)
+countCells, countTrue = util.excelutil_exp.check_solidfill_in_range(
+    sheetdata=sheetData, sheetmath=sheetMath, range_string="C54:C57")
+assert ((countCells, countTrue) == (4, 3))
+countCells, countTrue = util.excelutil_exp.check_border_in_range(
+    sheetdata=sheetData, sheetmath=sheetMath, range_string="E60:E67", border_style="thin")
+assert ((countCells, countTrue) == (8, 8))
+countCells, countTrue = util.excelutil_exp.check_font_in_range(
+    sheetdata=sheetData, sheetmath=sheetMath, range_string="E60:E67", italic=True)
+assert ((countCells, countTrue) == (8, 0))
+# 範囲の参照でセルは作られない
+numCells = len(sheetData._cells)
+countCells, countTrue = util.excelutil_exp.check_aligned_h_in_range(
+    sheetdata=sheetData, sheetmath=sheetMath, range_string="A1:Z200", horizontal="justify")
+assert (countCells == 26 * 200)
+assert (len(sheetData._cells) == numCells)
+# 書式はブックごとに1回だけ変換される
+assert (util.styleindex.style_at(sheetData, 60, 5) is util.styleindex.style_at(sheetData, 60, 5))
+
+# 1回の解析で読み込んだシートでも同じ結果になる
+book = util.xlsxreader.load_dual_workbook(filename, ranges={sheetName: ["C37:E67"]})
+dualData, dualMath = book[sheetName]
+for addr in ["C37", "C38", "C41", "C43", "C45", "C47", "E60", "E61", "E62", "E63", "E67"]:
+    for sheet in (sheetData, dualData):
+        style = util.styleindex.style_at(sheet, *openpyxl.utils.cell.coordinate_to_tuple(addr))
+        cell = sheetData[addr]
+        assert (style.horizontal == cell.alignment.horizontal)
+        assert (style.vertical == cell.alignment.vertical)
+        assert (style.fill_type == cell.fill.patternType)
+        assert (style.number_format == cell.number_format)
+        assert (style.border == (cell.border.left.style, cell.border.right.style,
+                                 cell.border.top.style, cell.border.bottom.style))
+countCells, countTrue = util.excelutil_exp.check_numberformat_in_range(
+    sheetdata=dualData, sheetmath=dualMath, range_string="E60:E67", number_format="General")
+assert ((countCells, countTrue) == (8, 1))
+# 列全体や行全体は使われているセルまでとする
+dualData, dualMath = util.xlsxreader.load_dual_workbook(filename)[sheetName]
+for sheet in (sheetData, dualData):
+    countCells, countTrue = util.excelutil_exp.check_numberformat_in_range(
+        sheetdata=sheet, sheetmath=sheet, range_string="E:E", number_format="General")
+    assert ((countCells, countTrue) == (67, 60))
+    countCells, countTrue = util.excelutil_exp.check_border_in_range(
+        sheetdata=sheet, sheetmath=sheet, range_string="60:60", border_style="thin")
+    assert ((countCells, countTrue) == (7, 2))
+print("OK")
+
+
+#######################################
+print("Check single-parse loader. 1回の読み込みで値と数式を取得する")
+book = util.xlsxreader.load_dual_workbook(filename)
+dualData, dualMath = book[sheetName]
+assert (book.sheetnames == wbdata.sheetnames)
+assert (util.excelutil.get_creator_lastmodify(book) == ("Creator01", "Editor02"))
+for row in sheetMath.iter_rows():
+    for cell in row:
+        assert (dualData[cell.coordinate].value == sheetData[cell.coordinate].value)
+        assert (dualMath[cell.coordinate].value == cell.value)
+assert (util.excelutil.is_formula(sheetdata=dualData, sheetmath=dualMath, addr="B5"))
+assert (not util.excelutil.is_formula(sheetdata=dualData, sheetmath=dualMath, addr="A4"))
+(countCells, countTrue) = util.excelutil.check_num_formulas_in_range(sheetdata=dualData, sheetmath=dualMath,
+                                                                 range_string="B12:E14")
+assert (countCells == 12)
+assert (countTrue == 3)
+(countCells, countTrue) = util.excelutil.check_func_in_range(sheetdata=dualData, sheetmath=dualMath,
+                                                         range_string="D21:D28", func_string="SUM")
+assert (countCells == 8)
+assert (countTrue == 2)
+print("OK")
+
+
+#######################################
+print("Check range-targeted loader. 指定したセル範囲だけを読み込む")
+book = util.xlsxreader.load_dual_workbook(filename, ranges={sheetName: ["B2", "C12:E13", "E14"]})
+rangeData, rangeMath = book[sheetName]
+assert (util.excelutil.is_given_value(sheetdata=rangeData, sheetmath=rangeMath, addr="B2", value=123))
+(countCells, countTrue) = util.excelutil.check_num_formulas_in_range(sheetdata=rangeData, sheetmath=rangeMath,
+                                                                 range_string="C12:E13")
+assert (countCells == 6)
+assert (countTrue == 2)
+# E14 は E13 の共有数式から作られる
+assert (rangeMath["E14"].value == sheetMath["E14"].value)
+assert (rangeData["E14"].value == sheetData["E14"].value)
+# 範囲外のセルは読まない
+assert (rangeData["B8"].value is None)
+assert (book[sheetName].max_row == 14)
+# 列全体と行全体の範囲
+book = util.xlsxreader.load_dual_workbook(filename, ranges={sheetName: ["E:E", "4:4"]})
+rangeData, rangeMath = book[sheetName]
+assert (rangeMath["E14"].value == sheetMath["E14"].value)
+assert (rangeData["E67"].value == sheetData["E67"].value is not None)
+assert ([c.value for c in rangeData["A4:E4"][0]] == [c.value for c in sheetData["A4:E4"][0]])
+assert (rangeData["B2"].value is None)
+assert (rangeData["C5"].value is None)
+print("OK")
+
+
+#######################################
+print("Check pass masks and relative tolerance. セルごとの合否と相対誤差")
+refdata2 = [
+    ["aa", 1290],
+    ["bbb", 45666],
+    ["c", 789],
+]
+(countCells, countTrue, mask) = util.excelutil.check_values_in_range(sheetdata=sheetData, sheetmath=sheetMath,
+                                                                 range_string="B8:C10",
+                                                                 values=refdata2, return_mask=True)
+assert (countCells == 6)
+assert (countTrue == 3)
+assert (mask.tolist() == [[False, True], [True, False], [False, True]])
+# 123.45678 と 123.5 の差は 0.01 より大きいが、相対誤差 0.1% 以内
+(countCells, countTrue) = util.excelutil.check_values_in_range_float(sheetdata=sheetData, sheetmath=sheetMath,
+                                                                 range_string="D32",
+                                                                 values=[[123.5]], diffval=0.01)
+assert (countTrue == 0)
+(countCells, countTrue, mask) = util.excelutil.check_values_in_range_float(sheetdata=sheetData, sheetmath=sheetMath,
+                                                                       range_string="D32",
+                                                                       values=[[123.5]], diffval=0.01,
+                                                                       reltol=0.001, return_mask=True)
+assert (countCells == 1)
+assert (countTrue == 1)
+assert (mask.tolist() == [[True]])
+(countCells, countTrue, mask) = util.excelutil.check_num_formulas_in_range(sheetdata=sheetData, sheetmath=sheetMath,
+                                                                       range_string="C12:E13",
+                                                                       return_mask=True)
+assert (mask.tolist() == [[False, False, True], [False, False, True]])
+snapshot = util.sheetsnapshot.take_snapshot(sheetData, sheetMath, "B8:C10")
+assert (snapshot.types.tolist() == [["s", "n"], ["s", "n"], ["s", "n"]])
+assert (snapshot.numbers[:, 1].tolist() == [1290, 456, 789])
+# 列全体や行全体は使われているセルまでとする
+(countCells, countTrue) = util.excelutil.check_num_formulas_in_range(sheetdata=sheetData, sheetmath=sheetMath,
+                                                                 range_string="E:E")
+assert ((countCells, countTrue) == (67, 3))
+(countCells, countTrue) = util.excelutil.check_values_in_range(sheetdata=sheetData, sheetmath=sheetMath,
+                                                           range_string="B:B", values=[[1]] * 5)
+assert ((countCells, countTrue) == (5, 0))
+(countCells, countTrue) = util.excelutil.check_values_in_range_float(sheetdata=sheetData, sheetmath=sheetMath,
+                                                                 range_string="B:B", values=[[1]] * 5)
+assert ((countCells, countTrue) == (5, 0))
+assert (util.sheetsnapshot.take_snapshot(sheetData, sheetMath, "3:3").values.shape == (1, 7))
+print("OK")
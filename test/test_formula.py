@@ -0,0 +1,196 @@
+import sys
+import os
+import io
+import openpyxl
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.excelutil
+import util.formula
+import util.formulaequiv
+import util.formulaeval
+import util.xlsxreader
+
+
+#######################################
+print("Parse formula. 数式の解析")
+parsed = util.formula.parse_formula("=AVERAGE(C14:D14)")
+assert (parsed.tree == ("func", "AVERAGE", (("ref", "C14:D14"),)))
+assert (parsed.functions == ("AVERAGE",))
+assert (parsed.references == ("C14:D14",))
+# 同じ数式は1回だけ解析される
+assert (util.formula.parse_formula("=AVERAGE(C14:D14)") is parsed)
+
+parsed = util.formula.parse_formula('=SUMIF(A1:A3, "$*", $B$1:B3) + -2^2 & "円"')
+assert (parsed.functions == ("SUMIF",))
+assert (not parsed.has_function("SUM"))
+assert (parsed.has_function("sumif"))
+assert (parsed.references == ("A1:A3", "$B$1:B3"))
+assert (parsed.literals == ("$*", 2.0, 2.0, "円"))
+assert (parsed.reference_kinds() == ["relative", "relative", "absolute", "relative"])
+assert (util.formula.parse_formula("=B$52+10").reference_kinds() == ["mixed"])
+# 列全体と行全体の範囲
+assert (util.formula.parse_formula("=SUM($A:$A)").reference_kinds() == ["absolute", "absolute"])
+assert (util.formula.parse_formula("=SUM(Sheet2!$1:$1)").has_absolute_reference())
+assert (util.formula.parse_formula("=SUM(A:A,1:1)").reference_kinds() == ["relative"] * 4)
+assert (not util.formula.parse_formula("=SUM(A:A)").has_absolute_reference())
+assert (util.formula.parse_formula("=-2^2").tree ==
+        ("op", "^", (("prefix", "-", ("number", 2.0)), ("number", 2.0))))
+assert (util.formula.parse_formula("=1+2*3").tree ==
+        ("op", "+", (("number", 1.0), ("op", "*", (("number", 2.0), ("number", 3.0))))))
+assert (util.formula.parse_formula("=IF(A1,,2)").tree ==
+        ("func", "IF", (("ref", "A1"), ("empty",), ("number", 2.0))))
+assert (util.formula.parse_formula("=_xlfn.STDEV.S(A1:A3)").functions == ("STDEV.S",))
+for badformula in ["=SUM(1", "=1+", "=)"]:
+    try:
+        util.formula.parse_formula(badformula)
+        assert (False)
+    except ValueError:
+        pass
+assert (util.formula.parse_cell_formula("SUM") is None)
+assert (util.formula.parse_cell_formula(123) is None)
+print("OK")
+
+
+#######################################
+print("Exact function and reference checks. 関数名と参照の厳密なチェック")
+wb = openpyxl.Workbook()
+sheetMath = wb.active
+sheetMath["A1"] = "=SUM(B1:B3)"
+sheetMath["A2"] = "=SUMIF(B1:B3, \">0\")"
+sheetMath["A3"] = "SUM"
+sheetMath["A4"] = "=B$1*2"
+sheetMath["A5"] = "=B1&\"$\""
+(countCells, countTrue) = util.excelutil.check_func_in_range(sheetdata=sheetMath, sheetmath=sheetMath,
+                                                         range_string="A1:A5", func_string="SUM")
+assert (countCells == 5)
+assert (countTrue == 1)
+# 以前と同じ文字列としてのチェック
+(countCells, countTrue) = util.excelutil.check_func_in_range(sheetdata=sheetMath, sheetmath=sheetMath,
+                                                         range_string="A1:A5", func_string="SUM",
+                                                         exact=False)
+assert (countTrue == 3)
+(countCells, countTrue) = util.excelutil.check_comp_abs_ref_in_range(sheetdata=sheetMath, sheetmath=sheetMath,
+                                                                 range_string="A1:A5")
+assert (countCells == 5)
+assert (countTrue == 1)
+print("OK")
+
+
+#######################################
+print("Formula equivalence. 数式が同じ意味かどうか")
+for formula in ["=D4+C4", "= C4  +  D4", "=SUM(C4:D4)", "=SUM(C4, D4)", "= C4 * 100 / 100 + D4 "]:
+    assert (util.formulaequiv.is_equivalent(formula, "=C4+D4"))
+for formula in ["=C4*D4", "=C4+D4+E4", "=46"]:
+    assert (not util.formulaequiv.is_equivalent(formula, "=C4+D4"))
+assert (util.formulaequiv.is_equivalent("= (C9+100)*(D9-100) +100*C9 -100*D9 + 10000", "=C9*D9"))
+assert (util.formulaequiv.is_equivalent("=SUM(C14:D14)/COUNT(C14:D14)", "=AVERAGE(C14:D14)"))
+assert (util.formulaequiv.is_equivalent("=IF(C4>0, C4, -C4)", "=ABS(C4)"))
+# どの入力でも NaN になる数式どうしは同じ意味ではない
+assert (not util.formulaequiv.is_equivalent("=SQRT(-1-ABS(C4))", "=SQRT(-2-C4*C4)"))
+assert (not util.formulaequiv.is_equivalent("=SQRT(C4)", "=SQRT(ABS(C4))"))
+assert (util.formulaequiv.is_equivalent("=SQRT(C4)*2", "=SQRT(C4)+SQRT(C4)"))
+try:
+    util.formulaequiv.is_equivalent("=VLOOKUP(1, A1:B2, 2)", "=C4+D4")
+    assert (False)
+except ValueError:
+    pass
+# 同じ数式は1回だけコンパイルする
+assert (util.formulaequiv.compile_formula("=C4+D4") is util.formulaequiv.compile_formula("=C4+D4"))
+results = util.formulaequiv.check_equivalence(["=SUM(C4:D4)", None, "=VLOOKUP(1, A1:B2, 2)", "=C4-D4",
+                                               "=SUM(C4:D4)"], "=C4+D4")
+assert (results == [True, False, False, False, True])
+sheetMath["E4"] = "=SUM(C4, D4)"
+assert (util.excelutil.is_equivalent_formula(sheetdata=sheetMath, sheetmath=sheetMath,
+                                             addr="E4", formula="=C4+D4"))
+assert (not util.excelutil.is_equivalent_formula(sheetdata=sheetMath, sheetmath=sheetMath,
+                                                 addr="E5", formula="=C4+D4"))
+print("OK")
+
+
+#######################################
+print("Formula evaluation. 保存されていない数式の値の計算")
+# openpyxl で保存したブックには数式の値が保存されない
+wb = openpyxl.Workbook()
+ws = wb.active
+ws.title = "Sheet1"
+ws.append(["name", "score1", "score2", "total"])
+for i, (a, b) in enumerate([(46, 54), (30, 20), (15, 70)], start=2):
+    ws.append(["s{}".format(i), a, b, "=B{0}+C{0}".format(i)])
+ws["D5"] = "=SUM(D2:D4)"
+ws["D6"] = "=ROUND(AVERAGE(B2:C4), 1)"
+ws["D7"] = '=COUNTIF(B2:C4, ">40")'
+ws["D8"] = '=IF(D5>250, "pass", "fail")'
+ws["D9"] = "=B2/0"
+ws["D10"] = "=VLOOKUP(1, A1:B2, 2)"
+buf = io.BytesIO()
+wb.save(buf)
+buf.seek(0)
+book = util.xlsxreader.load_dual_workbook(buf)
+sheetData, sheetMath = book["Sheet1"]
+assert (sheetData["D5"].value is None)
+missing = util.formulaeval.missing_values(book)
+assert (len(missing) == 9)
+assert (util.formulaeval.missing_values(book, {"Sheet1": ["D5:D6"]}) == [("Sheet1", 5, 4), ("Sheet1", 6, 4)])
+filled = util.formulaeval.fill_missing_values(book)
+assert (len(filled) == 8)
+assert ([sheetData.cell_value(row, 4) for row in range(2, 11)] ==
+        [100, 50, 85, 235, 39.2, 3, "fail", "#DIV/0!", None])
+assert (sheetMath["D5"].value == "=SUM(D2:D4)")
+
+# 範囲を指定して読み込んでも、範囲外の参照先から計算する
+buf.seek(0)
+book = util.xlsxreader.load_dual_workbook(buf, ranges={"Sheet1": ["D5"]}, evaluate=True)
+sheetData, sheetMath = book["Sheet1"]
+assert (sheetData["D5"].value == 235)
+# 計算に使った範囲外のセルは読み込まない
+assert (sheetData["D2"].value is None)
+assert (sheetMath["D8"].value is None)
+assert (sheetData.max_row == 5)
+
+# 値を変えると、依存するセルだけが再計算される
+buf.seek(0)
+evaluator = util.formulaeval.Evaluator(util.xlsxreader.load_dual_workbook(buf), use_cached=False)
+assert (evaluator.value("Sheet1", "D8") == "fail")
+evaluator.set_value("Sheet1", "B2", 146)
+assert (evaluator.value("Sheet1", "D2") == 200)
+assert (evaluator.value("Sheet1", "D5") == 335)
+assert (evaluator.value("Sheet1", "D8") == "pass")
+assert (evaluator.value("Sheet1", "D9") == util.formulaeval.ExcelError("#DIV/0!"))
+
+# 負の数の小数乗は #NUM! にする
+wb = openpyxl.Workbook()
+ws = wb.active
+ws.title = "Sheet1"
+ws.append([-8, "=POWER(A1, 1/3)", "=A1^0.5", "=POWER(A1, 2)", "=2^-1"])
+buf = io.BytesIO()
+wb.save(buf)
+buf.seek(0)
+evaluator = util.formulaeval.Evaluator(util.xlsxreader.load_dual_workbook(buf))
+assert ([evaluator.value("Sheet1", addr) for addr in ["B1", "C1", "D1", "E1"]] ==
+        [util.formulaeval.ExcelError("#NUM!"), util.formulaeval.ExcelError("#NUM!"), 64, 0.5])
+
+# 長い参照の連鎖も再帰の上限を超えずに計算する
+wb = openpyxl.Workbook()
+ws = wb.active
+ws.title = "Sheet1"
+for row in range(1, 2000):
+    ws.cell(row=row, column=1, value="=A{}+1".format(row + 1))
+ws["A2000"] = 1
+ws["B1"] = "=B2"
+ws["B2"] = "=B1"
+buf = io.BytesIO()
+wb.save(buf)
+buf.seek(0)
+book = util.xlsxreader.load_dual_workbook(buf, ranges={"Sheet1": ["A1", "B1"]}, evaluate=True)
+sheetData, sheetMath = book["Sheet1"]
+assert (sheetData["A1"].value == 2000)
+assert (sheetData["A1000"].value is None)
+assert (sheetMath["A1000"].value is None)
+buf.seek(0)
+assert (util.formulaeval.Evaluator(util.xlsxreader.load_dual_workbook(buf)).value("Sheet1", "A1000") == 1001)
+# 循環参照のセルは計算しない
+assert (sheetData["B1"].value is None)
+print("OK")
@@ -0,0 +1,79 @@
+import sys
+import os
+import shutil
+import tempfile
+import pathlib
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.excelutil
+import util.gradecache
+
+sampledata_dir = os.path.join(pardir, "../sampledata")
+testfiles = [
+    "exceldata1.xlsx",
+    "word/testfile1.docx",
+    "powerpoint/testfile1.pptx",
+    "email/email_data1.eml",
+]
+
+rubric1 = {"checks": [{"name": "value", "check": "is_given_value", "addr": "B2", "value": 123}]}
+rubric2 = {"checks": [{"name": "value", "check": "is_given_value", "addr": "B2", "value": 124}]}
+key1 = util.gradecache.rubric_key(rubric1, modules=[util.excelutil])
+key2 = util.gradecache.rubric_key(rubric2, modules=[util.excelutil])
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    dbpath = os.path.join(tmpdir, "cache.sqlite3")
+
+    #######################################
+    print("Store and get rows. 行の保存と取得")
+    assert (key1 != key2)
+    assert (key1 == util.gradecache.rubric_key(rubric1, modules=[util.excelutil]))
+    with util.gradecache.GradeCache(dbpath) as cache:
+        for item in testfiles:
+            filepath = os.path.join(sampledata_dir, item)
+            assert (cache.get(filepath, key1) is None)
+            cache.put(filepath, key1, {"file": item, "score": (1, 2)})
+    # 開き直しても残っている
+    with util.gradecache.GradeCache(dbpath) as cache:
+        for item in testfiles:
+            filepath = os.path.join(sampledata_dir, item)
+            assert (cache.get(filepath, key1) == {"file": item, "score": (1, 2)})
+            assert (cache.get(filepath, key2) is None)
+    print("OK")
+
+    #######################################
+    print("Same contents share a row. 同じ中身のファイルは同じ行を使う")
+    copypath = os.path.join(tmpdir, "copy.xlsx")
+    shutil.copyfile(os.path.join(sampledata_dir, "exceldata1.xlsx"), copypath)
+    with util.gradecache.GradeCache(dbpath) as cache:
+        assert (cache.get(copypath, key1) == {"file": "exceldata1.xlsx", "score": (1, 2)})
+        # 中身が変われば別のキーになる
+        with open(copypath, "ab") as f:
+            f.write(b"\0")
+        assert (cache.get(copypath, key1) is None)
+    print("OK")
+
+    #######################################
+    print("Eviction. サイズによる削除")
+    with util.gradecache.GradeCache(os.path.join(tmpdir, "small.sqlite3"), max_bytes=1500) as cache:
+        cache.put(copypath, key1, {"data": "x" * 1000})
+        cache.put(copypath, key2, {"data": "y" * 1000})
+        # 古い行から削除される
+        assert (cache.get(copypath, key1) is None)
+        assert (cache.get(copypath, key2) == {"data": "y" * 1000})
+    print("OK")
+
+    #######################################
+    print("Invalidate. キャッシュの消去")
+    with util.gradecache.GradeCache(dbpath) as cache:
+        cache.put(copypath, key2, {"score": 1})
+        assert (cache.invalidate(key2) == 1)
+        assert (cache.get(copypath, key2) is None)
+        assert (cache.get(os.path.join(sampledata_dir, testfiles[0]), key1) is not None)
+    util.gradecache.main(["invalidate", dbpath])
+    with util.gradecache.GradeCache(dbpath) as cache:
+        assert (cache.get(os.path.join(sampledata_dir, testfiles[0]), key1) is None)
+    print("OK")
@@ -0,0 +1,231 @@
+import sys
+import os
+import filecmp
+import mailbox
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import pathlib
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.emailutil
+import util.mailsource
+
+sampledata_dir = os.path.join(pardir, "../sampledata/email")
+testfiles = [
+    "email_data1.eml",
+    "email_data2.eml",
+    "email_data3_html.eml",
+    "email_data4_attached.eml",
+]
+filelist = [pathlib.Path(os.path.join(sampledata_dir, item)) for item in testfiles]
+keys = ["From", "To", "Cc", "Subject"]
+
+
+def make_mailboxes(tmpdir):
+    # サンプルの eml ファイルから mbox と Maildir を作る
+    mboxpath = os.path.join(tmpdir, "course.mbox")
+    maildirpath = os.path.join(tmpdir, "course")
+    mbox = mailbox.mbox(mboxpath)
+    maildir = mailbox.Maildir(maildirpath)
+    for i, filepath in enumerate(filelist):
+        with open(filepath, "rb") as f:
+            mbox.add(f.read())
+        # mailbox.Maildir.add は改行を変換するので、そのままコピーする
+        shutil.copy(filepath, os.path.join(maildirpath, "new", "{}.msg{}".format(i, i)))
+    mbox.close()
+    return mboxpath, maildirpath
+
+
+def get_subject(eml):
+    return eml.get_header(["Subject"])["Subject"]
+
+
+def check_messages(path, tmpdir):
+    assert (util.mailsource.is_maildir(path) == os.path.isdir(path))
+    messages = list(util.mailsource.iter_messages(path))
+    assert (len(messages) == len(filelist))
+    if util.mailsource.is_maildir(path):
+        # Maildir のキーの順は追加した順とは限らないので件名で対応させる
+        bysubject = {util.emailutil.get_header(f, ["Subject"])["Subject"]: f for f in filelist}
+        pairs = [(bysubject[get_subject(eml)], eml) for _, eml in messages]
+    else:
+        assert ([key for key, _ in messages] == [0, 1, 2, 3])
+        pairs = [(f, eml) for f, (_, eml) in zip(filelist, messages)]
+    for filepath, eml in pairs:
+        assert (eml.get_header(keys) == util.emailutil.get_header(filepath, keys))
+        assert (eml.get_messagebody() == util.emailutil.get_messagebody(filepath))
+        outdir = os.path.join(tmpdir, "attached")
+        os.makedirs(outdir, exist_ok=True)
+        names = eml.get_attached(outdir)
+        assert (names == util.emailutil.parse_eml(filepath).get_attached(outdir))
+        for name in names:
+            assert (filecmp.cmp(os.path.join(outdir, name),
+                                os.path.join(sampledata_dir, "attached_original", name),
+                                shallow=False))
+        try:
+            eml.get_attached()
+            assert (not names)
+        except ValueError:
+            pass
+
+
+class StandInImap(socketserver.ThreadingTCPServer):
+    # テスト用の最小限の IMAP サーバー。LOGIN、EXAMINE、UID SEARCH、UID FETCH だけに対応する
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages, uidvalidity=1):
+        super().__init__(("127.0.0.1", 0), StandInImapHandler)
+        self.messages = dict(messages)
+        self.uidvalidity = uidvalidity
+        self.fetched = []
+        self.logins = 0
+        self.lock = threading.Lock()
+
+
+def _parse_uid_set(text, uids):
+    found = set()
+    for item in text.split(","):
+        first, _, last = item.partition(":")
+        top = max(uids) if uids else 0
+        low = top if first == "*" else int(first)
+        high = low if not last else (top if last == "*" else int(last))
+        low, high = min(low, high), max(low, high)
+        found.update(uid for uid in uids if low <= uid <= high)
+    return sorted(found)
+
+
+class StandInImapHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        self.send(b"* OK IMAP4rev1 stand-in ready\r\n")
+        for line in self.rfile:
+            tag, _, command = line.decode("ascii").strip().partition(" ")
+            words = command.split(" ")
+            name = words[0].upper()
+            if name == "CAPABILITY":
+                self.send(b"* CAPABILITY IMAP4rev1\r\n")
+            elif name == "LOGIN":
+                if [w.strip('"') for w in words[1:]] != ["course", "secret"]:
+                    self.send(tag.encode() + b" NO LOGIN failed\r\n")
+                    continue
+                with server.lock:
+                    server.logins += 1
+            elif name == "EXAMINE":
+                self.send("* {} EXISTS\r\n* OK [UIDVALIDITY {}] UIDs valid\r\n".format(
+                    len(server.messages), server.uidvalidity).encode())
+                self.send(tag.encode() + b" OK [READ-ONLY] EXAMINE completed\r\n")
+                continue
+            elif name == "UID" and words[1].upper() == "SEARCH":
+                uids = _parse_uid_set(words[3], sorted(server.messages))
+                self.send(("* SEARCH " + " ".join(map(str, uids))).rstrip().encode() + b"\r\n")
+            elif name == "UID" and words[1].upper() == "FETCH":
+                item = re.search(r"BODY\.PEEK\[(HEADER)?\]", command).group(1)
+                uids = sorted(server.messages)
+                for seq, uid in enumerate(uids, 1):
+                    if uid not in _parse_uid_set(words[2], uids):
+                        continue
+                    data = server.messages[uid]
+                    if item == "HEADER":
+                        data = data[:data.index(b"\r\n\r\n") + 4]
+                    with server.lock:
+                        server.fetched.append((uid, item or "FULL"))
+                    self.send("* {} FETCH (UID {} BODY[{}] {{{}}}\r\n".format(
+                        seq, uid, item or "", len(data)).encode() + data + b")\r\n")
+            elif name == "LOGOUT":
+                self.send(b"* BYE logging out\r\n" + tag.encode() + b" OK LOGOUT completed\r\n")
+                return
+            elif name != "NOOP":
+                self.send(tag.encode() + b" BAD unknown command\r\n")
+                continue
+            self.send(tag.encode() + b" OK completed\r\n")
+
+
+#######################################
+print("Read mbox and Maildir. mbox と Maildir を読む")
+tmpdir = tempfile.mkdtemp()
+try:
+    mboxpath, maildirpath = make_mailboxes(tmpdir)
+    check_messages(mboxpath, tmpdir)
+    check_messages(maildirpath, tmpdir)
+    # mailbox.mbox と同じメッセージに分割する
+    raw = [data for _, data in util.mailsource.iter_mbox(mboxpath)]
+    assert (raw == [mailbox.mbox(mboxpath).get_bytes(i) for i in range(len(filelist))])
+finally:
+    shutil.rmtree(tmpdir)
+print("OK")
+
+
+#######################################
+print("Read an IMAP mailbox. IMAP のメールボックスを読む")
+imap_messages = {}
+for uid, filepath in zip([3, 4, 7, 9], filelist):
+    with open(filepath, "rb") as f:
+        imap_messages[uid] = f.read()
+server = StandInImap(imap_messages)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+tmpdir = tempfile.mkdtemp()
+try:
+    port = server.server_address[1]
+    pool = util.mailsource.ImapPool("127.0.0.1", "course", "secret", port=port, ssl=False, size=2)
+    checkpoint = util.mailsource.UidCheckpoint(os.path.join(tmpdir, "imap.sqlite3"))
+    with pool, checkpoint:
+        source = util.mailsource.ImapSource(pool, checkpoint, batch_size=2)
+        assert (source.new_uids() == [3, 4, 7, 9])
+        # ヘッダーを先に取得し、条件を満たすメッセージだけ全体を取得する
+        wanted = lambda headers: headers["Subject"] in ("text mail", "attached mail")
+        messages = list(source.iter_messages(header_filter=wanted))
+        assert ([uid for uid, _ in messages] == [4, 9])
+        assert (messages[0][1].get_header(keys) == util.emailutil.get_header(filelist[1], keys))
+        assert (messages[1][1].get_messagebody() == util.emailutil.get_messagebody(filelist[3]))
+        assert ([a.name for a in messages[1][1].get_attachments()]
+                == [a.name for a in util.emailutil.get_attachments(filelist[3])])
+        assert (sorted(server.fetched) == [(3, "HEADER"), (4, "FULL"), (4, "HEADER"),
+                                           (7, "HEADER"), (9, "FULL"), (9, "HEADER")])
+        assert (server.logins <= 2)
+        # 2回目は新しいメッセージだけを取得する
+        assert (source.new_uids() == [] and list(source.iter_messages()) == [])
+        server.messages[12] = imap_messages[3]
+        server.fetched.clear()
+        assert ([uid for uid, _ in source.iter_messages()] == [12])
+        assert (server.fetched == [(12, "FULL")])
+        # UIDVALIDITY が変わると最初からやり直す
+        assert (checkpoint.get(source.name, 1) == 12 and checkpoint.get(source.name, 2) == 0)
+    try:
+        util.mailsource.ImapPool("127.0.0.1", "course", "wrong", port=port, ssl=False)._open()
+        assert (False)
+    except util.mailsource.imaplib.IMAP4.error:
+        pass
+finally:
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(tmpdir)
+print("OK")
+
+
+if __name__ == "__main__":
+    #######################################
+    print("Process messages with workers. ワーカープロセスでメッセージを処理する")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        mboxpath, maildirpath = make_mailboxes(tmpdir)
+        expected = [util.emailutil.get_header(f, ["Subject"])["Subject"] for f in filelist]
+        for workers in [1, 2]:
+            results = list(util.mailsource.map_messages(get_subject, mboxpath, workers=workers,
+                                                        max_pending=2))
+            assert (results == list(enumerate(expected)))
+        results = list(util.mailsource.map_messages(get_subject, maildirpath, workers=2))
+        assert (sorted(result for _, result in results) == sorted(expected))
+    finally:
+        shutil.rmtree(tmpdir)
+    print("OK")
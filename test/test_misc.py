@@ -1,6 +1,8 @@
 import sys
 import os
 import shutil
+import tempfile
+import zipfile
 import openpyxl
 
 # append import path
@@ -50,6 +52,118 @@ for item in filepathlist:
 assert (tmplist == expected_list)
 print("list xls OK")
 
+#######################################
+print("Iterate files. ファイルを1つずつ返す")
+tmpdir = tempfile.mkdtemp()
+try:
+    for name in ["a.xlsx", "b.docx", "c.txt", "~$a.xlsx", "sub/d.xlsx", ".git/e.xlsx"]:
+        os.makedirs(os.path.dirname(os.path.join(tmpdir, name)), exist_ok=True)
+        with open(os.path.join(tmpdir, name), "w") as f:
+            f.write(name)
+    files = [p.relative_to(tmpdir).as_posix()
+             for p in util.misc.iterfiles(tmpdir, ext=(".xlsx", ".docx"), ignore=["~$*", ".git"])]
+    assert (files == ["a.xlsx", "b.docx", "sub/d.xlsx"])
+    files = [p.relative_to(tmpdir).as_posix()
+             for p in util.misc.iterfiles(tmpdir, ext=".xlsx", ignore=["sub/*"])]
+    assert (files == [".git/e.xlsx", "a.xlsx", "~$a.xlsx"])
+
+    # 2回目以降は新しいファイルと変更されたファイルだけを返す
+    dbpath = os.path.join(tmpdir, "manifest.sqlite3")
+    with util.misc.FileManifest(dbpath) as manifest:
+        assert (len(list(util.misc.iterfiles(tmpdir, ext=".xlsx", manifest=manifest))) == 4)
+        assert (list(util.misc.iterfiles(tmpdir, ext=".xlsx", manifest=manifest)) == [])
+    with open(os.path.join(tmpdir, "sub/d.xlsx"), "w") as f:
+        f.write("changed")
+    with open(os.path.join(tmpdir, "f.xlsx"), "w") as f:
+        f.write("new")
+    # 更新日時だけが変わったファイルは返さない
+    os.utime(os.path.join(tmpdir, "a.xlsx"), ns=(0, 0))
+    with util.misc.FileManifest(dbpath) as manifest:
+        files = [p.relative_to(tmpdir).as_posix()
+                 for p in util.misc.iterfiles(tmpdir, ext=".xlsx", manifest=manifest)]
+        assert (files == ["f.xlsx", "sub/d.xlsx"])
+        assert (manifest.get(os.path.join(tmpdir, "a.xlsx"))[1] == 0)
+        manifest.forget(os.path.join(tmpdir, "a.xlsx"))
+        assert ([p.name for p in util.misc.iterfiles(tmpdir, ext=".xlsx", manifest=manifest)]
+                == ["a.xlsx"])
+    # 処理中にエラーになったファイルは記録せず、次も返す
+    try:
+        with util.misc.FileManifest(dbpath) as manifest:
+            for p in util.misc.iterfiles(tmpdir, ext=".docx", manifest=manifest):
+                raise RuntimeError(p.name)
+    except RuntimeError as e:
+        assert (str(e) == "b.docx")
+    with util.misc.FileManifest(dbpath) as manifest:
+        assert ([p.name for p in util.misc.iterfiles(tmpdir, ext=".docx", manifest=manifest)]
+                == ["b.docx"])
+        assert (list(util.misc.iterfiles(tmpdir, ext=".docx", manifest=manifest)) == [])
+    # エラーになる前に処理したファイルは記録が残る
+    dbpath = os.path.join(tmpdir, "partial.sqlite3")
+    try:
+        with util.misc.FileManifest(dbpath) as manifest:
+            for p in util.misc.iterfiles(tmpdir, ext=".xlsx", ignore=["~$*", ".git"],
+                                         manifest=manifest):
+                if p.name == "d.xlsx":
+                    raise RuntimeError(p.name)
+    except RuntimeError as e:
+        assert (str(e) == "d.xlsx")
+    with util.misc.FileManifest(dbpath) as manifest:
+        assert ([p.name for p in util.misc.iterfiles(tmpdir, ext=".xlsx", ignore=["~$*", ".git"],
+                                                     manifest=manifest)] == ["d.xlsx"])
+
+    print("Watch a directory. ディレクトリの監視")
+    watcher = util.misc.DirectoryWatcher(tmpdir, ext=".xlsx", ignore=["~$*", ".git"], settle=0,
+                                         full_scan_interval=3600)
+    # 見つけたファイルは次のポーリングで報告する
+    assert (watcher.poll() == [])
+    assert ([p.name for p in watcher.poll()] == ["a.xlsx", "f.xlsx", "d.xlsx"])
+    assert (watcher.poll() == [])
+    with open(os.path.join(tmpdir, "sub/g.xlsx"), "w") as f:
+        f.write("new")
+    assert (watcher.poll() == [])
+    assert ([p.name for p in watcher.poll()] == ["g.xlsx"])
+    # 書き込み中 (更新日時が新しい) のファイルは報告しない
+    with open(os.path.join(tmpdir, "h.xlsx"), "w") as f:
+        f.write("new")
+    watcher.settle = 3600
+    watcher.poll()
+    assert (watcher.poll() == [])
+    watcher.settle = 0
+    assert ([p.name for p in watcher.poll()] == ["h.xlsx"])
+    # その場で上書きしたファイルは全体を調べ直したときに見つける
+    with open(os.path.join(tmpdir, "a.xlsx"), "w") as f:
+        f.write("overwritten")
+    os.utime(os.path.join(tmpdir, "a.xlsx"), ns=(1, 1))
+    watcher.full_scan_interval = 0
+    watcher.poll()
+    assert ([p.name for p in watcher.poll()] == ["a.xlsx"])
+    # commit していないファイルは再起動した後に再び報告する
+    dbpath = os.path.join(tmpdir, "watch.sqlite3")
+    with util.misc.FileManifest(dbpath) as manifest:
+        watcher = util.misc.DirectoryWatcher(tmpdir, ext=".xlsx", ignore=["~$*", ".git"],
+                                             manifest=manifest, settle=0)
+        watcher.poll()
+        reported = watcher.poll()
+        assert ([p.name for p in reported] == ["a.xlsx", "f.xlsx", "h.xlsx", "d.xlsx", "g.xlsx"])
+        watcher.commit(reported[:2])
+    with util.misc.FileManifest(dbpath) as manifest:
+        watcher = util.misc.DirectoryWatcher(tmpdir, ext=".xlsx", ignore=["~$*", ".git"],
+                                             manifest=manifest, settle=0)
+        watcher.poll()
+        assert ([p.name for p in watcher.poll()] == ["h.xlsx", "d.xlsx", "g.xlsx"])
+        watcher.commit()
+    # 拡張子の大文字と小文字は区別しない
+    with open(os.path.join(tmpdir, "Report.XLSX"), "w") as f:
+        f.write("upper")
+    assert ([p.name for p in util.misc.iterfiles(tmpdir, ext=[".xlsx"], ignore=["~$*", ".git", "sub"])]
+            == ["Report.XLSX", "a.xlsx", "f.xlsx", "h.xlsx"])
+    watcher = util.misc.DirectoryWatcher(tmpdir, ext=".XLSX", ignore=["~$*", ".git", "sub"], settle=0)
+    watcher.poll()
+    assert ([p.name for p in watcher.poll()] == ["Report.XLSX", "a.xlsx", "f.xlsx", "h.xlsx"])
+finally:
+    shutil.rmtree(tmpdir)
+print("OK")
+
 #######################################
 print("Encript xlsx")
 
@@ -91,4 +205,119 @@ shutil.copytree(src=abssrcdirname, dst=absdstdirname, dirs_exist_ok=True)
 util.misc.decript_xlsxs(
     rootdir=absdstdirname, password="abc", flag_delete=True)
 
-print("Please check by hand that files are deccripted {}".format(absdstdirname))
\ No newline at end of file
+print("Please check by hand that files are deccripted {}".format(absdstdirname))
+
+
+#######################################
+print("Decrypt into memory. メモリ上での復号")
+tmpdir = tempfile.mkdtemp()
+try:
+    for name in ["exceldata1.xlsx", "word/stu1_word.docx"]:
+        shutil.copy(os.path.join(pardir, "../sampledata", name), tmpdir)
+        util.misc.encrypt_file(os.path.join(tmpdir, os.path.basename(name)), password="abc",
+                               flag_delete=True)
+    encfile = os.path.join(tmpdir, "exceldata1_enc.xlsx")
+    cache = util.misc.DecryptedCache()
+    wb = openpyxl.load_workbook(util.misc.decrypt_to_buffer(encfile, "abc", cache=cache))
+    assert (wb.sheetnames == ["Sheet1"])
+    # 2回目はキャッシュから取り出す
+    assert (len(cache) == 1)
+    size = cache.size
+    buf = util.misc.decrypt_to_buffer(encfile, "abc", cache=cache)
+    assert (len(cache) == 1 and cache.size == size)
+    assert (buf.read(2) == b"PK")
+    # 復号したファイルはディスクに書かない
+    assert (sorted(os.listdir(tmpdir)) == ["exceldata1_enc.xlsx", "stu1_word_enc.docx"])
+    # 暗号化されていないファイルはそのまま返す
+    plain = os.path.join(pardir, "../sampledata/exceldata2.xlsx")
+    with open(plain, "rb") as f:
+        assert (util.misc.decrypt_to_buffer(plain, "abc").getvalue() == f.read())
+    try:
+        util.misc.decrypt_to_buffer(encfile, "wrong")
+        assert (False)
+    except util.misc.msoffcrypto.exceptions.InvalidKeyError:
+        pass
+    # サイズの上限を超えると古いものから削除する
+    small = util.misc.DecryptedCache(max_bytes=size + 1)
+    util.misc.decrypt_to_buffer(encfile, "abc", cache=small)
+    util.misc.decrypt_to_buffer(os.path.join(tmpdir, "stu1_word_enc.docx"), "abc", cache=small)
+    assert (len(small) == 1)
+
+    print("Random access decryption. 必要な部分だけの復号")
+    full = util.misc.decrypt_to_buffer(encfile, "abc").getvalue()
+    with util.misc.DecryptingReader(encfile, "abc") as reader:
+        assert (reader.size == len(full))
+        for offset, length in [(0, 10), (4090, 20), (len(full) - 5, 100), (8192, 4096)]:
+            reader.seek(offset)
+            assert (reader.read(length) == full[offset:offset + length])
+        reader.seek(-3, os.SEEK_END)
+        assert (reader.read() == full[-3:])
+        reader.seek(0)
+        assert (reader.read() == full)
+    # docProps/core.xml を読むのに全てのセグメントは復号しない
+    with util.misc.DecryptingReader(os.path.join(tmpdir, "stu1_word_enc.docx"), "abc") as reader:
+        with zipfile.ZipFile(reader) as archive:
+            assert (archive.read("docProps/core.xml").startswith(b"<?xml"))
+        assert (0 < reader.decrypted_segments < -(-reader.size // util.misc.SEGMENT_LENGTH))
+    with util.misc.DecryptingReader(encfile, "abc") as reader:
+        wb = openpyxl.load_workbook(reader)
+        assert (wb.sheetnames == ["Sheet1"])
+    try:
+        util.misc.DecryptingReader(encfile, "wrong")
+        assert (False)
+    except util.misc.msoffcrypto.exceptions.InvalidKeyError:
+        pass
+    try:
+        util.misc.DecryptingReader(plain, "abc")
+        assert (False)
+    except util.misc.msoffcrypto.exceptions.DecryptionError:
+        pass
+finally:
+    shutil.rmtree(tmpdir)
+print("OK")
+
+
+#######################################
+def check_parallel_crypt():
+    print("Encrypt and decrypt in parallel. 並列での暗号化と復号")
+    sampledir = os.path.join(pardir, "../sampledata")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ["exceldata1.xlsx", "word/stu1_word.docx", "powerpoint/testfile1.pptx"]:
+            shutil.copy(os.path.join(sampledir, name), tmpdir)
+        with open(os.path.join(tmpdir, "broken.docx"), "wb") as f:
+            f.write(b"not an office file")
+        results = util.misc.encrypt_directory(tmpdir, password="abc", flag_delete=True, workers=2)
+        statuses = {os.path.basename(r["file"]): r["status"] for r in results}
+        assert (statuses == {"exceldata1.xlsx": util.misc.STATUS_OK,
+                             "stu1_word.docx": util.misc.STATUS_OK,
+                             "testfile1.pptx": util.misc.STATUS_OK,
+                             "broken.docx": util.misc.STATUS_CORRUPT})
+        assert (sorted(os.listdir(tmpdir)) == ["broken.docx", "exceldata1_enc.xlsx",
+                                               "stu1_word_enc.docx", "testfile1_enc.pptx"])
+        # 暗号化済みのファイルはもう一度暗号化しない
+        result = util.misc.encrypt_file(os.path.join(tmpdir, "exceldata1_enc.xlsx"), password="abc")
+        assert (result["status"] == util.misc.STATUS_ALREADY_ENCRYPTED)
+
+        # パスワードが違うとファイルを作らない
+        results = util.misc.decrypt_directory(tmpdir, password="wrong", workers=2)
+        statuses = {os.path.basename(r["file"]): r["status"] for r in results}
+        assert (statuses["exceldata1_enc.xlsx"] == util.misc.STATUS_WRONG_PASSWORD)
+        assert (statuses["broken.docx"] == util.misc.STATUS_CORRUPT)
+        assert (len(os.listdir(tmpdir)) == 4)
+
+        results = util.misc.decrypt_directory(tmpdir, password="abc", flag_delete=True, workers=2)
+        assert ([r["status"] for r in results].count(util.misc.STATUS_OK) == 3)
+        wb = openpyxl.load_workbook(os.path.join(tmpdir, "exceldata1_enc_dec.xlsx"))
+        assert (wb.sheetnames == ["Sheet1"])
+        result = util.misc.decrypt_file(os.path.join(tmpdir, "exceldata1_enc_dec.xlsx"), password="abc")
+        assert (result["status"] == util.misc.STATUS_NOT_ENCRYPTED)
+        assert (result["output"] is None)
+    finally:
+        shutil.rmtree(tmpdir)
+    print("OK")
+
+
+# ワーカープロセスを使うので、直接実行したときだけ調べる
+if __name__ == "__main__":
+    check_parallel_crypt()
@@ -0,0 +1,95 @@
+import sys
+import os
+import openpyxl
+
+# append import path
+pardir = os.path.dirname(os.path.abspath(__file__))
+utildir = os.path.join(pardir, "../")
+sys.path.append(utildir)
+import util.excelutil
+import util.rubric
+
+
+filename = os.path.join(pardir, "../sampledata/exceldata1.xlsx")
+sheetName = "Sheet1"
+
+wbdata = openpyxl.load_workbook(filename=filename, data_only=True)
+wbmath = openpyxl.load_workbook(filename=filename, data_only=False)
+
+# データだけシート
+sheetData = wbdata[sheetName]
+# 数式のシート
+sheetMath = wbmath[sheetName]
+
+rubric = {
+    "sheet": sheetName,
+    "checks": [
+        {"name": "value", "check": "is_given_value", "addr": "B2", "value": 123},
+        {"name": "formula", "check": "is_formula", "addr": "B5"},
+        {"name": "formulas", "check": "check_num_formulas_in_range", "range_string": "B12:E14"},
+        {"name": "formulas_count", "check": "check_num_formulas_in_range", "range_string": "B12:E14",
+         "result": "count"},
+        {"name": "sum", "check": "check_func_in_range", "range_string": "D21:D28", "func_string": "SUM"},
+        {"name": "absref", "check": "check_comp_abs_ref_in_range", "range_string": "C54:C56",
+         "result": "count"},
+        {"name": ["creator", "modifiedby"], "check": "get_creator_lastmodify"},
+    ]
+}
+
+#######################################
+print("Compile rubric. ルーブリックのコンパイル")
+plan = util.rubric.compile_rubric(rubric)
+assert (plan.ranges == {sheetName: ["B2:E56"]})
+assert (plan.fieldnames == ["value", "formula", "formulas", "formulas_count", "sum", "absref",
+                            "creator", "modifiedby"])
+print("OK")
+
+#######################################
+print("Grade with rubric. ルーブリックで採点する")
+row = plan.grade(filename)
+expected_row = {
+    "value": True,
+    "formula": True,
+    "formulas": 3 / 12,
+    "formulas_count": (12, 3),
+    "sum": 2 / 8,
+    "absref": (3, 2),
+    "creator": "Creator01",
+    "modifiedby": "Editor02",
+}
+assert (row == expected_row)
+# 手で書いたチェックと同じ結果になる
+assert (row["formulas_count"] == util.excelutil.check_num_formulas_in_range(
+    sheetdata=sheetData, sheetmath=sheetMath, range_string="B12:E14"))
+print("OK")
+
+#######################################
+print("Style checks in rubric. ルーブリックでの書式のチェック")
+plan = util.rubric.compile_rubric([
+    {"name": "numfmt", "check": "check_numberformat_in_range", "sheet": sheetName,
+     "range_string": "E60:E67", "number_format": "General", "result": "count"},
+    {"name": "center", "check": "is_aligned_h", "sheet": sheetName, "addr": "C45", "horizontal": "center"},
+])
+assert (plan.grade(filename) == {"numfmt": (8, 1), "center": True})
+print("OK")
+
+#######################################
+print("Whole column in rubric. ルーブリックでの列全体の範囲")
+plan = util.rubric.compile_rubric([
+    {"name": "column", "check": "check_num_formulas_in_range", "sheet": sheetName,
+     "range_string": "E:E", "result": "count"},
+    {"name": "value", "check": "is_given_value", "sheet": sheetName, "addr": "B2", "value": 123},
+])
+assert (plan.ranges == {sheetName: ["B1:E1048576"]})
+assert (plan.grade(filename) == {"column": util.excelutil.check_num_formulas_in_range(
+    sheetdata=sheetData, sheetmath=sheetMath, range_string="E:E"), "value": True})
+print("OK")
+
+#######################################
+print("Unknown check. 存在しないチェック")
+try:
+    util.rubric.compile_rubric([{"name": "x", "check": "no_such_check", "sheet": sheetName, "addr": "A1"}])
+    assert (False)
+except ValueError:
+    pass
+print("OK")
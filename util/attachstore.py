@@ -0,0 +1,448 @@
+"""Content-addressed store of email attachments, extracted with bounded memory.
+
+util.emailutil.get_attached reads the whole message and decodes each attachment at once,
+and attachments with the same name overwrite each other in outdir.
+This module reads a message line by line, decodes base64 and quoted-printable
+parts chunk by chunk, and writes each attachment to a file named by its sha256 hash.
+An index in SQLite maps each message and attachment filename to the hash,
+so identical files submitted many times are stored only once.
+util.emailutil.get_attached はメッセージ全体を読み込んで各添付ファイルを一度に復号し、
+同じ名前の添付ファイルは outdir で上書きされてしまいます。
+このモジュールはメッセージを1行ずつ読み、base64 と quoted-printable のパートを
+少しずつ復号して、各添付ファイルを sha256 ハッシュの名前のファイルに書き込みます。
+SQLite の索引がメッセージと添付ファイル名からハッシュを引けるようにするので、
+何度も提出された同じファイルは1回だけ保存されます。
+
+Example:
+    with util.attachstore.AttachmentStore("attachments") as store:
+        for emlpath in util.misc.iterfiles("submissions", ext=".eml"):
+            store.extract(emlpath)
+        for record in store.attachments(message=str(emlpath)):
+            print(record.filename, store.path_of(record.file_hash))
+"""
+import binascii
+import contextlib
+import email.parser
+import email.policy
+import hashlib
+import io
+import os
+import pathlib
+import re
+import sqlite3
+import tempfile
+import util.mailsource
+
+# 一度に読み書きするバイト数の上限
+CHUNK_SIZE = 64 * 1024
+
+_header_parser = email.parser.BytesHeaderParser(policy=email.policy.default)
+_NOT_BASE64 = re.compile(rb"[^A-Za-z0-9+/=]")
+
+
+class AttachmentRecord:
+    """Attachment in the index of an AttachmentStore.
+
+    Attributes:
+        message (str): message the attachment came from, like the path of the eml file
+        position (int): order of the attachment in the message, from 0
+        filename (str): filename of the attachment
+        content_type (str): content type like "text/plain"
+        file_hash (str): sha256 hex digest of the contents
+        size (int): size of the contents in bytes
+    """
+
+    __slots__ = ("message", "position", "filename", "content_type", "file_hash", "size")
+
+    def __init__(self, message, position, filename, content_type, file_hash, size):
+        self.message = message
+        self.position = position
+        self.filename = filename
+        self.content_type = content_type
+        self.file_hash = file_hash
+        self.size = size
+
+    def __repr__(self):
+        return "<AttachmentRecord {}>".format(
+            ", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class _Lines:
+    # 1行ずつ読む。改行の無い長いデータは CHUNK_SIZE ごとに区切る
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.stream.readline(CHUNK_SIZE)
+        if not line:
+            raise StopIteration
+        return line
+
+
+def _read_headers(lines):
+    block = []
+    for line in lines:
+        if line in (b"\r\n", b"\n"):
+            break
+        block.append(line)
+    return _header_parser.parsebytes(b"".join(block))
+
+
+def _boundary_of(line, boundaries):
+    # 境界の行なら (境界, 終わりかどうか) を返す
+    if not line.startswith(b"--"):
+        return None
+    stripped = line.rstrip(b"\r\n").rstrip(b" \t")
+    for boundary in reversed(boundaries):
+        if stripped == b"--" + boundary:
+            return boundary, False
+        if stripped == b"--" + boundary + b"--":
+            return boundary, True
+    return None
+
+
+class _Base64Decoder:
+    def __init__(self):
+        self.rest = b""
+
+    def decode(self, data):
+        data = self.rest + _NOT_BASE64.sub(b"", data)
+        usable = len(data) - len(data) % 4
+        self.rest = data[usable:]
+        return binascii.a2b_base64(data[:usable]) if usable else b""
+
+    def flush(self):
+        rest, self.rest = self.rest, b""
+        if not rest:
+            return b""
+        # email と同じく、足りないパディングを補って復号する
+        try:
+            return binascii.a2b_base64(rest + b"=" * (-len(rest) % 4))
+        except binascii.Error:
+            return b""
+
+
+class _QuotedPrintableDecoder:
+    def decode(self, data):
+        return binascii.a2b_qp(data)
+
+    def flush(self):
+        return b""
+
+
+class _IdentityDecoder:
+    def decode(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+def _decoder_of(headers):
+    cte = str(headers.get("Content-Transfer-Encoding", "")).strip().lower()
+    if cte == "base64":
+        return _Base64Decoder()
+    if cte == "quoted-printable":
+        return _QuotedPrintableDecoder()
+    return _IdentityDecoder()
+
+
+def iter_attachments(stream, writer):
+    """Walk a message line by line and pass the decoded attachments to writer.
+
+    A part with a filename at any depth of nested multiparts
+    and attached messages (message/rfc822) is an attachment.
+    This differs from util.emailutil.get_attached, which uses EmailMessage.iter_attachments
+    and looks only at the parts directly under the top-level multipart,
+    so attachments of forwarded messages are also found here.
+    If writing or decoding fails, abort() of the sink is called, if it has one.
+    The body of an attachment is decoded line by line and given to the sink made by writer,
+    so only one line is held in memory.
+    メッセージを1行ずつ読み、復号した添付ファイルを writer に渡します。
+    入れ子になったマルチパートや添付されたメッセージ (message/rfc822) のどの深さでも、
+    ファイル名のあるパートを添付ファイルとします。
+    util.emailutil.get_attached は EmailMessage.iter_attachments を使い、
+    最上位のマルチパートの直下のパートだけを調べるので、これとは異なり、
+    転送されたメッセージの添付ファイルも見つけます。
+    書き込みか復号に失敗した場合は、出力先に abort() があれば呼びます。
+    添付ファイルの本文は1行ずつ復号して writer が作る出力先に渡すので、
+    メモリに保持するのは1行だけです。
+
+    Args:
+        stream (binary file object): message
+        writer (callable): called with the part headers (email.message.EmailMessage)
+            and returns an object with write(bytes) and close() methods,
+            and optionally an abort() method.
+
+    Returns:
+        list of object: objects returned by close(), in the order of the attachments
+    """
+    results = []
+    lines = _Lines(stream)
+    headers = _read_headers(lines)
+    _walk(lines, headers, [], writer, results)
+    return results
+
+
+def _walk(lines, headers, boundaries, writer, results):
+    # パートを処理し、終わりの境界の行 (ファイルの終わりなら b"") を返す
+    if headers.get_content_maintype() == "multipart" and headers.get_boundary():
+        boundary = headers.get_boundary().encode("ascii", "replace")
+        inner = boundaries + [boundary]
+        # プリアンブルを読み飛ばす
+        terminator = _skip(lines, inner)
+        while terminator:
+            found, last = _boundary_of(terminator, inner)
+            if found != boundary:
+                return terminator
+            if last:
+                # エピローグを読み飛ばし、外側の境界で終わる
+                return _skip(lines, boundaries)
+            terminator = _walk(lines, _read_headers(lines), inner, writer, results)
+        return b""
+    if headers.get_filename() is None:
+        if headers.get_content_type() == "message/rfc822":
+            # 転送されたメッセージの中も調べる
+            return _walk(lines, _read_headers(lines), boundaries, writer, results)
+        return _skip(lines, boundaries)
+    sink = writer(headers)
+    try:
+        terminator = _copy_part(lines, boundaries, _decoder_of(headers), sink)
+    except BaseException:
+        # 書きかけの出力を残さない
+        if hasattr(sink, "abort"):
+            sink.abort()
+        raise
+    results.append(sink.close())
+    return terminator
+
+
+def _copy_part(lines, boundaries, decoder, sink):
+    previous = None
+    terminator = b""
+    for line in lines:
+        if _boundary_of(line, boundaries) is not None:
+            terminator = line
+            # 境界の前の改行は境界の一部
+            if previous is not None:
+                previous = _strip_newline(previous)
+            break
+        if previous is not None:
+            sink.write(decoder.decode(previous))
+        previous = line
+    if previous is not None:
+        sink.write(decoder.decode(previous))
+    sink.write(decoder.flush())
+    return terminator
+
+
+def _strip_newline(line):
+    if line.endswith(b"\r\n"):
+        return line[:-2]
+    if line.endswith(b"\n"):
+        return line[:-1]
+    return line
+
+
+def _skip(lines, boundaries):
+    for line in lines:
+        if _boundary_of(line, boundaries) is not None:
+            return line
+    return b""
+
+
+class _StoreSink:
+    def __init__(self, store, headers):
+        self.store = store
+        self.filename = headers.get_filename()
+        self.content_type = headers.get_content_type()
+        self.hash = hashlib.sha256()
+        self.size = 0
+        # 中身のハッシュが分かるまで一時ファイルに書き込む
+        self.file = tempfile.NamedTemporaryFile(dir=store.tmpdir, delete=False,
+                                                buffering=CHUNK_SIZE)
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def abort(self):
+        self.file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.file.name)
+
+    def close(self):
+        self.file.close()
+        digest = self.hash.hexdigest()
+        path = self.store.path_of(digest)
+        try:
+            if path.exists():
+                # 同じ中身のファイルは既にあるので書き込まない
+                os.unlink(self.file.name)
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(self.file.name, path)
+        except OSError:
+            self.abort()
+            raise
+        return self.filename, self.content_type, digest, self.size
+
+
+class AttachmentStore:
+    """Attachments stored by the sha256 hash of their contents, with an index.
+
+    The files are stored as objects/<first 2 characters of the hash>/<hash>
+    and the index is index.sqlite3 under rootdir.
+    ファイルは rootdir の下の objects/<ハッシュの最初の2文字>/<ハッシュ> に、
+    索引は index.sqlite3 に保存します。
+
+    Args:
+        rootdir (str | pathlib.Path): directory of the store
+    """
+
+    def __init__(self, rootdir):
+        self.rootdir = pathlib.Path(rootdir).absolute()
+        self.tmpdir = self.rootdir / "tmp"
+        self.tmpdir.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.rootdir / "index.sqlite3"))
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS attachments (
+                message TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                file_hash TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (message, position)
+            );
+            CREATE INDEX IF NOT EXISTS attachments_file_hash ON attachments (file_hash);
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def path_of(self, file_hash):
+        """Returns the path of the stored file of a hash.
+
+        ハッシュの保存したファイルのパスを返します。
+
+        Args:
+            file_hash (str): sha256 hex digest
+
+        Returns:
+            pathlib.Path
+        """
+        return self.rootdir / "objects" / file_hash[:2] / file_hash
+
+    def extract(self, source, message=None):
+        """Store the attachments of a message.
+
+        Records of the message already in the index are replaced.
+        メッセージの添付ファイルを保存します。索引にあるメッセージの記録は置き換えます。
+
+        Args:
+            source (str | pathlib.Path | bytes | binary file object): eml file or message
+            message (str, optional): name of the message in the index.
+                Defaults to None, which means the absolute path of the eml file.
+
+        Returns:
+            list of AttachmentRecord
+        """
+        if isinstance(source, (str, pathlib.Path)):
+            path = os.path.abspath(source)
+            if message is None:
+                message = path
+            with open(path, "rb") as stream:
+                stored = iter_attachments(stream, lambda headers: _StoreSink(self, headers))
+        else:
+            if message is None:
+                raise ValueError("message is required for a message not read from a file")
+            stream = io.BytesIO(source) if isinstance(source, bytes) else source
+            stored = iter_attachments(stream, lambda headers: _StoreSink(self, headers))
+        records = [AttachmentRecord(message, position, filename, content_type, digest, size)
+                   for position, (filename, content_type, digest, size) in enumerate(stored)]
+        self.conn.execute("DELETE FROM attachments WHERE message = ?", (message,))
+        self.conn.executemany(
+            "INSERT INTO attachments VALUES (?, ?, ?, ?, ?, ?)",
+            [(r.message, r.position, r.filename, r.content_type, r.file_hash, r.size)
+             for r in records])
+        self.conn.commit()
+        return records
+
+    def extract_mailbox(self, path):
+        """Store the attachments of all messages of an mbox file or a Maildir directory.
+
+        Each message is named "<path>#<key>" in the index.
+        mbox ファイルか Maildir ディレクトリの全てのメッセージの添付ファイルを保存します。
+        索引では各メッセージを "<path>#<key>" と名付けます。
+
+        Args:
+            path (str | pathlib.Path): mbox file or Maildir directory
+
+        Returns:
+            list of AttachmentRecord
+        """
+        prefix = os.path.abspath(path)
+        records = []
+        for key, data in util.mailsource.iter_raw(path):
+            records.extend(self.extract(data, message="{}#{}".format(prefix, key)))
+        return records
+
+    def attachments(self, message=None, file_hash=None):
+        """Returns the records in the index.
+
+        索引の記録を返します。
+
+        Args:
+            message (str, optional): only the attachments of this message. Defaults to None.
+            file_hash (str, optional): only the attachments with this hash.
+                Defaults to None.
+
+        Returns:
+            list of AttachmentRecord: records sorted by the message and the position
+        """
+        query = "SELECT message, position, filename, content_type, file_hash, size FROM attachments"
+        conditions = []
+        params = []
+        if message is not None:
+            conditions.append("message = ?")
+            params.append(str(message))
+        if file_hash is not None:
+            conditions.append("file_hash = ?")
+            params.append(file_hash)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY message, position"
+        return [AttachmentRecord(*row) for row in self.conn.execute(query, params)]
+
+    def export(self, message, outdir):
+        """Copy the attachments of a message to a directory with their filenames.
+
+        メッセージの添付ファイルを、元のファイル名でディレクトリにコピーします。
+
+        Args:
+            message (str): name of the message in the index
+            outdir (str | pathlib.Path): directory where the files will be saved
+
+        Returns:
+            list of str: list of saved files name
+        """
+        names = []
+        for record in self.attachments(message=message):
+            with self.path_of(record.file_hash).open("rb") as fin, \
+                    open(os.path.join(outdir, record.filename), "wb") as fout:
+                for block in iter(lambda: fin.read(CHUNK_SIZE), b""):
+                    fout.write(block)
+            names.append(record.filename)
+        return names
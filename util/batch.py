@@ -0,0 +1,405 @@
+"""Batch grading of many submissions with worker processes.
+
+Submissions are spread across worker processes.
+Each worker compiles the rubric once and grades the files it is given.
+Result rows are yielded in the order of the files,
+and a file that cannot be graded gives a row with its error
+instead of stopping the batch.
+提出物を複数のワーカープロセスに分配して採点します。
+各ワーカーはルーブリックを1回だけコンパイルし、渡されたファイルを採点します。
+結果の行はファイルの順番で返され、採点できなかったファイルは
+バッチを止めずにエラーを記録した行になります。
+
+Example:
+    rubric = util.rubric.load_rubric("rubric02.json")
+    for row in util.batch.grade_directory("submissions", rubric, workers=4):
+        print(row["file"], row["error"], row["value1"])
+
+With a util.gradecache.GradeCache, unchanged submissions are not graded again.
+util.gradecache.GradeCache を渡すと、変更されていない提出物は再び採点しません。
+
+During the submission window, watch mode grades files as they arrive
+and appends the rows to a CSV file.
+提出期間中は、監視モードで届いたファイルから採点し、結果の行を CSV ファイルに追記できます。
+    python -m util.batch submissions rubric02.json --out results.csv
+"""
+import argparse
+import contextlib
+import csv
+import functools
+import os
+import pathlib
+import time
+import concurrent.futures
+import util.excelutil
+import util.excelutil_exp
+import util.formula
+import util.formulaequiv
+import util.formulaeval
+import util.gradecache
+import util.mailsource
+import util.misc
+import util.rubric
+import util.sheetsnapshot
+import util.styleindex
+import util.xlsxreader
+from logging import getLogger, StreamHandler, DEBUG, INFO
+logger = getLogger(__name__)
+handler = StreamHandler()
+loglevel = INFO
+handler.setLevel(loglevel)
+logger.setLevel(loglevel)
+logger.addHandler(handler)
+logger.propagate = False
+
+# ワーカープロセスごとにコンパイルされたルーブリック
+_plan = None
+# 暗号化された提出ファイルのパスワードと、復号したファイルのキャッシュ
+_password = None
+_decrypted = None
+# 採点する添付ファイルの拡張子
+_ext = None
+
+
+def _init_worker(rubric, password=None):
+    global _plan, _password, _decrypted
+    _plan = util.rubric.compile_rubric(rubric)
+    _password = password
+    _decrypted = util.misc.DecryptedCache() if password is not None else None
+
+
+def _grade_one(filepath):
+    row = {"file": str(filepath), "error": None}
+    try:
+        source = filepath
+        if _password is not None:
+            # 復号したファイルはディスクに書かずにメモリ上で採点する
+            source = util.misc.decrypt_to_buffer(filepath, _password, cache=_decrypted)
+        row.update(_plan.grade(source))
+    except Exception as e:
+        logger.warning("Something is wrong for " + str(filepath))
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+    return row
+
+
+def _init_mailbox_worker(rubric, ext):
+    global _ext
+    _init_worker(rubric)
+    _ext = ext.lower()
+
+
+def _grade_message(eml):
+    # 拡張子の合う添付ファイルを、保存せずにメモリ上で採点する
+    rows = []
+    for attached in eml.get_attachments():
+        if not attached.name.lower().endswith(_ext):
+            continue
+        row = {"file": attached.name, "error": None}
+        try:
+            row.update(_plan.grade(attached))
+        except Exception as e:
+            logger.warning("Something is wrong for " + attached.name)
+            row["error"] = "{}: {}".format(type(e).__name__, e)
+        rows.append(row)
+    return rows
+
+
+def grade_files(filelist, rubric, workers=None, chunksize=4, cache=None, password=None):
+    """Grade files with worker processes.
+
+    Rows are yielded in the order of filelist as soon as they are ready.
+    If workers is 1, the files are graded in this process.
+    If cache is given, rows of unchanged files are taken from the cache
+    and new rows without errors are stored in it.
+    filelist の順番で、採点が終わったものから順に行を返します。
+    workers が 1 の場合はこのプロセスで採点します。
+    cache を与えると、変更されていないファイルの行はキャッシュから取り出し、
+    エラーの無い新しい行をキャッシュに保存します。
+    If password is given, encrypted files are decrypted in memory.
+    password を与えると、暗号化されたファイルをメモリ上で復号します。
+
+    Args:
+        filelist (sequence of str | pathlib.Path): files to grade
+        rubric (dict | list of dict): rubric for util.rubric.compile_rubric
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means os.cpu_count().
+        chunksize (int, optional): number of files sent to a worker at once.
+            Defaults to 4.
+        cache (util.gradecache.GradeCache, optional): cache of result rows.
+            Defaults to None.
+        password (str, optional): password of encrypted files. Defaults to None.
+
+    Yields:
+        dict: result row with "file" and "error" keys
+            "error" is None if the file was graded.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    filelist = list(filelist)
+    if workers <= 1:
+        yield from _grade_cached(filelist, rubric, cache, _local_mapper(rubric, password))
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=_init_worker,
+                                                initargs=(rubric, password)) as executor:
+        # ワーカープロセスは最初にファイルを渡したときに起動する
+        yield from _grade_cached(filelist, rubric, cache,
+                                 functools.partial(executor.map, _grade_one, chunksize=chunksize))
+
+
+def _local_mapper(rubric, password):
+    # このプロセスで採点する。ルーブリックは採点するファイルがあるときに1回だけコンパイルする
+    initialized = []
+
+    def mapper(files):
+        if not initialized:
+            _init_worker(rubric, password)
+            initialized.append(True)
+        return map(_grade_one, files)
+    return mapper
+
+
+def _grade_cached(filelist, rubric, cache, mapper):
+    cached = {}
+    key = None
+    if cache is not None:
+        key = rubric_key(rubric)
+        for i, filepath in enumerate(filelist):
+            row = cache.get(filepath, key)
+            if row is not None:
+                cached[i] = row
+    pending = [filepath for i, filepath in enumerate(filelist) if i not in cached]
+    results = mapper(pending) if pending else iter(())
+    yield from _merge(filelist, cached, results, cache, key)
+
+
+def _merge(filelist, cached, results, cache, key):
+    # キャッシュの行と新しく採点した行をファイルの順番に並べる
+    for i, filepath in enumerate(filelist):
+        if i in cached:
+            row = dict(cached[i])
+            row["file"] = str(filepath)
+            yield row
+            continue
+        row = next(results)
+        if cache is not None and row["error"] is None:
+            cache.put(filepath, key, row)
+        yield row
+
+
+def rubric_key(rubric):
+    """Returns the cache key of a rubric for Excel files.
+
+    Excel ファイル用のルーブリックのキャッシュのキーを返します。
+
+    Args:
+        rubric (dict | list of dict): rubric
+
+    Returns:
+        str: key for util.gradecache.GradeCache
+    """
+    return util.gradecache.rubric_key(
+        rubric, modules=[util.excelutil, util.excelutil_exp, util.formula, util.formulaequiv,
+                         util.formulaeval, util.sheetsnapshot, util.styleindex,
+                         util.xlsxreader, util.rubric])
+
+
+def grade_directory(rootdir, rubric, ext=".xlsx", workers=None, chunksize=4, cache=None,
+                    password=None):
+    """Grade all files in a directory with worker processes.
+
+    Files are listed recursively with util.misc.listfiles and graded in sorted order.
+    ディレクトリ以下のファイルを util.misc.listfiles で再帰的に探し、
+    ソートした順に採点します。
+
+    Args:
+        rootdir (str | pathlib.Path): directory of the submissions
+        rubric (dict | list of dict): rubric for util.rubric.compile_rubric
+        ext (str, optional): file extention to grade.
+            Defaults to ".xlsx".
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means os.cpu_count().
+        chunksize (int, optional): number of files sent to a worker at once.
+            Defaults to 4.
+        cache (util.gradecache.GradeCache, optional): cache of result rows.
+            Defaults to None.
+        password (str, optional): password of encrypted files. Defaults to None.
+
+    Yields:
+        dict: result row with "file" and "error" keys
+    """
+    filelist = sorted(util.misc.listfiles(rootdir, ext=ext))
+    yield from grade_files(filelist, rubric, workers=workers, chunksize=chunksize, cache=cache,
+                           password=password)
+
+
+def grade_mailbox(path, rubric, ext=".xlsx", workers=None):
+    """Grade the attached files of all messages in a mailbox with worker processes.
+
+    The messages of an mbox file or a Maildir directory are read one by one
+    and the attached files are graded in memory without saving them.
+    The "file" of a row is "<mailbox>#<key>/<filename>".
+    A message without an attached file with the extension gives a row with an error.
+    mbox ファイルか Maildir ディレクトリのメッセージを1つずつ読み、
+    添付ファイルを保存せずにメモリ上で採点します。
+    行の "file" は "<mailbox>#<key>/<filename>" です。
+    拡張子の合う添付ファイルが無いメッセージはエラーを記録した行になります。
+
+    Args:
+        path (str | pathlib.Path): mbox file or Maildir directory
+        rubric (dict | list of dict): rubric for util.rubric.compile_rubric
+        ext (str, optional): file extention of the attached files to grade.
+            Defaults to ".xlsx".
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means os.cpu_count().
+
+    Yields:
+        dict: result row with "file" and "error" keys
+    """
+    prefix = os.path.abspath(path)
+    for key, rows in util.mailsource.map_messages(_grade_message, path, workers=workers,
+                                                  initializer=_init_mailbox_worker,
+                                                  initargs=(rubric, ext)):
+        message = "{}#{}".format(prefix, key)
+        if not rows:
+            yield {"file": message, "error": "No {} attachment".format(ext)}
+        for row in rows:
+            row["file"] = "{}/{}".format(message, row["file"])
+            yield row
+
+
+def watch_directory(rootdir, rubric, ext=".xlsx", manifest=None, interval=2.0, settle=2.0,
+                    full_scan_interval=60.0, ignore=("~$*",), workers=None, chunksize=4,
+                    cache=None, password=None, max_cycles=None):
+    """Grade files in a directory as they arrive.
+
+    The directory is polled every interval seconds with util.misc.DirectoryWatcher
+    and only new or changed files are graded.
+    A file is graded after it has not changed for settle seconds.
+    With a util.misc.FileManifest saved in a file,
+    files graded before a restart are not graded again.
+    The worker processes are started once and kept while watching.
+    util.misc.DirectoryWatcher で interval 秒ごとにディレクトリを調べ、
+    新しいファイルと変更されたファイルだけを採点します。
+    ファイルは settle 秒変わらなくなってから採点します。
+    ファイルに保存した util.misc.FileManifest を使うと、
+    再起動する前に採点したファイルは再び採点しません。
+    ワーカープロセスは1回だけ起動し、監視している間使い続けます。
+
+    Example:
+        with util.misc.FileManifest("manifest.sqlite3") as manifest:
+            for row in util.batch.watch_directory("submissions", rubric, manifest=manifest):
+                print(row["file"], row["error"])
+
+    Args:
+        rootdir (str | pathlib.Path): directory of the submissions
+        rubric (dict | list of dict): rubric for util.rubric.compile_rubric
+        ext (str | tuple of str, optional): file extentions to grade.
+            Defaults to ".xlsx".
+        manifest (util.misc.FileManifest, optional): manifest of the graded files.
+            Defaults to None, which means a manifest in memory.
+        interval (float, optional): seconds between polls. Defaults to 2.0.
+        settle (float, optional): seconds for which a file must not change.
+            Defaults to 2.0.
+        full_scan_interval (float, optional): seconds between full scans
+            which find files overwritten in place. Defaults to 60.0.
+        ignore (sequence of str, optional): glob patterns of skipped names or relative paths.
+            Defaults to ("~$*",), the temporary files of Office.
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means os.cpu_count().
+        chunksize (int, optional): number of files sent to a worker at once.
+            Defaults to 4.
+        cache (util.gradecache.GradeCache, optional): cache of result rows.
+            Defaults to None.
+        password (str, optional): password of encrypted files. Defaults to None.
+        max_cycles (int, optional): number of polls before returning.
+            Defaults to None, which means watching forever.
+
+    Yields:
+        dict: result row with "file" and "error" keys
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    watcher = util.misc.DirectoryWatcher(rootdir, ext=ext, ignore=ignore, manifest=manifest,
+                                         settle=settle, full_scan_interval=full_scan_interval)
+    with contextlib.ExitStack() as stack:
+        if workers <= 1:
+            mapper = _local_mapper(rubric, password)
+        else:
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(rubric, password)))
+            mapper = functools.partial(executor.map, _grade_one, chunksize=chunksize)
+        cycle = 0
+        while max_cycles is None or cycle < max_cycles:
+            started = time.monotonic()
+            changed = watcher.poll()
+            if changed:
+                logger.info("Grade {} new or changed files".format(len(changed)))
+                for filepath, row in zip(changed, _grade_cached(changed, rubric, cache, mapper)):
+                    yield row
+                    # 行を渡し終わってから記録するので、途中で止まったファイルは再び採点する
+                    watcher.commit([filepath])
+            watcher.commit()
+            cycle += 1
+            if max_cycles is None or cycle < max_cycles:
+                time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+def append_rows(rows, csvpath, fieldnames):
+    """Append result rows to a CSV file as soon as each row is ready.
+
+    The header is written if the file is new.
+    結果の行を、1行ずつ CSV ファイルに追記します。新しいファイルならヘッダーを書きます。
+
+    Args:
+        rows (iterable of dict): result rows
+        csvpath (str | pathlib.Path): CSV file
+        fieldnames (list of str): columns
+
+    Returns:
+        int: number of appended rows
+    """
+    csvpath = pathlib.Path(csvpath)
+    new = not csvpath.exists() or csvpath.stat().st_size == 0
+    count = 0
+    with csvpath.open("a", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        if new:
+            writer.writeheader()
+            f.flush()
+        for row in rows:
+            writer.writerow(row)
+            f.flush()
+            count += 1
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m util.batch",
+                                     description="Grade submissions as they arrive")
+    parser.add_argument("rootdir")
+    parser.add_argument("rubric", help="rubric JSON file")
+    parser.add_argument("--out", required=True, help="CSV file to which rows are appended")
+    parser.add_argument("--manifest", default=None,
+                        help="SQLite file of the graded files. Defaults to OUT.manifest.sqlite3")
+    parser.add_argument("--ext", default=".xlsx")
+    parser.add_argument("--interval", type=float, default=2.0)
+    parser.add_argument("--settle", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--password", default=None, help="password of encrypted files")
+    args = parser.parse_args(argv)
+    rubric = util.rubric.load_rubric(args.rubric)
+    fieldnames = ["file", "error"] + util.rubric.compile_rubric(rubric).fieldnames
+    manifest_path = args.manifest or args.out + ".manifest.sqlite3"
+    with util.misc.FileManifest(manifest_path) as manifest:
+        rows = watch_directory(args.rootdir, rubric, ext=args.ext, manifest=manifest,
+                               interval=args.interval, settle=args.settle,
+                               workers=args.workers, password=args.password)
+        try:
+            append_rows(rows, args.out, fieldnames)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
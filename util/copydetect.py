@@ -0,0 +1,459 @@
+"""Copy detection of workbooks by formula-structure fingerprints.
+
+Each workbook is turned into a set of features:
+formulas normalized to relative references (R[0]C[-2] style),
+the layout of the cells (type of each cell) and the constants.
+The sets are summarized by MinHash signatures and put into an LSH index,
+so similar workbooks fall into the same buckets
+and only those candidate pairs are compared, instead of every pair.
+The similarity of a pair is the Jaccard index of the feature sets.
+各ブックを特徴の集合に変換します。
+特徴は相対参照 (R[0]C[-2] の形) に正規化した数式、セルの配置 (各セルの型)、定数です。
+特徴の集合を MinHash の署名に要約して LSH のインデックスに入れるので、
+似たブックは同じバケットに入り、全ての組ではなくその候補の組だけを比べます。
+組の類似度は特徴の集合の Jaccard 係数です。
+
+Cells given to every student (the template) make all workbooks look similar.
+Give the template file, or drop the features found in many workbooks with max_df.
+全員に配られたセル (テンプレート) があると全てのブックが似てしまいます。
+テンプレートのファイルを与えるか、max_df で多くのブックにある特徴を除いてください。
+
+Example:
+    result = util.copydetect.find_copies(filelist, template="exceldata3.xlsx")
+    for file1, file2, score in result.pairs:
+        print(file1, file2, score)
+
+The detection can be run from the command line.
+コマンドラインからも実行できます。
+    python -m util.copydetect submissions --template exceldata3.xlsx --threshold 0.6
+"""
+import argparse
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import re
+import sys
+import numpy as np
+import openpyxl
+import util.formula
+import util.misc
+import util.xlsxreader
+from openpyxl.formula.tokenizer import Token
+from logging import getLogger, StreamHandler, DEBUG, INFO
+logger = getLogger(__name__)
+handler = StreamHandler()
+loglevel = INFO
+handler.setLevel(loglevel)
+logger.setLevel(loglevel)
+logger.addHandler(handler)
+logger.propagate = False
+
+_CELL_RE = re.compile(r"(\$?)([A-Za-z]{1,3})(\$?)(\d+)")
+_COLUMN_RE = re.compile(r"(\$?)([A-Za-z]{1,3})")
+_ROW_RE = re.compile(r"(\$?)(\d+)")
+# MinHash に使う 64 bit の定数 (splitmix64)
+_MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def _relative_row(absolute, row, base):
+    return "R{}".format(row) if absolute else "R[{}]".format(row - base)
+
+
+def _relative_column(absolute, column, base):
+    return "C{}".format(column) if absolute else "C[{}]".format(column - base)
+
+
+def _normalize_part(part, row, column):
+    m = _CELL_RE.fullmatch(part)
+    if m:
+        col_abs, letters, row_abs, digits = m.groups()
+        return _relative_row(row_abs, int(digits), row) + _relative_column(
+            col_abs, openpyxl.utils.column_index_from_string(letters.upper()), column)
+    m = _COLUMN_RE.fullmatch(part)
+    if m:
+        return _relative_column(m.group(1), openpyxl.utils.column_index_from_string(m.group(2).upper()),
+                                column)
+    m = _ROW_RE.fullmatch(part)
+    if m:
+        return _relative_row(m.group(1), int(m.group(2)), row)
+    # 名前の定義など
+    return part.upper()
+
+
+def _normalize_reference(ref, row, column):
+    sheet = ""
+    if "!" in ref:
+        sheet, ref = ref.rsplit("!", 1)
+        sheet += "!"
+    return sheet + ":".join(_normalize_part(part, row, column) for part in ref.split(":"))
+
+
+def normalize_formula(text, row, column):
+    """Normalize a formula to relative references.
+
+    References are written relative to the cell of the formula,
+    so the same formula copied to other cells becomes the same string.
+    White-spaces are removed and names are written in upper case.
+    参照を数式のセルからの相対位置で書き直すので、
+    他のセルにコピーした同じ数式は同じ文字列になります。
+    空白は取り除き、名前は大文字にします。
+
+    Args:
+        text (str): formula
+            example: "=SUM(C4:D4)"
+        row (int): row number of the cell of the formula
+        column (int): column number of the cell of the formula
+
+    Returns:
+        str: normalized formula. example: "=SUM(R[0]C[-2]:R[0]C[-1])" for E4
+            If the formula cannot be parsed, the text without white-spaces.
+    """
+    try:
+        tokens = util.formula.parse_formula(text).tokens
+    except ValueError:
+        return "".join(text.split())
+    parts = ["="]
+    for ttype, subtype, value in tokens:
+        if ttype == Token.OPERAND and subtype == Token.RANGE:
+            parts.append(_normalize_reference(value, row, column))
+        elif ttype == Token.OPERAND and subtype == Token.TEXT:
+            parts.append(value)
+        else:
+            parts.append(value.upper())
+    return "".join(parts)
+
+
+def _type_code(value):
+    if isinstance(value, bool):
+        return "b"
+    if isinstance(value, (int, float)):
+        return "n"
+    if isinstance(value, str):
+        return "s"
+    return "o"
+
+
+def sheet_features(sheetdata, sheetmath, range_string=None):
+    """Returns the features of a sheet.
+
+    シートの特徴を返します。
+
+    Args:
+        sheetdata (Worksheet): Worksheet instance of the openpyxl
+            whose book are opened with data_only set to True
+        sheetmath (Worksheet): Worksheet instance of the openpyxl
+            whose book are opened with data_only set to False
+        range_string (str, optional): Excel style cell range.
+            Defaults to None, which means the whole sheet.
+
+    Returns:
+        set of str: features
+            "F|formula"              normalized formula
+            "P|row,column|formula"   normalized formula at the cell
+            "L|row,column|type"      type of the cell ("f" for formulas)
+            "V|row,column|value"     constant at the cell
+    """
+    if range_string is None:
+        min_row, min_col, max_row, max_col = 1, 1, sheetmath.max_row, sheetmath.max_column
+    else:
+        (min_col, min_row, max_col,
+         max_row) = openpyxl.utils.cell.range_boundaries(range_string)
+    features = set()
+    for row, values in enumerate(sheetmath.iter_rows(min_row=min_row, max_row=max_row,
+                                                     min_col=min_col, max_col=max_col,
+                                                     values_only=True), start=min_row):
+        for column, value in enumerate(values, start=min_col):
+            if value is None:
+                continue
+            position = "{},{}".format(row, column)
+            text = util.formula.formula_text(value)
+            if text is not None:
+                normalized = normalize_formula(text, row, column)
+                features.add("F|" + normalized)
+                features.add("P|{}|{}".format(position, normalized))
+                features.add("L|{}|f".format(position))
+            else:
+                features.add("L|{}|{}".format(position, _type_code(value)))
+                features.add("V|{}|{!r}".format(position, value))
+    return features
+
+
+def workbook_features(filename):
+    """Returns the features of all sheets of a workbook.
+
+    ブックの全てのシートの特徴を返します。
+
+    Args:
+        filename (str | pathlib.Path): xlsx file
+
+    Returns:
+        frozenset of str: features, each prefixed with the sheet name
+    """
+    book = util.xlsxreader.load_dual_workbook(filename)
+    features = set()
+    for sheet in book.worksheets:
+        sheetdata, sheetmath = sheet
+        features.update(sheet.title + "!" + feature
+                        for feature in sheet_features(sheetdata, sheetmath))
+    return frozenset(features)
+
+
+def _feature_hashes(features):
+    # 各特徴を 64 bit の整数にする
+    return np.fromiter((int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(),
+                                       "little")
+                        for f in features), dtype=np.uint64, count=len(features))
+
+
+class CopyIndex:
+    """MinHash/LSH index of feature sets.
+
+    A pair of sets becomes a candidate if all rows of any band of their signatures are equal.
+    With the default 32 bands of 4 rows,
+    pairs whose Jaccard index is about 0.4 or more are likely to be candidates.
+    署名のいずれかのバンドの全ての行が等しい組を候補とします。
+    デフォルトの 4 行 32 バンドでは、Jaccard 係数がおよそ 0.4 以上の組が候補になりやすくなります。
+
+    Args:
+        num_perm (int, optional): length of the MinHash signature. Defaults to 128.
+        bands (int, optional): number of LSH bands. num_perm must be divisible by it.
+            Defaults to 32.
+        seed (int, optional): seed of the hash functions. Defaults to 0.
+    """
+
+    def __init__(self, num_perm=128, bands=32, seed=0):
+        if num_perm % bands:
+            raise ValueError("num_perm {} is not divisible by bands {}".format(num_perm, bands))
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.default_rng(seed)
+        self._seeds = rng.integers(0, np.iinfo(np.uint64).max, num_perm, dtype=np.uint64,
+                                   endpoint=True)
+        self.features = {}
+        self.signatures = {}
+        self._buckets = [collections.defaultdict(list) for _ in range(bands)]
+
+    def signature(self, features):
+        """Returns the MinHash signature of a feature set.
+
+        特徴の集合の MinHash の署名を返します。
+
+        Args:
+            features (set of str): features
+
+        Returns:
+            numpy.ndarray: num_perm uint64 values
+        """
+        if not features:
+            return np.full(self.num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+        # 各ハッシュ関数 (splitmix64 の混合関数) で全ての特徴を一度に計算する
+        x = _feature_hashes(features)[np.newaxis, :] ^ self._seeds[:, np.newaxis]
+        x = (x ^ (x >> np.uint64(30))) * _MIX1
+        x = (x ^ (x >> np.uint64(27))) * _MIX2
+        x = x ^ (x >> np.uint64(31))
+        return x.min(axis=1)
+
+    def add(self, key, features):
+        """Add a feature set.
+
+        特徴の集合を追加します。
+
+        Args:
+            key (str): name of the set, usually the file path
+            features (set of str): features
+        """
+        features = frozenset(features)
+        signature = self.signature(features)
+        self.features[key] = features
+        self.signatures[key] = signature
+        for band in range(self.bands):
+            chunk = signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            self._buckets[band][chunk].append(key)
+
+    def candidates(self):
+        """Returns the candidate pairs which share a bucket.
+
+        同じバケットに入った候補の組を返します。
+
+        Returns:
+            set of (key1, key2): pairs in the order of addition
+        """
+        order = {key: i for i, key in enumerate(self.features)}
+        pairs = set()
+        for buckets in self._buckets:
+            for keys in buckets.values():
+                if len(keys) < 2:
+                    continue
+                for i, key1 in enumerate(keys):
+                    for key2 in keys[i + 1:]:
+                        if order[key1] > order[key2]:
+                            key1, key2 = key2, key1
+                        pairs.add((key1, key2))
+        return pairs
+
+    def estimate(self, key1, key2):
+        """Returns the Jaccard index estimated from the signatures.
+
+        署名から推定した Jaccard 係数を返します。
+        """
+        return float(np.mean(self.signatures[key1] == self.signatures[key2]))
+
+    def similarity(self, key1, key2):
+        """Returns the Jaccard index of the feature sets.
+
+        特徴の集合の Jaccard 係数を返します。
+        """
+        a = self.features[key1]
+        b = self.features[key2]
+        if not a and not b:
+            return 0.0
+        return len(a & b) / len(a | b)
+
+    def pairs(self, threshold=0.5):
+        """Returns the similar pairs among the candidates.
+
+        候補の中から似ている組を返します。
+
+        Args:
+            threshold (float, optional): minimum Jaccard index. Defaults to 0.5.
+
+        Returns:
+            list of (key1, key2, score): pairs in the descending order of the score
+        """
+        retlist = []
+        for key1, key2 in self.candidates():
+            score = self.similarity(key1, key2)
+            if score >= threshold:
+                retlist.append((key1, key2, score))
+        retlist.sort(key=lambda pair: (-pair[2], pair[0], pair[1]))
+        return retlist
+
+
+def clusters(pairs):
+    """Group the keys of the pairs into clusters.
+
+    組のキーをクラスタにまとめます。
+
+    Args:
+        pairs (list of (key1, key2, score)): similar pairs
+
+    Returns:
+        list of list of str: clusters of two or more keys, larger ones first
+    """
+    parent = {}
+
+    def find(key):
+        parent.setdefault(key, key)
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    for key1, key2, _ in pairs:
+        root1 = find(key1)
+        root2 = find(key2)
+        if root1 != root2:
+            parent[root2] = root1
+    groups = collections.defaultdict(list)
+    for key in parent:
+        groups[find(key)].append(key)
+    return sorted((sorted(group) for group in groups.values()), key=lambda group: (-len(group), group))
+
+
+class CopyResult:
+    """Result of find_copies.
+
+    Attributes:
+        pairs (list of (file1, file2, score)): similar pairs
+        clusters (list of list of str): clusters of similar files
+        index (CopyIndex): index of all files
+        errors (dict): file to error message of files which cannot be read
+    """
+
+    def __init__(self, pairs, clusters, index, errors):
+        self.pairs = pairs
+        self.clusters = clusters
+        self.index = index
+        self.errors = errors
+
+
+def _features_or_error(filepath):
+    try:
+        return workbook_features(filepath), None
+    except Exception as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+
+def find_copies(filelist, threshold=0.5, template=None, max_df=None, workers=None,
+                num_perm=128, bands=32, seed=0):
+    """Find similar workbooks.
+
+    似ているブックを探します。
+
+    Args:
+        filelist (list of str | pathlib.Path): xlsx files
+        threshold (float, optional): minimum Jaccard index of a pair. Defaults to 0.5.
+        template (str | pathlib.Path, optional): file given to the students.
+            Its features are removed from all files. Defaults to None.
+        max_df (float, optional): remove the features found in more than
+            this fraction of the files. Defaults to None, which removes nothing.
+        workers (int, optional): number of worker processes to read the files.
+            Defaults to None, which means the number of CPUs. 1 means no worker process.
+        num_perm, bands, seed: passed to CopyIndex
+
+    Returns:
+        CopyResult
+    """
+    filelist = [str(filepath) for filepath in filelist]
+    if workers is not None and workers <= 1:
+        featurelist = [_features_or_error(filepath) for filepath in filelist]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            featurelist = list(executor.map(_features_or_error, filelist, chunksize=4))
+    errors = {}
+    features = {}
+    for filepath, (fileset, error) in zip(filelist, featurelist):
+        if error is not None:
+            logger.warning("Something is wrong for " + filepath)
+            errors[filepath] = error
+        else:
+            features[filepath] = fileset
+    removed = set()
+    if template is not None:
+        removed |= workbook_features(template)
+    if max_df is not None and features:
+        counts = collections.Counter(f for fileset in features.values() for f in fileset)
+        limit = max_df * len(features)
+        removed |= {f for f, count in counts.items() if count > limit}
+    index = CopyIndex(num_perm=num_perm, bands=bands, seed=seed)
+    for filepath, fileset in features.items():
+        index.add(filepath, fileset - removed)
+    pairs = index.pairs(threshold)
+    return CopyResult(pairs, clusters(pairs), index, errors)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m util.copydetect",
+                                     description="Find similar workbooks")
+    parser.add_argument("rootdir")
+    parser.add_argument("--ext", default=".xlsx")
+    parser.add_argument("--template", default=None, help="file given to the students")
+    parser.add_argument("--threshold", type=float, default=0.5)
+    parser.add_argument("--max-df", type=float, default=None,
+                        help="remove features found in more than this fraction of the files")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+    filelist = sorted(util.misc.listfiles(args.rootdir, args.ext))
+    result = find_copies(filelist, threshold=args.threshold, template=args.template,
+                         max_df=args.max_df, workers=args.workers)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["file1", "file2", "score"])
+    for file1, file2, score in result.pairs:
+        writer.writerow([file1, file2, "{:.3f}".format(score)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,540 @@
+"""Comparison of Word documents without Word.
+
+util.wordutil.create_word_diff needs Windows and Word.
+This module compares docx files with python-docx on any platform.
+The teacher document is parsed once into a DocumentIndex,
+whose paragraphs are hashed by their text and by their style and runs.
+Each student document is aligned with it paragraph by paragraph
+with difflib.SequenceMatcher over the hashes,
+and changed paragraphs are compared character by character.
+The result is written as an HTML report and as a docx with revisions (w:ins and w:del),
+which Word shows like the result of Compare Documents.
+Students are compared in worker processes.
+util.wordutil.create_word_diff は Windows と Word が必要です。
+このモジュールはどのプラットフォームでも python-docx で docx ファイルを比較します。
+先生の文書を1回だけ解析して DocumentIndex を作り、段落をテキストと、スタイルとランでハッシュします。
+各学生の文書をハッシュの列に対する difflib.SequenceMatcher で段落ごとに対応させ、
+変更された段落は文字ごとに比較します。
+結果は HTML のレポートと、変更履歴 (w:ins と w:del) 付きの docx に書き出します。
+Word では「文書の比較」の結果と同じように表示されます。
+学生の文書はワーカープロセスで比較します。
+
+Example:
+    rows = util.docxdiff.compare_files("teacher_word.docx", student_filelist, workers=4)
+    for row in rows:
+        print(row["file"], row["similarity"], row["html"])
+
+The comparison can be run from the command line.
+コマンドラインからも実行できます。
+    python -m util.docxdiff teacher_word.docx submissions --outdir reports
+"""
+import argparse
+import concurrent.futures
+import csv
+import datetime
+import difflib
+import hashlib
+import html
+import os
+import pathlib
+import sys
+import docx
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+import util.misc
+from logging import getLogger, StreamHandler, DEBUG, INFO
+logger = getLogger(__name__)
+handler = StreamHandler()
+loglevel = INFO
+handler.setLevel(loglevel)
+logger.setLevel(loglevel)
+logger.addHandler(handler)
+logger.propagate = False
+
+REVISION_AUTHOR = "grading_comp_lite"
+
+FIELDNAMES = ["file", "similarity", "inserted", "deleted", "format_changed", "html", "docx", "error"]
+
+
+def _digest(*parts):
+    # プロセスをまたいでも同じ値になるように hashlib を使う
+    h = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        h.update(repr(part).encode("utf-8"))
+        h.update(b"\x00")
+    return int.from_bytes(h.digest(), "little")
+
+
+def _run_format(run):
+    return (bool(run.bold), bool(run.italic), bool(run.underline), bool(run.font.strike))
+
+
+class Paragraph:
+    """Paragraph of a DocumentIndex.
+
+    Adjacent runs with the same format are merged,
+    because Word splits runs at arbitrary places while editing.
+    Word は編集中に任意の位置でランを分割するので、同じ書式の隣り合うランは結合します。
+
+    Attributes:
+        style (str | None): paragraph style name
+        text (str): text of the paragraph
+        runs (tuple of (str, tuple)): merged runs as (text, (bold, italic, underline, strike))
+        key (int): hash of the text
+        run_key (int): hash of the style and the merged runs
+    """
+
+    __slots__ = ("style", "text", "runs", "key", "run_key")
+
+    def __init__(self, style, text, runs):
+        self.style = style
+        self.text = text
+        self.runs = runs
+        self.key = _digest(text)
+        self.run_key = _digest(style, runs)
+
+    @classmethod
+    def from_docx(cls, paragraph):
+        runs = []
+        for run in paragraph.runs:
+            if not run.text:
+                continue
+            fmt = _run_format(run)
+            if runs and runs[-1][1] == fmt:
+                runs[-1] = (runs[-1][0] + run.text, fmt)
+            else:
+                runs.append((run.text, fmt))
+        style = paragraph.style.name if paragraph.style is not None else None
+        return cls(style, paragraph.text, tuple(runs))
+
+
+class DocumentIndex:
+    """Paragraphs of a docx file with their hashes.
+
+    Paragraphs in tables are included in the order of the document.
+    表の中の段落も文書の順番に含めます。
+
+    Args:
+        paragraphs (list of Paragraph): paragraphs
+    """
+
+    def __init__(self, paragraphs):
+        self.paragraphs = list(paragraphs)
+        self.keys = [p.key for p in self.paragraphs]
+
+    @classmethod
+    def from_file(cls, filename):
+        """Parse a docx file.
+
+        docx ファイルを解析します。
+
+        Args:
+            filename (str | pathlib.Path | file-like object): docx file
+
+        Returns:
+            DocumentIndex
+        """
+        if isinstance(filename, pathlib.Path):
+            filename = str(filename)
+        document = docx.Document(filename)
+        return cls(Paragraph.from_docx(p) for p in _iter_paragraphs(document))
+
+
+def _iter_paragraphs(parent):
+    # 本文と表のセルの段落を文書の順番に返す
+    for item in parent.iter_inner_content():
+        if isinstance(item, docx.table.Table):
+            for row in item.rows:
+                for cell in row.cells:
+                    yield from _iter_paragraphs(cell)
+        else:
+            yield item
+
+
+class DiffOp:
+    """Difference of a block of paragraphs.
+
+    Attributes:
+        tag (str): "equal", "insert", "delete", "replace" or "format"
+            "format" means the same text with a different style or different run formats.
+        original (list of Paragraph): paragraphs of the original document
+        revised (list of Paragraph): paragraphs of the revised document
+        segments (list of (str, str)): for a replaced single paragraph,
+            the character diff as ("equal" | "insert" | "delete", text)
+    """
+
+    __slots__ = ("tag", "original", "revised", "segments")
+
+    def __init__(self, tag, original, revised, segments=None):
+        self.tag = tag
+        self.original = original
+        self.revised = revised
+        self.segments = segments
+
+    def __repr__(self):
+        return "<DiffOp {} {} {}>".format(self.tag, len(self.original), len(self.revised))
+
+
+class DocumentDiff:
+    """Result of comparing two documents.
+
+    Attributes:
+        ops (list of DiffOp): differences in the order of the documents
+        similarity (float): similarity of the texts from 0.0 to 1.0
+        inserted (int): number of inserted characters
+        deleted (int): number of deleted characters
+        format_changed (int): number of paragraphs with only style or format changes
+    """
+
+    def __init__(self, ops):
+        self.ops = ops
+        self.inserted = 0
+        self.deleted = 0
+        self.format_changed = 0
+        equal = 0
+        for op in ops:
+            if op.tag == "equal":
+                equal += sum(len(p.text) for p in op.original)
+            elif op.tag == "format":
+                equal += sum(len(p.text) for p in op.original)
+                self.format_changed += len(op.original)
+            elif op.segments is not None:
+                for tag, text in op.segments:
+                    if tag == "equal":
+                        equal += len(text)
+                    elif tag == "insert":
+                        self.inserted += len(text)
+                    else:
+                        self.deleted += len(text)
+            else:
+                self.deleted += sum(len(p.text) for p in op.original)
+                self.inserted += sum(len(p.text) for p in op.revised)
+        total = 2 * equal + self.inserted + self.deleted
+        self.similarity = 2 * equal / total if total else 1.0
+
+
+def _char_segments(original, revised):
+    matcher = difflib.SequenceMatcher(None, original, revised, autojunk=False)
+    segments = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ("delete", "replace"):
+            segments.append(("delete", original[i1:i2]))
+        if tag in ("insert", "replace"):
+            segments.append(("insert", revised[j1:j2]))
+        if tag == "equal":
+            segments.append(("equal", original[i1:i2]))
+    return segments
+
+
+def diff_documents(original, revised):
+    """Compare two documents paragraph by paragraph.
+
+    Replaced blocks with the same number of paragraphs are compared
+    character by character for each pair of paragraphs.
+    2つの文書を段落ごとに比較します。
+    段落の数が同じ置き換えは、段落の組ごとに文字単位で比較します。
+
+    Args:
+        original (DocumentIndex): original document, like the teacher document
+        revised (DocumentIndex): revised document, like a student document
+
+    Returns:
+        DocumentDiff
+    """
+    matcher = difflib.SequenceMatcher(None, original.keys, revised.keys, autojunk=False)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        olds = original.paragraphs[i1:i2]
+        news = revised.paragraphs[j1:j2]
+        if tag == "equal":
+            # テキストが同じでもスタイルやランの書式が変わった段落を分ける
+            for old, new in zip(olds, news):
+                op_tag = "equal" if old.run_key == new.run_key else "format"
+                if ops and ops[-1].tag == op_tag:
+                    ops[-1].original.append(old)
+                    ops[-1].revised.append(new)
+                else:
+                    ops.append(DiffOp(op_tag, [old], [new]))
+        elif tag == "replace" and len(olds) == len(news):
+            for old, new in zip(olds, news):
+                ops.append(DiffOp("replace", [old], [new], _char_segments(old.text, new.text)))
+        else:
+            ops.append(DiffOp(tag, olds, news))
+    return DocumentDiff(ops)
+
+
+def write_html(result, filename, title=""):
+    """Write the differences as an HTML report.
+
+    差分を HTML のレポートとして書き出します。
+
+    Args:
+        result (DocumentDiff): differences
+        filename (str | pathlib.Path): HTML file
+        title (str, optional): title of the report. Defaults to "".
+    """
+    lines = [
+        "<!DOCTYPE html>",
+        '<html><head><meta charset="utf-8"><title>{}</title>'.format(html.escape(title)),
+        "<style>ins{background:#cfc;text-decoration:none}del{background:#fcc}"
+        "p.format{border-left:4px solid #fc6;padding-left:4px}</style></head><body>",
+        "<h1>{}</h1>".format(html.escape(title)),
+        "<p>similarity {:.3f}, inserted {}, deleted {}, format changed {}</p>".format(
+            result.similarity, result.inserted, result.deleted, result.format_changed),
+    ]
+    for op in result.ops:
+        if op.tag == "equal":
+            lines.extend("<p>{}</p>".format(html.escape(p.text)) for p in op.revised)
+        elif op.tag == "format":
+            lines.extend('<p class="format">{}</p>'.format(html.escape(p.text)) for p in op.revised)
+        elif op.segments is not None:
+            parts = []
+            for tag, text in op.segments:
+                text = html.escape(text)
+                parts.append(text if tag == "equal" else
+                             "<ins>{}</ins>".format(text) if tag == "insert" else
+                             "<del>{}</del>".format(text))
+            lines.append("<p>{}</p>".format("".join(parts)))
+        else:
+            lines.extend("<p><del>{}</del></p>".format(html.escape(p.text)) for p in op.original)
+            lines.extend("<p><ins>{}</ins></p>".format(html.escape(p.text)) for p in op.revised)
+    lines.append("</body></html>")
+    pathlib.Path(filename).write_text("\n".join(lines), encoding="utf-8")
+
+
+class _RevisionWriter:
+    # w:ins と w:del の変更履歴付きの段落を書く
+    def __init__(self, document, author, date):
+        self.document = document
+        self.author = author
+        self.date = date
+        self.next_id = 1
+
+    def _revision(self, tag):
+        element = OxmlElement(tag)
+        element.set(qn("w:id"), str(self.next_id))
+        element.set(qn("w:author"), self.author)
+        element.set(qn("w:date"), self.date)
+        self.next_id += 1
+        return element
+
+    def _run(self, text, fmt=None, deleted=False):
+        run = OxmlElement("w:r")
+        if fmt is not None and any(fmt):
+            rpr = OxmlElement("w:rPr")
+            for flag, tag in zip(fmt, ("w:b", "w:i", "w:u", "w:strike")):
+                if flag:
+                    element = OxmlElement(tag)
+                    if tag == "w:u":
+                        element.set(qn("w:val"), "single")
+                    rpr.append(element)
+            run.append(rpr)
+        t = OxmlElement("w:delText" if deleted else "w:t")
+        t.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
+        t.text = text
+        run.append(t)
+        return run
+
+    def paragraph(self, style):
+        paragraph = self.document.add_paragraph()
+        if style is not None:
+            try:
+                paragraph.style = style
+            except KeyError:
+                pass
+        return paragraph._p
+
+    def runs(self, p, runs):
+        for text, fmt in runs:
+            p.append(self._run(text, fmt))
+
+    def inserted(self, p, runs):
+        ins = self._revision("w:ins")
+        for text, fmt in runs:
+            ins.append(self._run(text, fmt))
+        p.append(ins)
+
+    def deleted(self, p, runs):
+        dele = self._revision("w:del")
+        for text, fmt in runs:
+            dele.append(self._run(text, fmt, deleted=True))
+        p.append(dele)
+
+    def mark_paragraph(self, p, tag):
+        # 段落記号そのものを挿入・削除として記録する
+        ppr = p.get_or_add_pPr()
+        rpr = ppr.find(qn("w:rPr"))
+        if rpr is None:
+            rpr = OxmlElement("w:rPr")
+            ppr.append(rpr)
+        rpr.append(self._revision(tag))
+
+
+def write_docx(result, filename, author=REVISION_AUTHOR, template=None):
+    """Write the revised document as a docx with revisions against the original.
+
+    Word shows the insertions and deletions as tracked changes.
+    元の文書に対する変更履歴付きの docx として、変更後の文書を書き出します。
+    Word では挿入と削除が変更履歴として表示されます。
+
+    Args:
+        result (DocumentDiff): differences
+        filename (str | pathlib.Path): docx file
+        author (str, optional): author of the revisions. Defaults to REVISION_AUTHOR.
+        template (str | pathlib.Path, optional): docx whose styles are used, like the original.
+            Defaults to None.
+    """
+    document = docx.Document(str(template) if template is not None else None)
+    body = document.element.body
+    # テンプレートの本文は削除し、セクションの設定だけを残す
+    for child in list(body):
+        if child.tag != qn("w:sectPr"):
+            body.remove(child)
+    date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    writer = _RevisionWriter(document, author, date)
+    for op in result.ops:
+        if op.tag in ("equal", "format"):
+            for p in op.revised:
+                writer.runs(writer.paragraph(p.style), p.runs)
+        elif op.segments is not None:
+            p = writer.paragraph(op.revised[0].style)
+            for tag, text in op.segments:
+                if tag == "equal":
+                    writer.runs(p, [(text, None)])
+                elif tag == "insert":
+                    writer.inserted(p, [(text, None)])
+                else:
+                    writer.deleted(p, [(text, None)])
+        else:
+            for old in op.original:
+                p = writer.paragraph(old.style)
+                writer.deleted(p, old.runs)
+                writer.mark_paragraph(p, "w:del")
+            for new in op.revised:
+                p = writer.paragraph(new.style)
+                writer.inserted(p, new.runs)
+                writer.mark_paragraph(p, "w:ins")
+    document.save(str(filename))
+
+
+# ワーカープロセスごとの元の文書
+_original = None
+_template = None
+
+
+def _init_worker(original, template):
+    global _original, _template
+    _original = original
+    _template = template
+
+
+def _report_bases(students, outdir):
+    # outdir に同じ名前のファイルのレポートが上書きされないよう、
+    # 学生のファイルに共通のディレクトリからの相対パスを "_" でつないだ名前にする
+    if outdir is None:
+        return [str(student) for student in students]
+    paths = [os.path.abspath(str(student)) for student in students]
+    try:
+        root = os.path.commonpath([os.path.dirname(path) for path in paths]) if paths else None
+    except ValueError:
+        # Windows で別のドライブにある場合
+        root = None
+    bases = []
+    for path in paths:
+        parts = pathlib.Path(os.path.relpath(path, root) if root else path).parts
+        if not root:
+            parts = parts[1:]
+        bases.append(str(pathlib.Path(outdir) / "_".join(parts)))
+    return bases
+
+
+def _compare_one(student, base, html_report, docx_report):
+    student = pathlib.Path(student)
+    row = {"file": str(student), "similarity": None, "inserted": None, "deleted": None,
+           "format_changed": None, "html": None, "docx": None, "error": None}
+    try:
+        result = diff_documents(_original, DocumentIndex.from_file(student))
+        row.update(similarity=result.similarity, inserted=result.inserted,
+                   deleted=result.deleted, format_changed=result.format_changed)
+        if html_report:
+            row["html"] = base + "_cmp.html"
+            write_html(result, row["html"], title=student.name)
+        if docx_report:
+            row["docx"] = base + "_cmp.docx"
+            write_docx(result, row["docx"], template=_template)
+    except Exception as e:
+        logger.warning("Something is wrong for " + str(student))
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+    return row
+
+
+def compare_files(original_doc_path, students_filelist, outdir=None, html_report=True,
+                  docx_report=True, workers=None):
+    """Compare student documents with the original document in worker processes.
+
+    The original document is parsed only once.
+    Reports are saved as "<student file>_cmp.html" and "<student file>_cmp.docx",
+    next to the student files or in outdir.
+    In outdir, the path of a student file from the common directory of the student files
+    is joined with "_", so "s1/a.docx" and "s2/a.docx" have the reports "s1_a.docx_cmp.html"
+    and "s2_a.docx_cmp.html".
+    学生の文書を元の文書とワーカープロセスで比較します。元の文書は1回だけ解析します。
+    レポートは学生のファイルと同じディレクトリか outdir に
+    「<学生のファイル>_cmp.html」「<学生のファイル>_cmp.docx」として保存します。
+    outdir では、学生のファイルに共通のディレクトリからのパスを "_" でつなぐので、
+    「s1/a.docx」「s2/a.docx」のレポートは「s1_a.docx_cmp.html」「s2_a.docx_cmp.html」になります。
+
+    Args:
+        original_doc_path (str | pathlib.Path): original document, like the teacher document
+        students_filelist (list of str | pathlib.Path): documents submitted by students
+        outdir (str | pathlib.Path, optional): directory of the reports.
+            Defaults to None, which means the directory of each student file.
+        html_report (bool, optional): write the HTML reports. Defaults to True.
+        docx_report (bool, optional): write the docx with revisions. Defaults to True.
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means os.cpu_count().
+
+    Returns:
+        list of dict: rows in the order of students_filelist with "file", "similarity",
+            "inserted", "deleted", "format_changed", "html", "docx" and "error" keys
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    original = DocumentIndex.from_file(original_doc_path)
+    template = str(original_doc_path)
+    args = [(student, base, html_report, docx_report)
+            for student, base in zip(students_filelist, _report_bases(students_filelist, outdir))]
+    if workers <= 1:
+        _init_worker(original, template)
+        return [_compare_one(*arg) for arg in args]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=_init_worker,
+                                                initargs=(original, template)) as executor:
+        return list(executor.map(_compare_one, *zip(*args)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m util.docxdiff",
+                                     description="Differences of docx files from the original")
+    parser.add_argument("original")
+    parser.add_argument("rootdir")
+    parser.add_argument("--outdir", default=None)
+    parser.add_argument("--no-html", action="store_true")
+    parser.add_argument("--no-docx", action="store_true")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+    original = pathlib.Path(args.original).resolve()
+    # 元の文書と、以前に作ったレポートは除く
+    filelist = sorted(p for p in util.misc.iterfiles(args.rootdir, ext=".docx", ignore=["~$*", "*_cmp.docx"])
+                      if p.resolve() != original)
+    if args.outdir is not None:
+        pathlib.Path(args.outdir).mkdir(parents=True, exist_ok=True)
+    rows = compare_files(original, filelist, outdir=args.outdir, html_report=not args.no_html,
+                         docx_report=not args.no_docx, workers=args.workers)
+    writer = csv.DictWriter(sys.stdout, fieldnames=FIELDNAMES)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
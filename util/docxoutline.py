@@ -0,0 +1,638 @@
+"""Streaming outline of Word documents for grading.
+
+Word assignments are graded by their headings, paragraphs, tables, images,
+page setup and tracked changes.
+python-docx builds the whole object tree of the document for this.
+This module reads word/document.xml with ElementTree.iterparse in one pass,
+removing each paragraph and table after it is read,
+and keeps only a compact DocumentOutline.
+The styles, numbering and comments parts are small and are read as a whole.
+Word の課題は、見出し、段落、表、画像、ページ設定、変更履歴で採点します。
+python-docx はそのために文書全体のオブジェクトを作ります。
+このモジュールは word/document.xml を ElementTree.iterparse で1回だけ読み、
+読み終わった段落と表はすぐに削除して、小さな DocumentOutline だけを残します。
+スタイル、段落番号、コメントのパーツは小さいのでまとめて読みます。
+
+Example:
+    outline = util.docxoutline.read_outline("stu1_word.docx")
+    outline.heading_texts(level=1)           # ["章タイトル1", "章タイトル2"]
+    outline.contains_paragraph("本文11。")   # True
+    outline.sections[0].orientation          # "portrait"
+    outline.revisions["insertions"]          # number of w:ins
+
+Many files can be scanned into rows, like util.docprops.
+util.docprops と同じように、多数のファイルを行のリストにできます。
+    rows = util.docxoutline.scan_directory("submissions")
+
+The scan can be run from the command line.
+コマンドラインからも実行できます。
+    python -m util.docxoutline submissions
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import hashlib
+import posixpath
+import re
+import sys
+import zipfile
+import xml.etree.ElementTree as ET
+import msoffcrypto.exceptions
+import util.misc
+
+FIELDNAMES = ["file", "paragraphs", "empty_paragraphs", "headings", "tables", "images",
+              "sections", "page_width", "page_height", "orientation",
+              "insertions", "deletions", "moves", "format_changes", "comments", "error"]
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+_WP = "{http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing}"
+_V = "{urn:schemas-microsoft-com:vml}"
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_OFFICE_DOCUMENT_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+
+# 変更履歴の要素と、数える項目
+REVISION_TAGS = {
+    _W + "ins": "insertions",
+    _W + "del": "deletions",
+    _W + "moveFrom": "moves",
+    _W + "rPrChange": "format_changes",
+    _W + "pPrChange": "format_changes",
+    _W + "sectPrChange": "format_changes",
+    _W + "tblPrChange": "format_changes",
+    _W + "trPrChange": "format_changes",
+    _W + "tcPrChange": "format_changes",
+}
+
+_HEADING_NAME = re.compile(r"^(?:heading|見出し)\s*(\d)$", re.IGNORECASE)
+
+
+def text_hash(text):
+    """Returns the hash of a paragraph text used in DocumentOutline.
+
+    DocumentOutline で使う段落のテキストのハッシュを返します。
+
+    Args:
+        text (str): text of a paragraph
+
+    Returns:
+        str: hex digest
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class _Record:
+    # __slots__ の名前をキーワード引数で受け取る小さなレコード
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class Heading(_Record):
+    """Heading of a DocumentOutline.
+
+    Attributes:
+        level (int): outline level from 1
+        text (str): text of the heading
+        style (str | None): paragraph style name
+        paragraph (int): index of the paragraph, from 0
+        numbering (str | None): number format like "decimal", or None if not numbered
+    """
+
+    __slots__ = ("level", "text", "style", "paragraph", "numbering")
+
+
+class TableShape(_Record):
+    """Table of a DocumentOutline.
+
+    Attributes:
+        rows (int): number of rows
+        columns (int): largest number of grid columns in a row, counting merged cells
+        depth (int): 0 for a table in the body, 1 for a table in a cell, and so on
+        paragraph (int): index of the first paragraph after the start of the table
+    """
+
+    __slots__ = ("rows", "columns", "depth", "paragraph")
+
+
+class ImageRef(_Record):
+    """Image of a DocumentOutline.
+
+    Attributes:
+        rid (str): relationship id
+        target (str | None): part name like "word/media/image1.png",
+            or the URL of a linked image
+        width (int | None): width in EMU (914400 per inch)
+        height (int | None): height in EMU
+        name (str | None): name of the drawing
+    """
+
+    __slots__ = ("rid", "target", "width", "height", "name")
+
+
+class Section(_Record):
+    """Page setup of a section.
+
+    Lengths are in twips (1440 per inch, 567 per cm).
+    長さの単位は twip (1インチ 1440、1cm 約 567) です。
+
+    Attributes:
+        page_width (int | None): width of the page
+        page_height (int | None): height of the page
+        orientation (str): "portrait" or "landscape"
+        margins (dict): "top", "bottom", "left", "right", "header", "footer" and "gutter"
+        columns (int): number of text columns
+        start (str): section start like "nextPage" or "continuous"
+    """
+
+    __slots__ = ("page_width", "page_height", "orientation", "margins", "columns", "start")
+
+
+class DocumentOutline:
+    """Compact outline of a docx file.
+
+    Attributes:
+        file (str): docx file
+        paragraph_hashes (list of str): text_hash of each paragraph in the order of the document,
+            including paragraphs in tables and text boxes
+        empty_paragraphs (int): number of paragraphs without text
+        headings (list of Heading): headings
+        tables (list of TableShape): tables in the order of their end
+        images (list of ImageRef): images
+        sections (list of Section): sections. The last one is the section of the document end.
+        styles (dict): paragraph style name to the number of paragraphs
+        numbering (dict): number format (like "bullet" or "decimal") to the number of paragraphs
+        revisions (dict): "insertions", "deletions", "moves" and "format_changes" to counts
+        revision_authors (list of str): authors of the revisions
+        comments (int): number of comments
+        comment_authors (list of str): authors of the comments
+    """
+
+    def __init__(self, file):
+        self.file = str(file)
+        self.paragraph_hashes = []
+        self.empty_paragraphs = 0
+        self.headings = []
+        self.tables = []
+        self.images = []
+        self.sections = []
+        self.styles = {}
+        self.numbering = {}
+        self.revisions = dict.fromkeys(("insertions", "deletions", "moves", "format_changes"), 0)
+        self.revision_authors = []
+        self.comments = 0
+        self.comment_authors = []
+
+    @property
+    def paragraph_count(self):
+        return len(self.paragraph_hashes)
+
+    @property
+    def has_revisions(self):
+        return any(self.revisions.values())
+
+    def heading_texts(self, level=None):
+        """Returns the texts of the headings.
+
+        見出しのテキストを返します。
+
+        Args:
+            level (int, optional): outline level. Defaults to None, which means all levels.
+
+        Returns:
+            list of str
+        """
+        return [h.text for h in self.headings if level is None or h.level == level]
+
+    def contains_paragraph(self, text):
+        """Returns True if a paragraph has exactly the text.
+
+        テキストが完全に一致する段落があれば True を返します。
+
+        Args:
+            text (str): text of a paragraph
+
+        Returns:
+            bool
+        """
+        return text_hash(text) in self.paragraph_hashes
+
+    def row(self):
+        """Returns the summary as a row with the keys in FIELDNAMES.
+
+        概要を FIELDNAMES のキーを持つ行として返します。
+        """
+        last = self.sections[-1] if self.sections else Section()
+        row = {
+            "file": self.file,
+            "paragraphs": self.paragraph_count,
+            "empty_paragraphs": self.empty_paragraphs,
+            "headings": len(self.headings),
+            "tables": len(self.tables),
+            "images": len(self.images),
+            "sections": len(self.sections),
+            "page_width": last.page_width,
+            "page_height": last.page_height,
+            "orientation": last.orientation,
+            "comments": self.comments,
+            "error": None,
+        }
+        row.update(self.revisions)
+        return row
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _val(element, tag):
+    child = element.find(tag) if element is not None else None
+    return child.get(_W + "val") if child is not None else None
+
+
+def _read_rels(archive, part):
+    # パーツのリレーションシップ id をパーツ名 (外部リンクは URL) とタイプの組にする
+    rels_name = posixpath.join(posixpath.dirname(part), "_rels", posixpath.basename(part) + ".rels")
+    try:
+        root = ET.fromstring(archive.read(rels_name))
+    except KeyError:
+        return {}
+    rels = {}
+    for rel in root.iter(_REL_NS + "Relationship"):
+        target = rel.get("Target", "")
+        if rel.get("TargetMode") != "External":
+            if target.startswith("/"):
+                target = target.lstrip("/")
+            else:
+                target = posixpath.join(posixpath.dirname(part), target)
+            target = posixpath.normpath(target)
+        rels[rel.get("Id")] = (target, rel.get("Type", ""))
+    return rels
+
+
+def _main_part(archive):
+    for target, reltype in _read_rels(archive, "").values():
+        if reltype == _OFFICE_DOCUMENT_REL:
+            return target
+    return "word/document.xml"
+
+
+def _part_of_type(rels, suffix):
+    for target, reltype in rels.values():
+        if reltype.endswith("/" + suffix):
+            return target
+    return None
+
+
+class _Styles:
+    # styles.xml の段落スタイルから名前、見出しのレベル、段落番号を求める
+    def __init__(self, data):
+        self.names = {}
+        self.based_on = {}
+        self.outline = {}
+        self.numbered = {}
+        self.default = None
+        if data is None:
+            return
+        for style in ET.fromstring(data).iter(_W + "style"):
+            if style.get(_W + "type") != "paragraph":
+                continue
+            style_id = style.get(_W + "styleId")
+            self.names[style_id] = _val(style, _W + "name")
+            self.based_on[style_id] = _val(style, _W + "basedOn")
+            ppr = style.find(_W + "pPr")
+            self.outline[style_id] = _int(_val(ppr, _W + "outlineLvl"))
+            numpr = ppr.find(_W + "numPr") if ppr is not None else None
+            if numpr is not None:
+                self.numbered[style_id] = (_val(numpr, _W + "numId"), _val(numpr, _W + "ilvl") or "0")
+            if style.get(_W + "default") in ("1", "true"):
+                self.default = style_id
+        self._levels = {}
+
+    def _chain(self, style_id):
+        seen = set()
+        while style_id is not None and style_id not in seen:
+            seen.add(style_id)
+            yield style_id
+            style_id = self.based_on.get(style_id)
+
+    def level(self, style_id):
+        if style_id not in self._levels:
+            self._levels[style_id] = self._level(style_id)
+        return self._levels[style_id]
+
+    def _level(self, style_id):
+        for sid in self._chain(style_id):
+            if self.outline.get(sid) is not None:
+                lvl = self.outline[sid]
+                return lvl + 1 if lvl < 9 else None
+            match = _HEADING_NAME.match(self.names.get(sid) or "")
+            if match:
+                return int(match.group(1))
+        return None
+
+    def numpr(self, style_id):
+        for sid in self._chain(style_id):
+            if sid in self.numbered:
+                return self.numbered[sid]
+        return None
+
+
+class _Numbering:
+    # numbering.xml の numId と段落番号のレベルから番号の書式を求める
+    def __init__(self, data):
+        self.abstract_of = {}
+        self.formats = {}
+        if data is None:
+            return
+        root = ET.fromstring(data)
+        for abstract in root.iter(_W + "abstractNum"):
+            abstract_id = abstract.get(_W + "abstractNumId")
+            for lvl in abstract.iter(_W + "lvl"):
+                self.formats[(abstract_id, lvl.get(_W + "ilvl"))] = _val(lvl, _W + "numFmt")
+        for num in root.iter(_W + "num"):
+            self.abstract_of[num.get(_W + "numId")] = _val(num, _W + "abstractNumId")
+
+    def format(self, num_id, ilvl):
+        if num_id is None or num_id == "0":
+            return None
+        return self.formats.get((self.abstract_of.get(num_id), ilvl or "0"), "none")
+
+
+def _read_optional(archive, name):
+    if name is None:
+        return None
+    try:
+        return archive.read(name)
+    except KeyError:
+        return None
+
+
+def _section(sectpr):
+    pgsz = sectpr.find(_W + "pgSz")
+    pgmar = sectpr.find(_W + "pgMar")
+    cols = sectpr.find(_W + "cols")
+    margins = {}
+    if pgmar is not None:
+        for key in ("top", "bottom", "left", "right", "header", "footer", "gutter"):
+            margins[key] = _int(pgmar.get(_W + key))
+    width = _int(pgsz.get(_W + "w")) if pgsz is not None else None
+    height = _int(pgsz.get(_W + "h")) if pgsz is not None else None
+    orientation = pgsz.get(_W + "orient") if pgsz is not None else None
+    if orientation is None:
+        orientation = "landscape" if width and height and width > height else "portrait"
+    return Section(page_width=width, page_height=height, orientation=orientation, margins=margins,
+                   columns=(_int(cols.get(_W + "num")) or 1) if cols is not None else 1,
+                   start=_val(sectpr, _W + "type") or "nextPage")
+
+
+class _Paragraph:
+    __slots__ = ("parts", "style", "outline", "numpr")
+
+    def __init__(self):
+        self.parts = []
+        self.style = None
+        self.outline = None
+        self.numpr = None
+
+
+def _read_document(outline, stream, rels, styles, numbering):
+    elements = []
+    paragraphs = []
+    tables = []
+    authors = set()
+    fallback = 0
+    for event, elem in ET.iterparse(stream, events=("start", "end")):
+        tag = elem.tag
+        if event == "start":
+            elements.append(elem)
+            if tag == _MC_FALLBACK:
+                # mc:AlternateContent の代替表示は同じ内容なので数えない
+                fallback += 1
+            elif fallback:
+                pass
+            elif tag == _W + "p":
+                paragraphs.append(_Paragraph())
+            elif tag == _W + "tbl":
+                tables.append([0, 0, len(outline.paragraph_hashes)])
+            elif tag in REVISION_TAGS:
+                outline.revisions[REVISION_TAGS[tag]] += 1
+                if elem.get(_W + "author"):
+                    authors.add(elem.get(_W + "author"))
+            continue
+
+        elements.pop()
+        parent = elements[-1] if elements else None
+        parent_tag = parent.tag if parent is not None else None
+        if tag == _MC_FALLBACK:
+            fallback -= 1
+        elif fallback:
+            pass
+        elif tag == _W + "t":
+            if paragraphs:
+                paragraphs[-1].parts.append(elem.text or "")
+        elif tag in (_W + "tab", _W + "br", _W + "cr") and parent_tag == _W + "r":
+            if paragraphs:
+                paragraphs[-1].parts.append("\t" if tag == _W + "tab" else "\n")
+        elif (parent_tag == _W + "pPr" and paragraphs and len(elements) > 1
+              and elements[-2].tag == _W + "p"):
+            paragraph = paragraphs[-1]
+            if tag == _W + "pStyle":
+                paragraph.style = elem.get(_W + "val")
+            elif tag == _W + "outlineLvl":
+                paragraph.outline = _int(elem.get(_W + "val"))
+            elif tag == _W + "numPr":
+                paragraph.numpr = (_val(elem, _W + "numId"), _val(elem, _W + "ilvl") or "0")
+            elif tag == _W + "sectPr":
+                outline.sections.append(_section(elem))
+        elif tag == _W + "sectPr" and parent_tag == _W + "body":
+            outline.sections.append(_section(elem))
+        elif tag == _W + "p":
+            _end_paragraph(outline, paragraphs.pop(), styles, numbering)
+        elif tag == _W + "tr":
+            if tables:
+                columns = sum(_int(_val(tc.find(_W + "tcPr"), _W + "gridSpan")) or 1
+                              for tc in elem.findall(_W + "tc"))
+                tables[-1][0] += 1
+                tables[-1][1] = max(tables[-1][1], columns)
+            elem.clear()
+        elif tag == _W + "tbl":
+            rows, columns, first = tables.pop()
+            outline.tables.append(TableShape(rows=rows, columns=columns, depth=len(tables),
+                                             paragraph=first))
+        elif tag == _W + "drawing":
+            _drawing(outline, elem, rels)
+        elif tag == _V + "imagedata":
+            rid = elem.get(_R + "id")
+            if rid is not None:
+                outline.images.append(ImageRef(rid=rid, target=rels.get(rid, (None,))[0]))
+        if tag == _W + "p":
+            elem.clear()
+        # 本文の直下の要素は読み終わったら削除してメモリを一定に保つ
+        if parent_tag == _W + "body":
+            parent.remove(elem)
+    outline.revision_authors = sorted(authors)
+
+
+def _drawing(outline, drawing, rels):
+    for frame in list(drawing):
+        extent = frame.find(_WP + "extent")
+        docpr = frame.find(_WP + "docPr")
+        for blip in frame.iter(_A + "blip"):
+            rid = blip.get(_R + "embed") or blip.get(_R + "link")
+            if rid is None:
+                continue
+            outline.images.append(ImageRef(
+                rid=rid, target=rels.get(rid, (None,))[0],
+                width=_int(extent.get("cx")) if extent is not None else None,
+                height=_int(extent.get("cy")) if extent is not None else None,
+                name=docpr.get("name") if docpr is not None else None))
+
+
+def _end_paragraph(outline, paragraph, styles, numbering):
+    text = "".join(paragraph.parts)
+    index = len(outline.paragraph_hashes)
+    outline.paragraph_hashes.append(text_hash(text))
+    if not text.strip():
+        outline.empty_paragraphs += 1
+    style_id = paragraph.style or styles.default
+    name = styles.names.get(style_id, style_id)
+    outline.styles[name] = outline.styles.get(name, 0) + 1
+    numpr = paragraph.numpr or styles.numpr(style_id)
+    fmt = numbering.format(*numpr) if numpr is not None else None
+    if fmt is not None:
+        outline.numbering[fmt] = outline.numbering.get(fmt, 0) + 1
+    if paragraph.outline is not None:
+        level = paragraph.outline + 1 if paragraph.outline < 9 else None
+    else:
+        level = styles.level(style_id)
+    if level is not None:
+        outline.headings.append(Heading(level=level, text=text, style=name, paragraph=index,
+                                        numbering=fmt))
+
+
+def _read_comments(outline, data):
+    if data is None:
+        return
+    authors = set()
+    for comment in ET.fromstring(data).iter(_W + "comment"):
+        outline.comments += 1
+        if comment.get(_W + "author"):
+            authors.add(comment.get(_W + "author"))
+    outline.comment_authors = sorted(authors)
+
+
+def read_outline(filepath, password=None):
+    """Read the outline of a docx file in one pass.
+
+    docx ファイルの概要を1回の読み込みで求めます。
+
+    Args:
+        filepath (str | pathlib.Path): docx file
+        password (str, optional): password of encrypted files. Defaults to None.
+
+    Returns:
+        DocumentOutline
+
+    Raises:
+        OSError, zipfile.BadZipFile, xml.etree.ElementTree.ParseError:
+            if the file cannot be read as a docx file
+    """
+    outline = DocumentOutline(filepath)
+    with contextlib.ExitStack() as stack:
+        source = filepath
+        # パスワードがあり zip でなければ、暗号化されたパッケージとして必要な部分だけ復号する
+        if password is not None and not zipfile.is_zipfile(filepath):
+            source = stack.enter_context(util.misc.DecryptingReader(filepath, password))
+        archive = stack.enter_context(zipfile.ZipFile(source))
+        main = _main_part(archive)
+        rels = _read_rels(archive, main)
+        styles = _Styles(_read_optional(archive, _part_of_type(rels, "styles")))
+        numbering = _Numbering(_read_optional(archive, _part_of_type(rels, "numbering")))
+        _read_comments(outline, _read_optional(archive, _part_of_type(rels, "comments")))
+        with archive.open(main) as stream:
+            _read_document(outline, stream, rels, styles, numbering)
+    return outline
+
+
+def _read_row(filepath, password=None):
+    try:
+        return read_outline(filepath, password=password).row()
+    except (OSError, KeyError, zipfile.BadZipFile, ET.ParseError,
+            msoffcrypto.exceptions.DecryptionError, msoffcrypto.exceptions.FileFormatError) as e:
+        row = dict.fromkeys(FIELDNAMES)
+        row["file"] = str(filepath)
+        row["error"] = "{}: {}".format(type(e).__name__, e)
+        return row
+
+
+def scan_files(filelist, workers=None, password=None):
+    """Read the outlines of many docx files as rows with a process pool.
+
+    プロセスプールで多数の docx ファイルの概要を行として読みます。
+
+    Args:
+        filelist (list of str | pathlib.Path): docx files
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means os.cpu_count().
+        password (str, optional): password of encrypted files. Defaults to None.
+
+    Returns:
+        list of dict: rows with the keys in FIELDNAMES in the order of filelist
+    """
+    read = functools.partial(_read_row, password=password)
+    if workers == 1:
+        return [read(f) for f in filelist]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read, filelist, chunksize=4))
+
+
+def scan_directory(rootdir, ext=".docx", workers=None, password=None):
+    """Read the outlines of the docx files under a directory as rows.
+
+    ディレクトリ以下の docx ファイルの概要を行として読みます。
+
+    Args:
+        rootdir (str | pathlib.Path): directory, searched recursively
+        ext (str | tuple of str, optional): file extensions. Defaults to ".docx".
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means os.cpu_count().
+        password (str, optional): password of encrypted files. Defaults to None.
+
+    Returns:
+        list of dict: rows sorted by the file path
+    """
+    # Office が作る一時ファイル (~$ で始まる) は除く
+    filelist = sorted(util.misc.iterfiles(rootdir, ext=ext, ignore=["~$*"]))
+    return scan_files(filelist, workers=workers, password=password)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m util.docxoutline",
+                                     description="Outline of docx files")
+    parser.add_argument("rootdir")
+    parser.add_argument("--ext", default=".docx")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--password", default=None, help="password of encrypted files")
+    args = parser.parse_args(argv)
+    rows = scan_directory(args.rootdir, ext=args.ext, workers=args.workers, password=args.password)
+    writer = csv.DictWriter(sys.stdout, fieldnames=FIELDNAMES)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""Bulk scan of email headers.
+
+Grading email assignments mostly checks From, To, Cc and Subject.
+This module reads only the header block of each .eml file
+(up to the first blank line), so large attachments are not read,
+and stores the headers of many messages in a HeaderTable, column by column.
+Rules like "To contains teacher@example.com" are evaluated over a whole column at once,
+and each rule gives a result column.
+電子メールの課題の採点では、主に From、To、Cc、Subject を調べます。
+このモジュールは各 .eml ファイルのヘッダー部分 (最初の空行まで) だけを読むので、
+大きな添付ファイルは読みません。多数のメッセージのヘッダーを列ごとに HeaderTable に保存します。
+「To に teacher@example.com を含む」のようなルールは列全体に対してまとめて評価し、
+ルールごとに結果の列を作ります。
+
+Example:
+    table = util.emailscan.scan_directory("submissions", ["From", "To", "Cc", "Subject"])
+    results = util.emailscan.evaluate_rules(table, [
+        {"name": "recipient", "header": "To", "op": "contains", "value": "teacher@example.com"},
+        {"name": "TA", "header": "Cc", "op": "contains", "value": "teaching_assistant@example.com"},
+    ])
+    rows = table.rows(results)
+
+The scan can be run from the command line. Rules are read from a JSON file.
+コマンドラインからも実行できます。ルールは JSON ファイルから読みます。
+    python -m util.emailscan submissions --rules rules.json
+"""
+import argparse
+import concurrent.futures
+import csv
+import email.parser
+import email.policy
+import json
+import pathlib
+import re
+import sys
+import numpy as np
+import util.misc
+
+DEFAULT_KEYS = ("From", "To", "Cc", "Subject")
+
+# ヘッダー部分として読む最大のバイト数
+MAX_HEADER_BYTES = 1024 * 1024
+
+_parser = email.parser.BytesHeaderParser(policy=email.policy.default)
+
+
+def read_header_block(emlpath, max_bytes=MAX_HEADER_BYTES):
+    """Read the header block of an eml file.
+
+    The file is read line by line up to the first blank line.
+    eml ファイルを最初の空行まで1行ずつ読みます。
+
+    Args:
+        emlpath (str | pathlib.Path): path for the .eml file
+        max_bytes (int, optional): maximum size of the header block.
+            Defaults to MAX_HEADER_BYTES.
+
+    Returns:
+        bytes: header block without the blank line
+    """
+    lines = []
+    size = 0
+    with pathlib.Path(emlpath).open("rb") as f:
+        for line in f:
+            if line in (b"\r\n", b"\n"):
+                break
+            lines.append(line)
+            size += len(line)
+            if size >= max_bytes:
+                break
+    return b"".join(lines)
+
+
+def read_headers(emlpath, keys=DEFAULT_KEYS):
+    """Read header values of an eml file without parsing the body.
+
+    本文を解析せずに eml ファイルのヘッダーの値を読みます。
+
+    Args:
+        emlpath (str | pathlib.Path): path for the .eml file
+        keys (sequence of str, optional): keys for the header.
+            Defaults to DEFAULT_KEYS.
+
+    Returns:
+        dictionary: data with the given keys.
+            Encoded words are decoded like util.emailutil.get_header.
+            If no data exists for the key, the value is None.
+    """
+    msg = _parser.parsebytes(read_header_block(emlpath))
+    values = {}
+    for key in keys:
+        value = msg[key]
+        values[key] = str(value) if value is not None else None
+    return values
+
+
+class HeaderTable:
+    """Header values of many messages, stored column by column.
+
+    Attributes:
+        files (list of str): eml files
+        keys (list of str): header keys
+        columns (dict): key to numpy.ndarray of str. A missing header is "".
+        present (dict): key to numpy.ndarray of bool. True if the header exists.
+        errors (list of str | None): error message if the file could not be read
+    """
+
+    def __init__(self, files, keys, values, errors):
+        self.files = [str(f) for f in files]
+        self.keys = list(keys)
+        self.columns = {}
+        self.present = {}
+        for key in self.keys:
+            column = [row.get(key) for row in values]
+            self.present[key] = np.array([v is not None for v in column], dtype=bool)
+            self.columns[key] = np.array([v if v is not None else "" for v in column], dtype=str)
+        self.errors = list(errors)
+
+    def __len__(self):
+        return len(self.files)
+
+    def rows(self, results=None):
+        """Returns the table as rows.
+
+        表を行のリストとして返します。
+
+        Args:
+            results (dict, optional): result columns made by evaluate_rules. Defaults to None.
+
+        Returns:
+            list of dict: rows with "file", the header keys, the rule names and "error"
+        """
+        results = results or {}
+        retlist = []
+        for i, filename in enumerate(self.files):
+            row = {"file": filename}
+            for key in self.keys:
+                row[key] = str(self.columns[key][i]) if self.present[key][i] else None
+            for name, column in results.items():
+                row[name] = bool(column[i])
+            row["error"] = self.errors[i]
+            retlist.append(row)
+        return retlist
+
+
+def _read_row(emlpath, keys):
+    try:
+        return read_headers(emlpath, keys), None
+    except OSError as e:
+        return {}, "{}: {}".format(type(e).__name__, e)
+
+
+def scan_files(filelist, keys=DEFAULT_KEYS, workers=8):
+    """Read the headers of many eml files into a HeaderTable with a thread pool.
+
+    スレッドプールで多数の eml ファイルのヘッダーを HeaderTable に読み込みます。
+
+    Args:
+        filelist (list of str | pathlib.Path): eml files
+        keys (sequence of str, optional): keys for the header. Defaults to DEFAULT_KEYS.
+        workers (int, optional): number of threads. Defaults to 8.
+
+    Returns:
+        HeaderTable: rows in the order of filelist
+    """
+    filelist = list(filelist)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        read = list(executor.map(lambda path: _read_row(path, keys), filelist))
+    return HeaderTable(filelist, keys, [values for values, _ in read],
+                       [error for _, error in read])
+
+
+def scan_directory(rootdir, keys=DEFAULT_KEYS, ext=".eml", workers=8):
+    """Read the headers of the eml files under a directory into a HeaderTable.
+
+    ディレクトリ以下の eml ファイルのヘッダーを HeaderTable に読み込みます。
+
+    Args:
+        rootdir (str | pathlib.Path): directory, searched recursively
+        keys (sequence of str, optional): keys for the header. Defaults to DEFAULT_KEYS.
+        ext (str | tuple of str, optional): file extentions. Defaults to ".eml".
+        workers (int, optional): number of threads. Defaults to 8.
+
+    Returns:
+        HeaderTable: rows sorted by the file path
+    """
+    filelist = sorted(util.misc.iterfiles(rootdir, ext=ext))
+    return scan_files(filelist, keys=keys, workers=workers)
+
+
+def _regex(values, pattern, flags):
+    compiled = re.compile(pattern, flags)
+    return np.array([compiled.search(v) is not None for v in values], dtype=bool)
+
+
+RULE_OPS = {
+    "contains": lambda values, value: np.char.find(values, value) >= 0,
+    "equals": lambda values, value: values == value,
+    "startswith": np.char.startswith,
+    "endswith": np.char.endswith,
+}
+
+
+def evaluate_rules(table, rules):
+    """Evaluate rules over the columns of a HeaderTable.
+
+    Each rule is evaluated once for each distinct value of the column.
+    Rules are dicts with these keys.
+        name (str): name of the result column
+        header (str): header key
+        op (str): "contains", "equals", "startswith", "endswith", "regex" or "exists"
+        value (str): value compared with. Not used by "exists".
+        ignore_case (bool, optional): compare ignoring case. Defaults to True.
+        negate (bool, optional): invert the result. Defaults to False.
+    A missing header does not satisfy any op except "exists".
+    HeaderTable の列に対してルールを評価します。
+    各ルールは列の異なる値ごとに1回だけ評価します。
+    ヘッダーが無い場合は "exists" 以外の条件を満たしません。
+
+    Args:
+        table (HeaderTable): header table
+        rules (list of dict): rules
+
+    Returns:
+        dict: rule name to numpy.ndarray of bool
+
+    Raises:
+        ValueError: if a rule has an unknown op or header
+    """
+    results = {}
+    # 列ごとに異なる値とその位置を1回だけ求める
+    uniques = {}
+    for rule in rules:
+        header = rule["header"]
+        op = rule["op"]
+        if header not in table.columns:
+            raise ValueError("Header {} is not in the table".format(header))
+        present = table.present[header]
+        if op == "exists":
+            result = present.copy()
+        else:
+            if header not in uniques:
+                uniques[header] = np.unique(table.columns[header], return_inverse=True)
+            values, inverse = uniques[header]
+            ignore_case = rule.get("ignore_case", True)
+            value = rule["value"]
+            if op == "regex":
+                matched = _regex(values, value, re.IGNORECASE if ignore_case else 0)
+            elif op in RULE_OPS:
+                if ignore_case:
+                    values = np.char.lower(values)
+                    value = value.lower()
+                matched = RULE_OPS[op](values, value)
+            else:
+                raise ValueError("Rule op {} is not supported".format(op))
+            result = matched[inverse] & present
+        if rule.get("negate", False):
+            result = ~result
+        results[rule["name"]] = result
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m util.emailscan",
+                                     description="Headers of eml files")
+    parser.add_argument("rootdir")
+    parser.add_argument("--keys", nargs="+", default=list(DEFAULT_KEYS))
+    parser.add_argument("--rules", default=None, help="JSON file of a list of rules")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args(argv)
+    table = scan_directory(args.rootdir, keys=args.keys, workers=args.workers)
+    results = {}
+    if args.rules:
+        with open(args.rules, "r", encoding="utf-8") as f:
+            results = evaluate_rules(table, json.load(f))
+    writer = csv.DictWriter(sys.stdout, fieldnames=["file"] + table.keys + list(results) + ["error"])
+    writer.writeheader()
+    writer.writerows(table.rows(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import email
 import email.policy
+import functools
+import io
 import os
 import pathlib
 from logging import getLogger, StreamHandler, DEBUG, INFO
@@ -14,6 +16,234 @@ logger.propagate = False
 # reference https://qiita.com/amedama/items/b856b2f30c2f38665701
 # https://docs.python.org/ja/3/howto/logging.html
 
+# 解析したメッセージを保持する数
+PARSED_CACHE_SIZE = 64
+
+
+class AttachedFile(io.BufferedIOBase):
+    """Attached file of a message as a read-only file object in memory.
+
+    The payload is decoded when the file is read for the first time.
+    The file object can be given to openpyxl.load_workbook, docx.Document,
+    pptx.Presentation and util.xlsxreader.load_dual_workbook without saving it.
+    添付ファイルをメモリ上の読み取り専用のファイルオブジェクトとして扱います。
+    中身は最初に読まれたときに復号します。
+    保存せずに openpyxl.load_workbook、docx.Document、pptx.Presentation、
+    util.xlsxreader.load_dual_workbook にそのまま渡せます。
+
+    Attributes:
+        name (str): filename of the attachment
+        content_type (str): content type like "text/plain"
+    """
+
+    def __init__(self, part):
+        super().__init__()
+        self._part = part
+        self._buffer = None
+        self.name = part.get_filename()
+        self.content_type = part.get_content_type()
+
+    def __repr__(self):
+        return "<AttachedFile name={!r} content_type={!r}>".format(self.name, self.content_type)
+
+    def _data(self):
+        if self._buffer is None:
+            self._buffer = io.BytesIO(self._part.get_payload(decode=True) or b"")
+        return self._buffer
+
+    @property
+    def size(self):
+        """int: size of the decoded contents in bytes"""
+        return len(self._data().getbuffer())
+
+    def getvalue(self):
+        """Returns the decoded contents.
+
+        復号した中身を返します。
+
+        Returns:
+            bytes
+        """
+        return self._data().getvalue()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._data().read(size)
+
+    def read1(self, size=-1):
+        return self._data().read1(size)
+
+    def readinto(self, b):
+        return self._data().readinto(b)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._data().seek(offset, whence)
+
+    def tell(self):
+        return self._data().tell()
+
+
+class ParsedEml:
+    """Email message parsed once.
+
+    get_header, get_messagebody and get_attached of the same file
+    read the same parsed message.
+    同じファイルの get_header、get_messagebody、get_attached は
+    同じ解析済みのメッセージを使います。
+
+    Example:
+        eml = util.emailutil.parse_eml("assignment1.eml")
+        headerdata = eml.get_header(["From", "To", "Cc", "Subject"])
+        messagedata = eml.get_messagebody()
+
+    Args:
+        msg (email.message.EmailMessage): parsed message
+        path (pathlib.Path, optional): path for the .eml file. Defaults to None.
+    """
+
+    def __init__(self, msg, path=None):
+        self.msg = msg
+        self.path = path
+
+    @classmethod
+    def from_bytes(cls, data, path=None):
+        """Parse a message.
+
+        メッセージを解析します。
+
+        Args:
+            data (bytes): contents of the .eml file
+            path (pathlib.Path, optional): path for the .eml file. Defaults to None.
+
+        Returns:
+            ParsedEml
+        """
+        return cls(email.message_from_bytes(data, policy=email.policy.default), path)
+
+    def get_header(self, keys):
+        """Get email header data like 'To', 'Subject'.
+
+        電子メールのヘッダーデータを取得します。
+
+        Args:
+            keys (sequence of str): keys for the header
+                example : ['To', 'Cc', 'From', 'Subject']
+
+        Returns:
+            dictionary: data with the given keys
+                if no data exists for the key,
+                  a dictionary with None value for the key is returned
+        """
+        tmpdic = {}
+        for key in keys:
+            tmpdic[key] = self.msg[key]
+        return tmpdic
+
+    def get_messagebody(self):
+        """Get email message body.
+
+        電子メールの本文を取得します。
+
+        Returns:
+            str: message body
+        """
+        part = self.msg.get_body(preferencelist=("plain", "html"))
+        charset = str(part.get_content_charset())
+        return part.get_payload(decode=True).decode(charset, errors="strict")
+
+    def get_attachments(self):
+        """Get all attached files as file objects in memory.
+
+        全ての添付ファイルをメモリ上のファイルオブジェクトとして取得します。
+
+        Example:
+            for attached in util.emailutil.parse_eml(emlpath).get_attachments():
+                if attached.name.endswith(".xlsx"):
+                    wb = openpyxl.load_workbook(attached)
+
+        Returns:
+            list of AttachedFile: attached files with filenames
+        """
+        return [AttachedFile(part) for part in self.msg.iter_attachments()
+                if part.get_filename() is not None]
+
+    def get_attached(self, outdir=None):
+        """Save all attached files.
+
+        If outdir is None, the files are saved in the same directory as the eml file.
+        全ての添付ファイルを保存します。
+        outdir が None の場合、添付ファイルは eml ファイルと同じディレクトリに保存されます。
+
+        Args:
+            outdir (str | pathlib.Path, optional): directory where the files will be saved
+                Defaults to None.
+
+        Returns:
+            list of str: list of saved files name
+
+        Raises:
+            ValueError: if outdir is None and the message is not read from a file
+        """
+        if outdir is None:
+            if self.path is None:
+                raise ValueError("outdir is required for a message not read from a file")
+            outdir = self.path.parent
+        at_filenamelist = []
+        for part in self.msg.iter_attachments():
+            if part.get_filename() is not None:
+                at_filename = part.get_filename()
+                at_filenamelist.append(at_filename)
+                #
+                charset = part.get_content_charset(failobj="")
+                logger.debug("attached filename={}".format(at_filename))
+                logger.debug("charset={}".format(charset))
+                #
+                outfilename = os.path.join(outdir, at_filename)
+                with open(outfilename, "bw") as fout:
+                    fout.write(part.get_payload(decode=True))
+        return at_filenamelist
+
+
+@functools.lru_cache(maxsize=PARSED_CACHE_SIZE)
+def _parse_file(path, size, mtime_ns):
+    # サイズと更新日時もキーに含めるので、変更されたファイルは解析し直す
+    filepath = pathlib.Path(path)
+    with filepath.open("rb") as email_file:
+        return ParsedEml.from_bytes(email_file.read(), filepath)
+
+
+def parse_eml(emlpath):
+    """Parse an eml file once.
+
+    The result is cached by the path, the size and the mtime of the file.
+    The cache keeps the last PARSED_CACHE_SIZE messages.
+    eml ファイルを1回だけ解析します。
+    結果はファイルのパス、サイズ、更新日時をキーにキャッシュされます。
+    キャッシュは最後に使った PARSED_CACHE_SIZE 個のメッセージを保持します。
+
+    Args:
+        emlpath (str | pathlib.Path): path for the .eml file
+
+    Returns:
+        ParsedEml
+    """
+    filepath = pathlib.Path(emlpath).absolute()
+    st = filepath.stat()
+    return _parse_file(str(filepath), st.st_size, st.st_mtime_ns)
+
+
+def clear_cache():
+    """Remove all parsed messages from the cache.
+
+    キャッシュした解析済みのメッセージを全て削除します。
+    """
+    _parse_file.cache_clear()
+
 
 def get_header(emlpath, keys):
     """Get email header data like 'To', 'Subject' from eml file
@@ -32,14 +262,7 @@ def get_header(emlpath, keys):
             if no data exists for the key,
               a dictionary with None value for the key is returned
     """
-    filepath = pathlib.Path(emlpath)
-    tmpdic = {}
-    with filepath.open("rb") as email_file:
-        msg = email.message_from_bytes(
-            email_file.read(), policy=email.policy.default)
-        for key in keys:
-            tmpdic[key] = msg[key]
-    return tmpdic
+    return parse_eml(emlpath).get_header(keys)
 
 
 def get_messagebody(emlpath):
@@ -55,15 +278,7 @@ def get_messagebody(emlpath):
     Returns:
         str: message body
     """
-    filepath = pathlib.Path(emlpath)
-    with filepath.open("rb") as email_file:
-        msg = email.message_from_bytes(
-            email_file.read(), policy=email.policy.default)
-        part = msg.get_body(preferencelist=("plain", "html"))
-        charset = str(part.get_content_charset())
-        retstr = part.get_payload(
-            decode=True).decode(charset, errors="strict")
-    return retstr
+    return parse_eml(emlpath).get_messagebody()
 
 
 def get_attached(emlpath, outdir=None):
@@ -83,24 +298,20 @@ def get_attached(emlpath, outdir=None):
     Returns:
         list of str: list of saved files name
     """
+    return parse_eml(emlpath).get_attached(outdir)
 
-    filepath = pathlib.Path(emlpath)
-    if outdir is None:
-        outdir = filepath.parent
-    at_filenamelist = []
-    with filepath.open("rb") as email_file:
-        msg = email.message_from_bytes(
-            email_file.read(), policy=email.policy.default)
-        for part in msg.iter_attachments():
-            if part.get_filename() is not None:
-                at_filename = part.get_filename()
-                at_filenamelist.append(at_filename)
-                #
-                charset = part.get_content_charset(failobj="")
-                logger.debug("attached filename={}".format(at_filename))
-                logger.debug("charset={}".format(charset))
-                #
-                outfilename = os.path.join(outdir, at_filename)
-                with open(outfilename, "bw") as fout:
-                    fout.write(part.get_payload(decode=True))
-    return at_filenamelist
+
+def get_attachments(emlpath):
+    """Get all attached files as file objects in memory
+
+    Nothing is written to the disk.
+    .eml の拡張子を持つ保存された電子メールファイルから、
+    全ての添付ファイルをメモリ上のファイルオブジェクトとして取得します。
+    ディスクには何も書き込みません。
+    Args:
+        emlpath (str | pathlib.Path): path for the .eml file
+
+    Returns:
+        list of AttachedFile: attached files with filenames
+    """
+    return parse_eml(emlpath).get_attachments()
@@ -1,7 +1,9 @@
 import sys
-import datetime
-import zoneinfo
 import openpyxl
+import util.docprops
+import util.formula
+import util.formulaequiv
+import util.sheetsnapshot
 
 
 def print_values_in_range(sheetdata, sheetmath, range_string, out=sys.stdout):
@@ -101,22 +103,10 @@ def get_createtime_modifiedtime(workbook, iana_key='Asia/Tokyo'):
             The datatimes are isoformat strings.
     """
     # # get datetime with "Z", (UTC)
-    createdtime = workbook.properties.created
-    modifiedtime = workbook.properties.modified
     # ただし、時間帯情報　timezone はNULLである　つまりシステム依存の時間に見えてしまう。
-    # 日本時間に変換
-    # 強引にUTCと認識させ、そこから日本時間帯に変換させる
-    if createdtime:
-        tmp = createdtime.replace(tzinfo=datetime.timezone.utc)
-        createdtimeJST = tmp.astimezone(tz=zoneinfo.ZoneInfo(key=iana_key))
-    else:
-        createdtimeJST = "Empty DateTime"
-    if modifiedtime:
-        tmp = modifiedtime.replace(tzinfo=datetime.timezone.utc)
-        modifiedtimeJST = tmp.astimezone(tz=zoneinfo.ZoneInfo(key=iana_key))
-    else:
-        modifiedtimeJST = "Empty DateTime"
-    return (createdtimeJST, modifiedtimeJST)
+    # UTCと認識させ、そこから指定された時間帯に変換させる
+    return (util.docprops.localtime(workbook.properties.created, iana_key),
+            util.docprops.localtime(workbook.properties.modified, iana_key))
 
 
 def is_given_value(sheetdata, sheetmath, addr, value):
@@ -169,7 +159,7 @@ def is_formula(sheetdata, sheetmath, addr):
         return False
 
 
-def check_values_in_range(sheetdata, sheetmath, range_string, values):
+def check_values_in_range(sheetdata, sheetmath, range_string, values, return_mask=False):
     """Verifies that the cells in the range are the given values.
 
     Returns total number of cells in the range
@@ -186,34 +176,34 @@ def check_values_in_range(sheetdata, sheetmath, range_string, values):
         values (list of list of int or str): Two dimensional values
             Row-major two dimensional sequence.
             example: [[11,12],[21,22],[31,32]]
+        return_mask (bool, optional): also return the pass mask of each cell.
+            Defaults to False.
 
     Returns:
         (countCells, countTrue) : tuple of ints
             countCells (int): total number of cells in the range
             countTrue (int): number of cells whose values are equal to the given values
+        (countCells, countTrue, mask) if return_mask is True
+            mask (numpy.ndarray of bool): True for the cells whose values are equal
     """
-    (min_col, min_row, max_col,
-     max_row) = openpyxl.utils.cell.range_boundaries(range_string)
-    countCells = 0
-    countTrue = 0
-    for row, valrow in zip(sheetdata.iter_rows(min_row=min_row, max_row=max_row,
-                                               min_col=min_col, max_col=max_col, values_only=True),
-                           values):
-        for cell1, val1 in zip(row, valrow):
-            countCells += 1
-            if cell1 == val1:
-                countTrue += 1
+    snapshot = util.sheetsnapshot.take_snapshot(sheetdata, sheetmath, range_string)
+    (countCells, countTrue, mask) = snapshot.count_equal(values)
+    if return_mask:
+        return (countCells, countTrue, mask)
     return (countCells, countTrue)
 
 
-def check_values_in_range_float(sheetdata, sheetmath, range_string, values, diffval=0.01):
+def check_values_in_range_float(sheetdata, sheetmath, range_string, values, diffval=0.01,
+                                reltol=0.0, return_mask=False):
     """Verifies that the cells in the range are the given float values.
 
     Returns total number of cells in the range
     and number of cells whose values are considered to be the same as the given float values.
     Slight differences in values are acceptable.
+    A cell is considered to be the same if |cell - value| <= diffval + reltol * |value|.
     範囲を指定されたセルの数と、与えられた値と同じ値を持つと考えられるセルの数を返します。
     わずかな値の差は許容される。
+    |セルの値 - 与えられた値| <= diffval + reltol * |与えられた値| であれば同じ値とみなします。
 
     Args:
         sheetdata (Worksheet): Worksheet instance of the openpyxl
@@ -227,29 +217,26 @@ def check_values_in_range_float(sheetdata, sheetmath, range_string, values, diff
             example: [[11.1,12.1],[21.1,22.1],[31.1,32.1]]
         diffval (float): Acceptable deviation
             10.12 and 10.123 are considerd to be the same if diffval is 0.01 .
+        reltol (float, optional): Acceptable relative deviation
+            Defaults to 0.0.
+        return_mask (bool, optional): also return the pass mask of each cell.
+            Defaults to False.
 
     Returns:
         (countCells, countTrue) : tuple of ints
             countCells (int): total number of cells in the range
             countTrue (int): number of cells whose values are 'equal' to the given values
+        (countCells, countTrue, mask) if return_mask is True
+            mask (numpy.ndarray of bool): True for the cells whose values are 'equal'
     """
-    (min_col, min_row, max_col,
-     max_row) = openpyxl.utils.cell.range_boundaries(range_string)
-    countCells = 0
-    countTrue = 0
-    for row, valrow in zip(sheetdata.iter_rows(min_row=min_row, max_row=max_row,
-                                               min_col=min_col, max_col=max_col, values_only=True),
-                           values):
-        for cell1, val1 in zip(row, valrow):
-            countCells += 1
-            if cell1 is not None and \
-                (isinstance(cell1, int) or isinstance(cell1, float)) and \
-                    abs(cell1 - val1) <= diffval:
-                countTrue += 1
+    snapshot = util.sheetsnapshot.take_snapshot(sheetdata, sheetmath, range_string)
+    (countCells, countTrue, mask) = snapshot.count_close(values, abstol=diffval, reltol=reltol)
+    if return_mask:
+        return (countCells, countTrue, mask)
     return (countCells, countTrue)
 
 
-def check_num_formulas_in_range(sheetdata, sheetmath, range_string):
+def check_num_formulas_in_range(sheetdata, sheetmath, range_string, return_mask=False):
     """Verifies that the cells in the range are formulas.
 
     Returns total number of cells in the range
@@ -265,38 +252,35 @@ def check_num_formulas_in_range(sheetdata, sheetmath, range_string):
             whose book are opened with data_only set to False
         range_string (str): Excel style cell range.
             example: `A1:B3`
+        return_mask (bool, optional): also return the mask of formula cells.
+            Defaults to False.
 
     Returns:
         (countCells, countTrue) : tuple of ints
             countCells (int): total number of cells in the range
             countTrue (int): number of cells which are formulas
+        (countCells, countTrue, mask) if return_mask is True
+            mask (numpy.ndarray of bool): True for the cells which are formulas
     """
-    (min_col, min_row, max_col,
-     max_row) = openpyxl.utils.cell.range_boundaries(range_string)
-    countCells = 0
-    countTrue = 0
-    for rowdata, rowmath in zip(sheetdata.iter_rows(min_row=min_row, max_row=max_row,
-                                min_col=min_col, max_col=max_col, values_only=True),
-                                sheetmath.iter_rows(min_row=min_row, max_row=max_row,
-                                min_col=min_col, max_col=max_col, values_only=True)):
-        for data1, math1 in zip(rowdata, rowmath):
-            countCells += 1
-            if data1 != math1:
-                # 保存されている値とセルに書かれているデータが違う　→　セルに書かれているのは数式
-                countTrue += 1
+    snapshot = util.sheetsnapshot.take_snapshot(sheetdata, sheetmath, range_string)
+    (countCells, countTrue, mask) = snapshot.count_formulas()
+    if return_mask:
+        return (countCells, countTrue, mask)
     return (countCells, countTrue)
 
 
-def check_func_in_range(sheetdata, sheetmath, range_string, func_string):
+def check_func_in_range(sheetdata, sheetmath, range_string, func_string, exact=True):
     """Verifies that the formulas contain the given function.
 
     Returns total number of cells in the range
-    and number of cells whose formula contains the given function.
-    This function checks the formula and function as string.
-    So this function do not distinguish SUM and SUMIF and so on.
-    範囲を指定されたセルの数と、与えられた関数を含む数式のセルの数を返します。
-    数式の詳細には触れず、文字列として関数名を含むかどうかをチェックします。
-    その為、SUM と SUMIF などは区別しません。
+    and number of cells whose formula calls the given function.
+    The formulas are parsed, so SUM does not match SUMIF.
+    If exact is False, the formula and function are checked as string like before,
+    so SUM and SUMIF and so on are not distinguished.
+    範囲を指定されたセルの数と、与えられた関数を呼び出す数式のセルの数を返します。
+    数式を解析するので、SUM は SUMIF に一致しません。
+    exact が False の場合は、以前と同じく文字列として関数名を含むかどうかをチェックします。
+    その場合、SUM と SUMIF などは区別しません。
 
     Args:
         sheetdata (Worksheet): Worksheet instance of the openpyxl
@@ -307,6 +291,8 @@ def check_func_in_range(sheetdata, sheetmath, range_string, func_string):
             example: `A1:B3`
         func_string (str): Excel function name
             example : 'AVERAGE'
+        exact (bool, optional): match function names exactly.
+            Defaults to True.
 
     Returns:
         (countCells, countTrue) : tuple of ints
@@ -321,12 +307,46 @@ def check_func_in_range(sheetdata, sheetmath, range_string, func_string):
                                    min_col=min_col, max_col=max_col, values_only=True):
         for cell1 in row:
             countCells += 1
-            if (isinstance(cell1, str)) and \
+            if exact:
+                parsed = util.formula.parse_cell_formula(cell1)
+                if parsed is not None and parsed.has_function(func_string):
+                    countTrue += 1
+            elif (isinstance(cell1, str)) and \
                     func_string in cell1:
                 countTrue += 1
     return (countCells, countTrue)
 
 
+def is_equivalent_formula(sheetdata, sheetmath, addr, formula):
+    """Verifies that the formula of the specified cell is equivalent to the given formula.
+
+    Returns True if the formula of the cell gives the same results as the given formula
+    for random values of the referenced cells.
+    So "=C4+D4", "=SUM(C4:D4)" and "= C4*100/100 + D4" are equivalent.
+    Only numeric formulas with the functions in util.formulaequiv.FUNCTIONS are supported,
+    and False is returned for other formulas.
+    アドレスを指定されたセルの数式が、参照するセルに乱数を入れたときに
+    与えられた数式と同じ結果になれば True を返します。
+    そのため「=C4+D4」「=SUM(C4:D4)」「= C4*100/100 + D4」は同じ意味になります。
+    util.formulaequiv.FUNCTIONS の関数を使った数値の数式だけに対応し、
+    それ以外の数式には False を返します。
+
+    Args:
+        sheetdata (Worksheet): Worksheet instance of the openpyxl
+            whose book are opened with data_only set to True
+        sheetmath (Worksheet): Worksheet instance of the openpyxl
+            whose book are opened with data_only set to False
+        addr (str): Excel style cell address.
+            example: "E4"
+        formula (str): expected formula
+            example: "=C4+D4"
+
+    Returns:
+        bool
+    """
+    return util.formulaequiv.check_equivalence([sheetmath[addr].value], formula)[0]
+
+
 def is_integer(sheetdata, sheetmath, addr):
     """Verifies that the value of the specified cell is int.
 
@@ -355,7 +375,9 @@ def check_comp_abs_ref_in_range(sheetdata, sheetmath, range_string):
 
     Returns total number of cells in the range
     and number of cells whose formula contains composite/absolute cell reference.
+    "$" in string constants of the formula is not counted.
     範囲を指定されたセルの数と、セルの複合参照もしくは絶対参照を含む数式のセルの数を返します。
+    数式の文字列定数の中の "$" は数えません。
 
     Args:
         sheetdata (Worksheet): Worksheet instance of the openpyxl
@@ -370,14 +392,25 @@ def check_comp_abs_ref_in_range(sheetdata, sheetmath, range_string):
             countCells (int): total number of cells in the range
             countTrue (int): number of cells which contains composite/absolute cell reference
     """
-    return check_func_in_range(sheetdata, sheetmath, range_string, func_string="$")
+    (min_col, min_row, max_col,
+     max_row) = openpyxl.utils.cell.range_boundaries(range_string)
+    countCells = 0
+    countTrue = 0
+    for row in sheetmath.iter_rows(min_row=min_row, max_row=max_row,
+                                   min_col=min_col, max_col=max_col, values_only=True):
+        for cell1 in row:
+            countCells += 1
+            parsed = util.formula.parse_cell_formula(cell1)
+            if parsed is not None and parsed.has_absolute_reference():
+                countTrue += 1
+    return (countCells, countTrue)
 
 
 # 指定したセルの「フォント」がｘｘである
-# 作成せず
+# util.excelutil_exp の is_font と check_font_in_range を参照
 
 # 指定したセルの「罫線」がｘｘである
-# 作成せず
+# util.excelutil_exp の is_bordered と check_border_in_range を参照
 
 # 指定したセル範囲の「条件付き書式」がある
 # 作成せず
@@ -1,6 +1,18 @@
 """This is an experimental util.
+
+The styles are looked up in util.styleindex,
+so styles.xml is resolved once per workbook
+and the checks work on the sheets loaded by util.xlsxreader too.
+書式は util.styleindex で参照するので、styles.xml はブックごとに1回だけ変換され、
+util.xlsxreader で読み込んだシートにも使えます。
 """
 import openpyxl
+import util.styleindex
+
+
+def _style(sheetdata, addr):
+    row, column = openpyxl.utils.cell.coordinate_to_tuple(addr)
+    return util.styleindex.style_at(sheetdata, row, column)
 
 
 def is_aligned_h(sheetdata, sheetmath, addr, horizontal):
@@ -30,14 +42,7 @@ def is_aligned_h(sheetdata, sheetmath, addr, horizontal):
     ----------
         bool
     """
-    tmpboolH = False
-    if horizontal is None:
-        if sheetdata[addr].alignment.horizontal is None:
-            tmpboolH = True
-    else:
-        if sheetdata[addr].alignment.horizontal == horizontal:
-            tmpboolH = True
-    return tmpboolH
+    return _style(sheetdata, addr).horizontal == horizontal
 
 
 def is_aligned_v(sheetdata, sheetmath, addr, vertical):
@@ -67,15 +72,7 @@ def is_aligned_v(sheetdata, sheetmath, addr, vertical):
     ----------
         bool
     """
-    tmpboolV = False
-    if vertical is None:
-        if sheetdata[addr].alignment.vertical is None:
-            tmpboolV = True
-    else:
-        if sheetdata[addr].alignment.vertical == vertical:
-            tmpboolV = True
-
-    return tmpboolV
+    return _style(sheetdata, addr).vertical == vertical
 
 
 def is_solidfill(sheetdata, sheetmath, addr):
@@ -98,10 +95,7 @@ def is_solidfill(sheetdata, sheetmath, addr):
     ----------
         bool
     """
-    if sheetdata[addr].fill.patternType == "solid":
-        return True
-    else:
-        return False
+    return _style(sheetdata, addr).fill_type == "solid"
 
 
 def is_numberformat(sheetdata, sheetmath, addr, number_format):
@@ -140,23 +134,232 @@ def is_numberformat(sheetdata, sheetmath, addr, number_format):
     # >>> sheetData["E67"].number_format
     # '0.000_ '
     """
-    if sheetdata[addr].number_format == number_format:
-        return True
-    else:
-        return False
+    return _style(sheetdata, addr).number_format == number_format
 
 # 指定したセルの「表示形式」の取得
 
 
 def get_numberformat(sheetdata, sheetmath, addr):
-    return sheetdata[addr].number_format
+    return _style(sheetdata, addr).number_format
 
 
-# 指定したセルの「フォント」がｘｘである
-# 作成せず
+def _font_matches(style, name, size, bold, italic, underline, color):
+    # None の条件は調べない
+    return ((name is None or style.font_name == name) and
+            (size is None or style.font_size == size) and
+            (bold is None or style.bold == bold) and
+            (italic is None or style.italic == italic) and
+            (underline is None or style.underline == (underline or None)) and
+            (color is None or style.font_color == color))
 
-# 指定したセルの「罫線」がｘｘである
-# 作成せず
+
+def is_font(sheetdata, sheetmath, addr, name=None, size=None, bold=None, italic=None,
+            underline=None, color=None):
+    """Verifies that the font of the specified cell is specified.
+
+    Returns True if the font of the cell has all the given properties.
+    Properties set to None are not checked.
+    指定したセルの「フォント」が与えられた指示と同じかどうかをチェックします。
+    None の項目はチェックしません。
+
+    Parameters:
+    ----------
+    sheetdata : Worksheet instance of the openpyxl
+        whose book are opened with data_only set to True
+    sheetmath : Worksheet instance of the openpyxl
+        whose book are opened with data_only set to False
+    addr: str
+        Excel style cell address.
+        example: "A3"
+    name : str
+        Font name
+        example : 'Yu Gothic'
+    size : float
+        Font size
+        example : 11
+    bold : bool
+    italic : bool
+    underline : str
+        example : 'single', 'double'. False means no underline.
+    color : str
+        RGB of the font color, or theme color like 'theme:1'
+        example : 'FFFF0000'
+
+    Returns:
+    ----------
+        bool
+    """
+    return _font_matches(_style(sheetdata, addr), name, size, bold, italic, underline, color)
+
+
+def get_font(sheetdata, sheetmath, addr):
+    """Font of the cell. 指定したセルの「フォント」の取得
+
+    Returns:
+    ----------
+        dict : name, size, bold, italic, underline, strike and color
+    """
+    style = _style(sheetdata, addr)
+    return {"name": style.font_name, "size": style.font_size, "bold": style.bold,
+            "italic": style.italic, "underline": style.underline, "strike": style.strike,
+            "color": style.font_color}
+
+
+def _border_matches(style, border_style, sides):
+    for side in sides:
+        value = style.border[util.styleindex.BORDER_SIDES.index(side)]
+        if value is None or (border_style is not None and value != border_style):
+            return False
+    return True
+
+
+def is_bordered(sheetdata, sheetmath, addr, border_style=None,
+                sides=("left", "right", "top", "bottom")):
+    """Verifies that the specified cell has borders.
+
+    Returns True if all the given sides of the cell have borders.
+    指定したセルの指定した辺に「罫線」があるかどうかをチェックします。
+
+    Parameters:
+    ----------
+    sheetdata : Worksheet instance of the openpyxl
+        whose book are opened with data_only set to True
+    sheetmath : Worksheet instance of the openpyxl
+        whose book are opened with data_only set to False
+    addr: str
+        Excel style cell address.
+        example: "A3"
+    border_style : str
+        Border style. None means any style.
+        example : 'thin', 'medium', 'double'
+    sides : sequence of str
+        Sides to check
+        example : ('left', 'right', 'top', 'bottom')
+
+    Returns:
+    ----------
+        bool
+    """
+    return _border_matches(_style(sheetdata, addr), border_style, sides)
+
+
+def check_aligned_h_in_range(sheetdata, sheetmath, range_string, horizontal):
+    """Count cells whose horizontal alignment is specified in the range.
+
+    指定したセル範囲の中で、水平方向の配置が与えられた指示と同じセルを数えます。
+
+    Parameters:
+    ----------
+    sheetdata : Worksheet instance of the openpyxl
+        whose book are opened with data_only set to True
+    sheetmath : Worksheet instance of the openpyxl
+        whose book are opened with data_only set to False
+    range_string : str
+        Excel style cell range.
+        example: `B2:F30`
+    horizontal : str
+        example : 'left', 'right', 'center', 'justify', and None.
+
+    Returns:
+    ----------
+        (countCells, countTrue) : countCells (int), countTrue (int)
+    """
+    return util.styleindex.count_styles(sheetdata, range_string,
+                                        lambda style: style.horizontal == horizontal)
+
+
+def check_aligned_v_in_range(sheetdata, sheetmath, range_string, vertical):
+    """Count cells whose vertical alignment is specified in the range.
+
+    指定したセル範囲の中で、垂直方向の配置が与えられた指示と同じセルを数えます。
+
+    Parameters:
+    ----------
+    sheetdata, sheetmath, range_string : same as check_aligned_h_in_range
+    vertical : str
+        example :  'top', 'bottom', 'center', 'justify', and None.
+
+    Returns:
+    ----------
+        (countCells, countTrue) : countCells (int), countTrue (int)
+    """
+    return util.styleindex.count_styles(sheetdata, range_string,
+                                        lambda style: style.vertical == vertical)
+
+
+def check_solidfill_in_range(sheetdata, sheetmath, range_string):
+    """Count cells filled with some color in the range.
+
+    指定したセル範囲の中で「塗りつぶし」のセルを数えます。
+
+    Parameters:
+    ----------
+    sheetdata, sheetmath, range_string : same as check_aligned_h_in_range
+
+    Returns:
+    ----------
+        (countCells, countTrue) : countCells (int), countTrue (int)
+    """
+    return util.styleindex.count_styles(sheetdata, range_string,
+                                        lambda style: style.fill_type == "solid")
+
+
+def check_numberformat_in_range(sheetdata, sheetmath, range_string, number_format):
+    """Count cells whose number format is specified in the range.
+
+    指定したセル範囲の中で「表示形式」が与えられた指示と同じセルを数えます。
+
+    Parameters:
+    ----------
+    sheetdata, sheetmath, range_string : same as check_aligned_h_in_range
+    number_format : str
+        example : '0.0_ '
+
+    Returns:
+    ----------
+        (countCells, countTrue) : countCells (int), countTrue (int)
+    """
+    return util.styleindex.count_styles(sheetdata, range_string,
+                                        lambda style: style.number_format == number_format)
+
+
+def check_font_in_range(sheetdata, sheetmath, range_string, name=None, size=None, bold=None,
+                        italic=None, underline=None, color=None):
+    """Count cells whose font is specified in the range.
+
+    指定したセル範囲の中で「フォント」が与えられた指示と同じセルを数えます。
+
+    Parameters:
+    ----------
+    sheetdata, sheetmath, range_string : same as check_aligned_h_in_range
+    name, size, bold, italic, underline, color : same as is_font
+
+    Returns:
+    ----------
+        (countCells, countTrue) : countCells (int), countTrue (int)
+    """
+    return util.styleindex.count_styles(
+        sheetdata, range_string,
+        lambda style: _font_matches(style, name, size, bold, italic, underline, color))
+
+
+def check_border_in_range(sheetdata, sheetmath, range_string, border_style=None,
+                          sides=("left", "right", "top", "bottom")):
+    """Count cells with borders in the range.
+
+    指定したセル範囲の中で、指定した辺に「罫線」があるセルを数えます。
+
+    Parameters:
+    ----------
+    sheetdata, sheetmath, range_string : same as check_aligned_h_in_range
+    border_style, sides : same as is_bordered
+
+    Returns:
+    ----------
+        (countCells, countTrue) : countCells (int), countTrue (int)
+    """
+    return util.styleindex.count_styles(
+        sheetdata, range_string, lambda style: _border_matches(style, border_style, sides))
 
 # 指定したセル範囲の「条件付き書式」がある
 # 作成せず
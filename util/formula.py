@@ -0,0 +1,329 @@
+"""Excel formula parser with a parse cache.
+
+A formula is split into tokens by openpyxl's tokenizer
+and parsed into a small syntax tree made of tuples.
+Many students write the same formula, so parsed formulas are cached by the text
+and each distinct formula is parsed only once.
+数式を openpyxl のトークナイザーでトークンに分け、タプルで表した小さな構文木に変換します。
+多くの学生が同じ数式を書くので、解析した数式は数式の文字列をキーにキャッシュし、
+異なる数式ごとに1回だけ解析します。
+
+Nodes of the syntax tree:
+構文木のノード:
+    ("number", 3.0)
+    ("text", "abc")
+    ("bool", True)
+    ("error", "#N/A")
+    ("ref", "$A$1:B2")              cell or range, with the sheet name if any
+    ("func", "SUM", (arg, ...))     function call, name in upper case
+    ("op", "+", (left, right))      infix operator
+    ("prefix", "-", operand)
+    ("postfix", "%", operand)
+    ("array", ((item, ...), ...))   array constant, row-major
+    ("empty",)                      omitted argument like IF(A1,,2)
+
+Example:
+    parsed = util.formula.parse_formula("=AVERAGE(C14:D14)")
+    parsed.functions   # ('AVERAGE',)
+    parsed.references  # ('C14:D14',)
+"""
+import functools
+import re
+from openpyxl.formula.tokenizer import Tokenizer, Token, TokenizerError
+
+# 二項演算子の優先順位 (大きいほど先に計算する)
+BINARY_PRECEDENCE = {
+    "=": 1, "<>": 1, "<": 1, ">": 1, "<=": 1, ">=": 1,
+    "&": 2,
+    "+": 3, "-": 3,
+    "*": 4, "/": 4,
+    "^": 5,
+    ":": 7,
+}
+# セル (A1)、列全体の端 (A:A の A)、行全体の端 (1:1 の 1)
+_CELL_RE = re.compile(r"(\$?)([A-Za-z]{1,3})(\$?)(\d+)|(\$?)([A-Za-z]{1,3})|(\$?)(\d+)")
+
+
+class ParsedFormula:
+    """Parsed formula.
+
+    Attributes:
+        text (str): formula text
+        tokens (tuple): (type, subtype, value) of each token without white-spaces
+        tree (tuple): syntax tree
+        functions (tuple of str): called functions in order, upper case,
+            without the "_xlfn." prefix
+        references (tuple of str): cell or range references in order
+        literals (tuple): number, text, bool and error constants in order
+    """
+
+    def __init__(self, text, tokens, tree):
+        self.text = text
+        self.tokens = tokens
+        self.tree = tree
+        functions = []
+        references = []
+        literals = []
+        for node in walk(tree):
+            kind = node[0]
+            if kind == "func":
+                functions.append(node[1])
+            elif kind == "ref":
+                references.append(node[1])
+            elif kind in ("number", "text", "bool", "error"):
+                literals.append(node[1])
+        self.functions = tuple(functions)
+        self.references = tuple(references)
+        self.literals = tuple(literals)
+
+    def has_function(self, name):
+        """Returns True if the formula calls the function. SUM does not match SUMIF.
+
+        数式がその関数を呼んでいれば True を返します。SUM は SUMIF に一致しません。
+        """
+        return name.upper() in self.functions
+
+    def reference_kinds(self):
+        """Returns the kind of each cell in the references.
+
+        参照に含まれる各セルの種類を返します。
+
+        Whole columns and rows count as "absolute" ($A:$A, $1:$1) or "relative" (A:A, 1:1)
+        for each end.
+        列全体や行全体の範囲は端ごとに "absolute" ($A:$A, $1:$1) か "relative" (A:A, 1:1) とします。
+
+        Returns:
+            list of str: "relative" (A1), "absolute" ($A$1),
+                "mixed" ($A1 or A$1) for each cell
+        """
+        kinds = []
+        for ref in self.references:
+            parts = ref.split("!")[-1].split(":")
+            for part in parts:
+                m = _CELL_RE.fullmatch(part)
+                if m is None:
+                    continue
+                col_abs, _, row_abs, row, line_col_abs, _, line_row_abs, _ = m.groups()
+                if row is None:
+                    # 名前付き範囲 (ABC など) と区別するため、":" のある範囲の端だけを数える
+                    if len(parts) > 1:
+                        kinds.append("absolute" if line_col_abs or line_row_abs else "relative")
+                elif col_abs and row_abs:
+                    kinds.append("absolute")
+                elif col_abs or row_abs:
+                    kinds.append("mixed")
+                else:
+                    kinds.append("relative")
+        return kinds
+
+    def has_absolute_reference(self):
+        """Returns True if the formula has an absolute or mixed cell reference.
+
+        "$" in text constants are not counted.
+        数式が絶対参照もしくは複合参照を含んでいれば True を返します。
+        文字列定数の中の "$" は数えません。
+        """
+        return any(kind != "relative" for kind in self.reference_kinds())
+
+    def __repr__(self):
+        return "<ParsedFormula {!r}>".format(self.text)
+
+
+def walk(node):
+    """Yield all nodes of a syntax tree, parents first.
+
+    構文木の全てのノードを親から順に返します。
+    """
+    yield node
+    kind = node[0]
+    if kind == "func":
+        for arg in node[2]:
+            yield from walk(arg)
+    elif kind == "op":
+        yield from walk(node[2][0])
+        yield from walk(node[2][1])
+    elif kind in ("prefix", "postfix"):
+        yield from walk(node[2])
+    elif kind == "array":
+        for row in node[1]:
+            for item in row:
+                yield from walk(item)
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_formula(text):
+    """Parse a formula. The result is cached by the text.
+
+    数式を解析します。結果は数式の文字列をキーにキャッシュされます。
+
+    Args:
+        text (str): formula
+            example: "=AVERAGE(C14:D14)"
+
+    Returns:
+        ParsedFormula
+
+    Raises:
+        ValueError: if the formula cannot be parsed
+    """
+    try:
+        tokenizer = Tokenizer(text)
+    except (TokenizerError, IndexError, KeyError, ValueError) as e:
+        # 括弧の対応が取れていないなどの場合、トークナイザーは様々な例外を出す
+        raise ValueError("Cannot parse {!r}: {}".format(text, e)) from e
+    tokens = tuple((t.type, t.subtype, t.value) for t in tokenizer.items
+                   if t.type != Token.WSPACE)
+    if not tokens:
+        raise ValueError("Empty formula {!r}".format(text))
+    parser = _Parser(tokens, text)
+    tree = parser.parse_expression(0)
+    if parser.pos != len(tokens):
+        raise ValueError("Cannot parse {!r}: unexpected {!r}".format(text, tokens[parser.pos][2]))
+    return ParsedFormula(text, tokens, tree)
+
+
+def formula_text(value):
+    """Returns the formula text of a cell value of sheetmath, or None.
+
+    sheetmath のセルの値が数式ならその文字列を、そうでなければ None を返します。
+
+    Args:
+        value (object): cell value of the sheet opened with data_only set to False
+
+    Returns:
+        str | None
+    """
+    text = getattr(value, "text", value)  # ArrayFormula
+    if isinstance(text, str) and text.startswith("=") and len(text) > 1:
+        return text
+    return None
+
+
+def parse_cell_formula(value):
+    """Parse the formula of a cell value of sheetmath.
+
+    Returns None if the cell is not a formula or the formula cannot be parsed.
+    sheetmath のセルの値の数式を解析します。
+    数式でない場合や解析できない場合は None を返します。
+
+    Args:
+        value (object): cell value of the sheet opened with data_only set to False
+
+    Returns:
+        ParsedFormula | None
+    """
+    text = formula_text(value)
+    if text is None:
+        return None
+    try:
+        return parse_formula(text)
+    except ValueError:
+        return None
+
+
+class _Parser:
+    """Recursive descent parser over the tokens."""
+
+    def __init__(self, tokens, text):
+        self.tokens = tokens
+        self.text = text
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None, None)
+
+    def _error(self, message):
+        return ValueError("Cannot parse {!r}: {}".format(self.text, message))
+
+    def parse_expression(self, min_prec):
+        left = self._parse_unary()
+        while True:
+            ttype, _, value = self._peek()
+            if ttype != Token.OP_IN or value not in BINARY_PRECEDENCE:
+                return left
+            prec = BINARY_PRECEDENCE[value]
+            if prec <= min_prec:
+                return left
+            self.pos += 1
+            # ^ も含めて Excel の演算子は全て左結合
+            right = self.parse_expression(prec)
+            left = ("op", value, (left, right))
+
+    def _parse_unary(self):
+        # 前置の - は ^ より先に計算する (=-2^2 は 4)
+        ttype, _, value = self._peek()
+        if ttype == Token.OP_PRE:
+            self.pos += 1
+            return ("prefix", value, self._parse_unary())
+        node = self._parse_primary()
+        while self._peek()[0] == Token.OP_POST:
+            node = ("postfix", self._peek()[2], node)
+            self.pos += 1
+        return node
+
+    def _parse_primary(self):
+        ttype, subtype, value = self._peek()
+        if ttype is None:
+            raise self._error("unexpected end")
+        self.pos += 1
+        if ttype == Token.OPERAND:
+            if subtype == Token.NUMBER:
+                return ("number", float(value))
+            if subtype == Token.TEXT:
+                return ("text", value[1:-1].replace('""', '"'))
+            if subtype == Token.LOGICAL:
+                return ("bool", value.upper() == "TRUE")
+            if subtype == Token.ERROR:
+                return ("error", value)
+            return ("ref", value)
+        if ttype == Token.FUNC and subtype == Token.OPEN:
+            name = value[:-1].upper()
+            if name.startswith("_XLFN."):
+                name = name[6:]
+            return ("func", name, self._parse_arguments())
+        if ttype == Token.PAREN and subtype == Token.OPEN:
+            node = self.parse_expression(0)
+            if self._peek()[:2] != (Token.PAREN, Token.CLOSE):
+                raise self._error("missing )")
+            self.pos += 1
+            return node
+        if ttype == Token.ARRAY and subtype == Token.OPEN:
+            return self._parse_array()
+        raise self._error("unexpected {!r}".format(value))
+
+    def _parse_arguments(self):
+        args = []
+        if self._peek()[:2] == (Token.FUNC, Token.CLOSE):
+            self.pos += 1
+            return ()
+        while True:
+            ttype, subtype, _ = self._peek()
+            if (ttype == Token.SEP and subtype == Token.ARG) or \
+                    (ttype == Token.FUNC and subtype == Token.CLOSE):
+                args.append(("empty",))
+            else:
+                args.append(self.parse_expression(0))
+            ttype, subtype, value = self._peek()
+            self.pos += 1
+            if ttype == Token.FUNC and subtype == Token.CLOSE:
+                return tuple(args)
+            if not (ttype == Token.SEP and subtype == Token.ARG):
+                raise self._error("unexpected {!r} in arguments".format(value))
+
+    def _parse_array(self):
+        rows = []
+        row = []
+        while True:
+            row.append(self.parse_expression(0))
+            ttype, subtype, value = self._peek()
+            self.pos += 1
+            if ttype == Token.ARRAY and subtype == Token.CLOSE:
+                rows.append(tuple(row))
+                return ("array", tuple(rows))
+            if ttype == Token.SEP and subtype == Token.ROW:
+                rows.append(tuple(row))
+                row = []
+            elif not (ttype == Token.SEP and subtype == Token.ARG):
+                raise self._error("unexpected {!r} in array".format(value))
@@ -0,0 +1,253 @@
+"""Equivalence check of formulas by randomized evaluation.
+
+A formula is compiled into a Python function which computes
+the formula with NumPy for many input values at once.
+Two formulas are considered to be equivalent
+if they give the same results for many random values of the referenced cells.
+So "=C4+D4", "=SUM(C4:D4)" and "= C4*100/100 + D4" are equivalent.
+Compiled functions are cached by the formula text.
+数式を、多数の入力値に対して NumPy でまとめて計算する Python の関数にコンパイルします。
+参照しているセルに多数の乱数を入れて同じ結果になる2つの数式を、同じ意味の数式とみなします。
+そのため「=C4+D4」「=SUM(C4:D4)」「= C4*100/100 + D4」は同じ意味になります。
+コンパイルした関数は数式の文字列をキーにキャッシュされます。
+
+Only numeric formulas are supported.
+Supported functions are the keys of FUNCTIONS.
+数値の数式だけに対応しています。対応している関数は FUNCTIONS のキーです。
+
+Example:
+    util.formulaequiv.is_equivalent("=SUM(C4:D4)", "=C4+D4")  # True
+"""
+import functools
+import numpy as np
+import openpyxl
+import util.formula
+
+# 範囲を展開するセルの数の上限
+MAX_RANGE_CELLS = 10000
+
+
+def _round(x, digits=0):
+    # Excel の ROUND は 0.5 を 0 から遠い方に丸める
+    scale = np.power(10.0, np.floor(digits))
+    return np.sign(x) * np.floor(np.abs(x) * scale + 0.5) / scale
+
+
+def _if(cond, a=True, b=False):
+    return np.where(cond, a, b)
+
+
+FUNCTIONS = {
+    "SUM": lambda *args: functools.reduce(np.add, args),
+    "AVERAGE": lambda *args: functools.reduce(np.add, args) / len(args),
+    "PRODUCT": lambda *args: functools.reduce(np.multiply, args),
+    "MIN": lambda *args: functools.reduce(np.minimum, args),
+    "MAX": lambda *args: functools.reduce(np.maximum, args),
+    "COUNT": lambda *args: np.float64(len(args)),
+    "ABS": np.abs,
+    "SQRT": np.sqrt,
+    "POWER": np.power,
+    "MOD": np.mod,
+    "INT": np.floor,
+    "ROUND": _round,
+    "IF": _if,
+    "AND": lambda *args: functools.reduce(np.logical_and, args),
+    "OR": lambda *args: functools.reduce(np.logical_or, args),
+    "NOT": np.logical_not,
+}
+
+_OPERATORS = {
+    "+": "+", "-": "-", "*": "*", "/": "/",
+    "=": "==", "<>": "!=", "<": "<", ">": ">", "<=": "<=", ">=": ">=",
+}
+
+
+def _cell_name(ref):
+    # $ を取り除き、大文字にしたものを変数名とする
+    return ref.replace("$", "").upper()
+
+
+def _expand(ref):
+    name = _cell_name(ref)
+    sheet = ""
+    if "!" in name:
+        sheet, name = name.rsplit("!", 1)
+        sheet += "!"
+    if ":" not in name:
+        return [sheet + name]
+    (min_col, min_row, max_col,
+     max_row) = openpyxl.utils.cell.range_boundaries(name)
+    if None in (min_col, min_row, max_col, max_row) or \
+            (max_col - min_col + 1) * (max_row - min_row + 1) > MAX_RANGE_CELLS:
+        raise ValueError("Range {} is too large".format(ref))
+    return [sheet + openpyxl.utils.get_column_letter(col) + str(row)
+            for row in range(min_row, max_row + 1)
+            for col in range(min_col, max_col + 1)]
+
+
+def _source(node, cells, in_args=False):
+    kind = node[0]
+    if kind == "number":
+        return repr(node[1])
+    if kind == "bool":
+        return "1.0" if node[1] else "0.0"
+    if kind == "ref":
+        names = _expand(node[1])
+        if len(names) > 1 and not in_args:
+            raise ValueError("Range {} outside of a function".format(node[1]))
+        cells.update(names)
+        return ", ".join("env[{!r}]".format(name) for name in names)
+    if kind == "op":
+        left = _source(node[2][0], cells)
+        right = _source(node[2][1], cells)
+        if node[1] == "^":
+            return "np.power({}, {})".format(left, right)
+        if node[1] not in _OPERATORS:
+            raise ValueError("Operator {} is not supported".format(node[1]))
+        return "({} {} {})".format(left, _OPERATORS[node[1]], right)
+    if kind == "prefix":
+        return "({}{})".format(node[1], _source(node[2], cells))
+    if kind == "postfix":
+        return "({} / 100.0)".format(_source(node[2], cells))
+    if kind == "func":
+        if node[1] not in FUNCTIONS:
+            raise ValueError("Function {} is not supported".format(node[1]))
+        args = ", ".join(_source(arg, cells, in_args=True) for arg in node[2])
+        return "F[{!r}]({})".format(node[1], args)
+    raise ValueError("{} is not supported".format(kind))
+
+
+class CompiledFormula:
+    """Formula compiled into a Python function.
+
+    Attributes:
+        text (str): formula text
+        cells (tuple of str): referenced cells like "C4" or "Sheet2!A1"
+        source (str): Python source of the function
+    """
+
+    def __init__(self, text, cells, source, func):
+        self.text = text
+        self.cells = cells
+        self.source = source
+        self.func = func
+
+    def __call__(self, env):
+        """Compute the formula.
+
+        Args:
+            env (dict): cell name to value or numpy.ndarray of values
+
+        Returns:
+            numpy.ndarray | float
+        """
+        with np.errstate(all="ignore"):
+            return self.func(env, FUNCTIONS, np)
+
+
+@functools.lru_cache(maxsize=65536)
+def compile_formula(text):
+    """Compile a formula into a Python function. The result is cached by the text.
+
+    数式を Python の関数にコンパイルします。結果は数式の文字列をキーにキャッシュされます。
+
+    Args:
+        text (str): formula
+            example: "=SUM(C4:D4)"
+
+    Returns:
+        CompiledFormula
+
+    Raises:
+        ValueError: if the formula cannot be parsed or is not supported
+    """
+    parsed = util.formula.parse_formula(text)
+    cells = set()
+    source = _source(parsed.tree, cells)
+    # 構文木から作ったコードだけを組み込み関数なしで評価する
+    func = eval("lambda env, F, np: " + source, {"__builtins__": {}})
+    return CompiledFormula(text, tuple(sorted(cells)), source, func)
+
+
+@functools.lru_cache(maxsize=1024)
+def _random_inputs(cells, trials, seed):
+    rng = np.random.default_rng(seed)
+    env = {}
+    half = trials // 2
+    for name in cells:
+        # 半分は小さな整数、残りは正負の実数
+        values = np.empty(trials)
+        values[:half] = rng.integers(-20, 21, half)
+        values[half:] = rng.uniform(-1000.0, 1000.0, trials - half)
+        env[name] = values
+    return env
+
+
+@functools.lru_cache(maxsize=65536)
+def is_equivalent(formula, reference, trials=64, seed=0, rtol=1e-9, atol=1e-9):
+    """Verifies that two formulas give the same results.
+
+    Both formulas are computed for random values of the cells referenced by either formula.
+    A NaN or an infinity on one side is a mismatch unless the other side is the same,
+    and formulas which give no finite result are not equivalent.
+    The result is cached by the arguments.
+    どちらかの数式が参照するセルに乱数を入れて両方の数式を計算し、結果が同じかどうかを調べます。
+    一方だけが NaN や無限大になる場合は違う結果とし、有限の結果が1つもない数式は同じ意味とみなしません。
+    結果は引数をキーにキャッシュされます。
+
+    Args:
+        formula (str): formula of a student
+        reference (str): expected formula
+        trials (int, optional): number of random input values. Defaults to 64.
+        seed (int, optional): seed of the random values. Defaults to 0.
+        rtol (float, optional): relative tolerance. Defaults to 1e-9.
+        atol (float, optional): absolute tolerance. Defaults to 1e-9.
+
+    Returns:
+        bool
+
+    Raises:
+        ValueError: if a formula cannot be parsed or is not supported
+    """
+    compiled = compile_formula(formula)
+    expected = compile_formula(reference)
+    cells = tuple(sorted(set(compiled.cells) | set(expected.cells)))
+    env = _random_inputs(cells, trials, seed)
+    result = np.broadcast_to(np.asarray(compiled(env), dtype=float), (trials,))
+    expected_result = np.broadcast_to(np.asarray(expected(env), dtype=float), (trials,))
+    finite = np.isfinite(result)
+    if not np.any(finite) or np.any(finite != np.isfinite(expected_result)):
+        return False
+    # NaN と無限大は同じ種類のエラーどうしだけを同じとみなす
+    return bool(np.all(np.isclose(result[finite], expected_result[finite], rtol=rtol, atol=atol))
+                and np.array_equal(result[~finite], expected_result[~finite], equal_nan=True))
+
+
+def check_equivalence(formulas, reference, **kw):
+    """Check many formulas against one expected formula.
+
+    Each distinct formula is compiled and computed only once.
+    Formulas which cannot be parsed or are not supported are not equivalent.
+    多数の数式を1つの正解の数式と比べます。
+    異なる数式ごとに1回だけコンパイルして計算します。
+    解析できない数式や対応していない数式は同じ意味ではないとします。
+
+    Args:
+        formulas (sequence of str | None): formulas of students
+        reference (str): expected formula
+        **kw: passed to is_equivalent
+
+    Returns:
+        list of bool
+    """
+    results = {}
+    retlist = []
+    for formula in formulas:
+        text = util.formula.formula_text(formula)
+        if text not in results:
+            try:
+                results[text] = text is not None and is_equivalent(text, reference, **kw)
+            except ValueError:
+                results[text] = False
+        retlist.append(results[text])
+    return retlist
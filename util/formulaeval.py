@@ -0,0 +1,660 @@
+"""Formula evaluator for workbooks without cached values.
+
+Excel saves the value of each formula cell with the formula,
+but workbooks saved by some other applications or scripts have no cached values,
+and the sheet opened with data_only set to True has None for the formula cells.
+This module computes such cells from the formulas.
+Only the needed formula cells and the cells they depend on are computed,
+and each computed value is kept, so a cell is computed only once.
+Excel は数式のセルの値を数式と一緒に保存しますが、
+他のアプリケーションやスクリプトで保存したブックには値が保存されておらず、
+data_only を True にして開いたシートでは数式のセルが None になります。
+このモジュールはそのようなセルの値を数式から計算します。
+必要な数式のセルと、それが参照するセルだけを計算し、
+計算した値は保持するので、各セルは1回だけ計算されます。
+
+Example:
+    book = util.xlsxreader.load_dual_workbook("submission.xlsx")
+    util.formulaeval.fill_missing_values(book, {"Sheet1": ["E4:E19"]})
+
+Supported functions are the keys of FUNCTIONS.
+Cells with other functions or defined names are left as None.
+対応している関数は FUNCTIONS のキーです。
+それ以外の関数や名前の定義を使ったセルは None のままです。
+"""
+import datetime
+import math
+import operator
+import re
+import openpyxl
+from openpyxl.utils.datetime import to_excel
+import util.formula
+
+ERROR_CODES = ("#NULL!", "#DIV/0!", "#VALUE!", "#REF!", "#NAME?", "#NUM!", "#N/A")
+
+
+class ExcelError(str):
+    """Excel error value like #DIV/0!."""
+
+
+class Unsupported(Exception):
+    """The formula cannot be computed by this evaluator."""
+
+
+class _ErrorValue(Exception):
+    # 計算中に Excel のエラー値が出たことを伝える
+    def __init__(self, error):
+        super().__init__(error)
+        self.error = error
+
+
+class _Range:
+    # セル範囲の値 (行優先で平らにしたもの)
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+
+def _is_error(value):
+    return isinstance(value, ExcelError) or (isinstance(value, str) and value in ERROR_CODES)
+
+
+def _to_number(value):
+    if _is_error(value):
+        raise _ErrorValue(ExcelError(value))
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return to_excel(value)
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            raise _ErrorValue(ExcelError("#VALUE!"))
+    if isinstance(value, _Range):
+        if len(value.values) == 1:
+            return _to_number(value.values[0])
+        raise _ErrorValue(ExcelError("#VALUE!"))
+    raise Unsupported("Value {!r} is not supported".format(value))
+
+
+def _to_text(value):
+    if _is_error(value):
+        raise _ErrorValue(ExcelError(value))
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, _Range):
+        if len(value.values) == 1:
+            return _to_text(value.values[0])
+        raise _ErrorValue(ExcelError("#VALUE!"))
+    return str(value)
+
+
+def _to_bool(value):
+    if isinstance(value, str) and not _is_error(value):
+        if value.upper() in ("TRUE", "FALSE"):
+            return value.upper() == "TRUE"
+        raise _ErrorValue(ExcelError("#VALUE!"))
+    return bool(_to_number(value))
+
+
+def _numbers(args):
+    # SUM などと同じく、範囲の中の数値以外は無視し、直接与えた値は数値に変換する
+    for arg in args:
+        if isinstance(arg, _Range):
+            for value in arg.values:
+                if _is_error(value):
+                    raise _ErrorValue(ExcelError(value))
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield value
+                elif isinstance(value, (datetime.datetime, datetime.date)):
+                    yield to_excel(value)
+        elif arg is not None:
+            yield _to_number(arg)
+
+
+def _flatten(args):
+    for arg in args:
+        if isinstance(arg, _Range):
+            yield from arg.values
+        else:
+            yield arg
+
+
+def _average(*args):
+    numbers = list(_numbers(args))
+    if not numbers:
+        raise _ErrorValue(ExcelError("#DIV/0!"))
+    return sum(numbers) / len(numbers)
+
+
+def _product(*args):
+    result = 1
+    for number in _numbers(args):
+        result *= number
+    return result
+
+
+def _round(value, digits=0, mode="half"):
+    value = _to_number(value)
+    digits = int(_to_number(digits))
+    scale = 10.0 ** digits
+    scaled = abs(value) * scale
+    if mode == "half":
+        scaled = math.floor(scaled + 0.5)
+    elif mode == "up":
+        scaled = math.ceil(scaled - 1e-9)
+    else:
+        scaled = math.floor(scaled + 1e-9)
+    return math.copysign(scaled / scale, value)
+
+
+def _mod(a, b):
+    a = _to_number(a)
+    b = _to_number(b)
+    if b == 0:
+        raise _ErrorValue(ExcelError("#DIV/0!"))
+    return a - b * math.floor(a / b)
+
+
+def _sqrt(value):
+    value = _to_number(value)
+    if value < 0:
+        raise _ErrorValue(ExcelError("#NUM!"))
+    return math.sqrt(value)
+
+
+def _power(a, b):
+    try:
+        value = float(_to_number(a)) ** _to_number(b)
+    except (ZeroDivisionError, OverflowError):
+        raise _ErrorValue(ExcelError("#NUM!"))
+    # 負の数の小数乗は Python では複素数になる
+    if isinstance(value, complex):
+        raise _ErrorValue(ExcelError("#NUM!"))
+    return value
+
+
+_CRITERIA_RE = re.compile(r"^(<=|>=|<>|<|>|=)?(.*)$", re.DOTALL)
+
+
+def _criteria(criteria):
+    # COUNTIF などの条件を関数に変換する
+    if isinstance(criteria, (int, float)) and not isinstance(criteria, bool):
+        return lambda v: isinstance(v, (int, float)) and not isinstance(v, bool) and v == criteria
+    text = _to_text(criteria)
+    op, operand = _CRITERIA_RE.match(text).groups()
+    try:
+        number = float(operand)
+    except ValueError:
+        number = None
+    ops = {None: operator.eq, "=": operator.eq, "<>": operator.ne,
+           "<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge}
+    func = ops[op]
+    if number is not None:
+        def match(v):
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                return func(v, number)
+            return op == "<>"
+        return match
+    if op in (None, "=", "<>") and ("*" in operand or "?" in operand):
+        pattern = re.compile("^" + re.escape(operand).replace(r"\*", ".*").replace(r"\?", ".") + "$",
+                             re.IGNORECASE | re.DOTALL)
+        if op == "<>":
+            return lambda v: not (isinstance(v, str) and pattern.match(v))
+        return lambda v: isinstance(v, str) and bool(pattern.match(v))
+    if op in (None, "=") and operand == "":
+        return lambda v: v is None or v == ""
+    return lambda v: isinstance(v, str) and func(v.lower(), operand.lower())
+
+
+def _countif(rng, criteria):
+    match = _criteria(criteria)
+    return sum(1 for v in _flatten([rng]) if match(v))
+
+
+def _sumif(rng, criteria, sum_range=None):
+    match = _criteria(criteria)
+    values = _flatten([rng])
+    sums = _flatten([sum_range]) if sum_range is not None else _flatten([rng])
+    return sum(s for v, s in zip(values, sums)
+               if match(v) and isinstance(s, (int, float)) and not isinstance(s, bool))
+
+
+def _averageif(rng, criteria, average_range=None):
+    match = _criteria(criteria)
+    values = list(_flatten([rng]))
+    targets = list(_flatten([average_range])) if average_range is not None else values
+    numbers = [s for v, s in zip(values, targets)
+               if match(v) and isinstance(s, (int, float)) and not isinstance(s, bool)]
+    if not numbers:
+        raise _ErrorValue(ExcelError("#DIV/0!"))
+    return sum(numbers) / len(numbers)
+
+
+def _count(*args):
+    # 数値と日付だけを数え、エラー値や文字列は無視する
+    return sum(1 for v in _flatten(args)
+               if isinstance(v, (int, float, datetime.datetime, datetime.date))
+               and not isinstance(v, bool))
+
+
+def _min(*args):
+    numbers = list(_numbers(args))
+    return min(numbers) if numbers else 0
+
+
+def _max(*args):
+    numbers = list(_numbers(args))
+    return max(numbers) if numbers else 0
+
+
+FUNCTIONS = {
+    "SUM": lambda *args: sum(_numbers(args)),
+    "AVERAGE": _average,
+    "MIN": _min,
+    "MAX": _max,
+    "PRODUCT": _product,
+    "COUNT": _count,
+    "COUNTA": lambda *args: sum(1 for v in _flatten(args) if v is not None),
+    "COUNTBLANK": lambda *args: sum(1 for v in _flatten(args) if v is None or v == ""),
+    "COUNTIF": _countif,
+    "SUMIF": _sumif,
+    "AVERAGEIF": _averageif,
+    "ABS": lambda v: abs(_to_number(v)),
+    "INT": lambda v: math.floor(_to_number(v)),
+    "ROUND": lambda v, d=0: _round(v, d, "half"),
+    "ROUNDUP": lambda v, d=0: _round(v, d, "up"),
+    "ROUNDDOWN": lambda v, d=0: _round(v, d, "down"),
+    "MOD": _mod,
+    "SQRT": _sqrt,
+    "POWER": _power,
+    "AND": lambda *args: all(_to_bool(v) for v in _flatten(args) if v is not None),
+    "OR": lambda *args: any(_to_bool(v) for v in _flatten(args) if v is not None),
+    "NOT": lambda v: not _to_bool(v),
+    "LEN": lambda v: len(_to_text(v)),
+    "UPPER": lambda v: _to_text(v).upper(),
+    "LOWER": lambda v: _to_text(v).lower(),
+    "CONCATENATE": lambda *args: "".join(_to_text(v) for v in args),
+}
+
+
+def _compare(op, a, b):
+    # Excel では 数値 < 文字列 < 論理値 の順で、文字列は大文字小文字を区別しない
+    def key(v):
+        if v is None:
+            v = 0
+        if isinstance(v, bool):
+            return (2, v)
+        if isinstance(v, str):
+            return (1, v.lower())
+        return (0, _to_number(v))
+    if isinstance(a, str) and a == "" and b is None or isinstance(b, str) and b == "" and a is None:
+        a = b = ""
+    ops = {"=": operator.eq, "<>": operator.ne, "<": operator.lt,
+           ">": operator.gt, "<=": operator.le, ">=": operator.ge}
+    return ops[op](key(a), key(b))
+
+
+def _binary(op, a, b):
+    if isinstance(a, _Range) and len(a.values) == 1:
+        a = a.values[0]
+    if isinstance(b, _Range) and len(b.values) == 1:
+        b = b.values[0]
+    if _is_error(a):
+        raise _ErrorValue(ExcelError(a))
+    if _is_error(b):
+        raise _ErrorValue(ExcelError(b))
+    if op == "&":
+        return _to_text(a) + _to_text(b)
+    if op in ("=", "<>", "<", ">", "<=", ">="):
+        return _compare(op, a, b)
+    a = _to_number(a)
+    b = _to_number(b)
+    if op == "+":
+        return a + b
+    if op == "-":
+        return a - b
+    if op == "*":
+        return a * b
+    if op == "/":
+        if b == 0:
+            raise _ErrorValue(ExcelError("#DIV/0!"))
+        return a / b
+    if op == "^":
+        return _power(a, b)
+    raise Unsupported("Operator {} is not supported".format(op))
+
+
+def _normalize(value):
+    # 整数の値は openpyxl と同じく int にする
+    if isinstance(value, complex):
+        return ExcelError("#NUM!")
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return ExcelError("#NUM!")
+        if value.is_integer() and abs(value) < 1e15:
+            return int(value)
+    return value
+
+
+class Evaluator:
+    """Evaluator of formula cells of a DualWorkbook.
+
+    Computed values are memoized.
+    The dependency graph is built while cells are computed,
+    and set_value recomputes only the cells which depend on the changed cell.
+    If use_cached is True, the cached values of formula cells are used as they are.
+    The cells a formula refers to are computed first in dependency order with an explicit stack,
+    so long chains of references do not exceed the recursion limit.
+    計算した値は保持されます。
+    セルを計算しながら依存関係のグラフを作り、
+    set_value は変更したセルに依存するセルだけを再計算の対象にします。
+    use_cached が True の場合、数式のセルに保存された値があればそれを使います。
+    数式が参照するセルは、明示的なスタックを使って依存関係の順に先に計算するので、
+    長い参照の連鎖でも再帰の上限を超えません。
+
+    Args:
+        book (util.xlsxreader.DualWorkbook): workbook
+        use_cached (bool, optional): use cached values of formula cells.
+            Defaults to True.
+    """
+
+    def __init__(self, book, use_cached=True):
+        self.book = book
+        self.use_cached = use_cached
+        self.memo = {}
+        # (sheet, row, column) -> そのセルが参照するセルの集合
+        self.precedents = {}
+        # (sheet, row, column) -> そのセルを参照するセルの集合
+        self.dependents = {}
+        self._visiting = set()
+        self._preparing = False
+
+    def value(self, sheet, addr):
+        """Returns the value of a cell, computing the formula if needed.
+
+        セルの値を返します。必要であれば数式を計算します。
+
+        Args:
+            sheet (str): sheet name
+            addr (str): Excel style cell address.
+
+        Returns:
+            object: value, ExcelError for an Excel error
+
+        Raises:
+            Unsupported: if the formula cannot be computed
+        """
+        row, column = openpyxl.utils.cell.coordinate_to_tuple(addr)
+        return self._cell((sheet, row, column))
+
+    def set_value(self, sheet, addr, value):
+        """Change the value of a cell and forget the values which depend on it.
+
+        セルの値を変更し、そのセルに依存する計算済みの値を消します。
+        """
+        row, column = openpyxl.utils.cell.coordinate_to_tuple(addr)
+        key = (sheet, row, column)
+        self.book[sheet].cells[(row, column)] = (value, value)
+        stack = [key]
+        while stack:
+            cur = stack.pop()
+            self.memo.pop(cur, None)
+            for dep in self.dependents.get(cur, ()):
+                if dep in self.memo:
+                    stack.append(dep)
+
+    def _formula(self, key):
+        # 計算が必要な数式のセルなら数式の文字列を返す
+        sheet, row, column = key
+        if key in self.memo or sheet not in self.book:
+            return None
+        pair = self.book[sheet].cells.get((row, column))
+        if pair is None:
+            return None
+        value, formula = pair
+        text = util.formula.formula_text(formula)
+        if text is None or not isinstance(formula, str) or \
+                (self.use_cached and value is not None):
+            return None
+        return text
+
+    def _references(self, key, text):
+        # 数式が参照する、計算が必要なセル
+        try:
+            tree = util.formula.parse_formula(text).tree
+        except ValueError:
+            return []
+        keys = []
+        for node in util.formula.walk(tree):
+            if node[0] != "ref":
+                continue
+            try:
+                for ref_key in self._ref_keys(node[1], key[0]):
+                    if self._formula(ref_key) is not None:
+                        keys.append(ref_key)
+            except (ValueError, _ErrorValue):
+                continue
+        return keys
+
+    def _prepare(self, key, text):
+        # 参照先の数式のセルを深さ優先の後順 (依存関係の順) に並べ、再帰を使わずに先に計算する
+        order = []
+        seen = {key}
+        stack = [(key, iter(self._references(key, text)))]
+        while stack:
+            cur, refs = stack[-1]
+            for ref_key in refs:
+                if ref_key not in seen:
+                    seen.add(ref_key)
+                    stack.append((ref_key, iter(self._references(ref_key, self._formula(ref_key)))))
+                    break
+            else:
+                stack.pop()
+                if cur != key:
+                    order.append(cur)
+        self._preparing = True
+        try:
+            for ref_key in order:
+                try:
+                    self._cell(ref_key)
+                except (Unsupported, _ErrorValue):
+                    # 計算できないセルは、本当に必要になったときに改めてエラーにする
+                    pass
+        finally:
+            self._preparing = False
+
+    def _cell(self, key):
+        if key in self.memo:
+            return self.memo[key]
+        sheet, row, column = key
+        if sheet not in self.book:
+            raise _ErrorValue(ExcelError("#REF!"))
+        pair = self.book[sheet].cells.get((row, column))
+        if pair is None:
+            return None
+        text = self._formula(key)
+        if text is None:
+            return pair[0]
+        if key in self._visiting:
+            raise Unsupported("Circular reference at {}".format(key))
+        if not self._preparing and not self._visiting:
+            self._prepare(key, text)
+        self._visiting.add(key)
+        try:
+            parsed = util.formula.parse_formula(text)
+            self.precedents[key] = set()
+            try:
+                result = _normalize(self._eval(parsed.tree, sheet, key))
+            except _ErrorValue as e:
+                result = e.error
+            if isinstance(result, _Range):
+                if len(result.values) != 1:
+                    raise Unsupported("Array result at {}".format(key))
+                result = result.values[0]
+        except ValueError as e:
+            raise Unsupported(str(e))
+        finally:
+            self._visiting.discard(key)
+        self.memo[key] = result
+        return result
+
+    def _ref(self, ref, sheet, owner):
+        values = []
+        for key in self._ref_keys(ref, sheet):
+            self.precedents[owner].add(key)
+            self.dependents.setdefault(key, set()).add(owner)
+            values.append(self._cell(key))
+        if ":" not in ref:
+            return values[0]
+        return _Range(values)
+
+    def _ref_keys(self, ref, sheet):
+        if "!" in ref:
+            sheet, ref = ref.rsplit("!", 1)
+            if sheet.startswith("'"):
+                sheet = sheet[1:-1].replace("''", "'")
+        ref = ref.replace("$", "")
+        (min_col, min_row, max_col,
+         max_row) = openpyxl.utils.cell.range_boundaries(ref)
+        if None in (min_col, min_row, max_col, max_row):
+            if sheet not in self.book:
+                raise _ErrorValue(ExcelError("#REF!"))
+            # 列全体・行全体の参照は値のある範囲に限る
+            min_col = min_col or 1
+            min_row = min_row or 1
+            max_col = max_col or self.book[sheet].max_column
+            max_row = max_row or self.book[sheet].max_row
+        return [(sheet, r, c) for r in range(min_row, max_row + 1)
+                for c in range(min_col, max_col + 1)]
+
+    def _eval(self, node, sheet, owner):
+        kind = node[0]
+        if kind in ("number", "text", "bool"):
+            return node[1]
+        if kind == "error":
+            return ExcelError(node[1])
+        if kind == "ref":
+            try:
+                return self._ref(node[1], sheet, owner)
+            except ValueError:
+                raise Unsupported("Reference {} is not supported".format(node[1]))
+        if kind == "op":
+            left = self._eval(node[2][0], sheet, owner)
+            right = self._eval(node[2][1], sheet, owner)
+            return _binary(node[1], left, right)
+        if kind == "prefix":
+            value = _to_number(self._eval(node[2], sheet, owner))
+            return -value if node[1] == "-" else value
+        if kind == "postfix":
+            return _to_number(self._eval(node[2], sheet, owner)) / 100
+        if kind == "func":
+            return self._call(node, sheet, owner)
+        raise Unsupported("{} is not supported".format(kind))
+
+    def _call(self, node, sheet, owner):
+        name, args = node[1], node[2]
+        if name == "IF":
+            # 選ばれなかった方は計算しない
+            if len(args) not in (2, 3):
+                raise _ErrorValue(ExcelError("#VALUE!"))
+            cond = self._eval(args[0], sheet, owner)
+            if _to_bool(cond):
+                branch = args[1]
+            elif len(args) == 3:
+                branch = args[2]
+            else:
+                return False
+            return 0 if branch[0] == "empty" else self._eval(branch, sheet, owner)
+        if name == "IFERROR":
+            try:
+                value = self._eval(args[0], sheet, owner)
+                if not _is_error(value):
+                    return value
+            except _ErrorValue:
+                pass
+            return self._eval(args[1], sheet, owner)
+        if name not in FUNCTIONS:
+            raise Unsupported("Function {} is not supported".format(name))
+        values = [None if arg[0] == "empty" else self._eval(arg, sheet, owner) for arg in args]
+        try:
+            return FUNCTIONS[name](*values)
+        except TypeError:
+            # 引数の数が違う
+            raise _ErrorValue(ExcelError("#VALUE!"))
+
+
+def missing_values(book, ranges=None):
+    """List formula cells which have no cached value.
+
+    保存された値の無い数式のセルを列挙します。
+
+    Args:
+        book (util.xlsxreader.DualWorkbook): workbook
+        ranges (dict, optional): sheet name to sequence of Excel style cell ranges.
+            Defaults to None, which means all cells of all sheets.
+
+    Returns:
+        list of (sheet, row, column)
+    """
+    missing = []
+    for sheet in book.sheetnames:
+        if ranges is not None and sheet not in ranges:
+            continue
+        bounds = None
+        if ranges is not None:
+            bounds = [openpyxl.utils.cell.range_boundaries(r) for r in ranges[sheet]]
+        for (row, column), (value, formula) in book[sheet].cells.items():
+            if value is not None or util.formula.formula_text(formula) is None:
+                continue
+            if bounds is not None and \
+                not any((min_col or 1) <= column <= (max_col or column) and
+                        (min_row or 1) <= row <= (max_row or row)
+                        for (min_col, min_row, max_col, max_row) in bounds):
+                continue
+            missing.append((sheet, row, column))
+    return sorted(missing)
+
+
+def fill_missing_values(book, ranges=None):
+    """Compute formula cells which have no cached value and store the values.
+
+    Only the formula cells in the ranges and the cells they depend on are computed.
+    Cells which cannot be computed are left as None.
+    保存された値の無い数式のセルを計算し、その値を保存します。
+    範囲内の数式のセルと、それが参照するセルだけを計算します。
+    計算できないセルは None のままです。
+
+    Args:
+        book (util.xlsxreader.DualWorkbook): workbook
+        ranges (dict, optional): sheet name to sequence of Excel style cell ranges.
+            Defaults to None, which means all cells of all sheets.
+
+    Returns:
+        list of (sheet, row, column): cells whose values are filled
+    """
+    evaluator = Evaluator(book)
+    filled = []
+    for sheet, row, column in missing_values(book, ranges):
+        try:
+            result = evaluator._cell((sheet, row, column))
+        except (Unsupported, RecursionError):
+            # 数式そのものが深く入れ子になっている場合も計算しない
+            continue
+        if isinstance(result, ExcelError):
+            # openpyxl と同じく、エラー値は文字列として保存する
+            result = str(result)
+        cells = book[sheet].cells
+        cells[(row, column)] = (result, cells[(row, column)][1])
+        filled.append((sheet, row, column))
+    return filled
@@ -0,0 +1,246 @@
+"""Content-addressed cache of grading results.
+
+A result row is stored with the hash of the submission bytes
+and the hash of the rubric and the check functions.
+When a submission has not changed, the stored row is returned
+and the file is not parsed again.
+Any file type (xlsx, docx, pptx, eml, ...) can be cached.
+採点結果の行を、提出ファイルの中身のハッシュと、
+ルーブリックとチェック関数のハッシュをキーとして保存します。
+提出ファイルが変わっていなければ保存した行を返し、ファイルを再び解析しません。
+どの種類のファイル (xlsx, docx, pptx, eml など) でも使えます。
+
+Example:
+    cache = util.gradecache.GradeCache("grading_cache.sqlite3")
+    key = util.gradecache.rubric_key(rubric, modules=[util.excelutil])
+    row = cache.get(filepath, key)
+    if row is None:
+        row = plan.grade(filepath)
+        cache.put(filepath, key, row)
+
+The cache can be cleared from the command line.
+コマンドラインからキャッシュを消去できます。
+    python -m util.gradecache invalidate grading_cache.sqlite3
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import pathlib
+import pickle
+import sqlite3
+import time
+
+
+def file_hash(filepath, blocksize=1 << 20):
+    """Returns the sha256 hash of the file contents.
+
+    ファイルの中身の sha256 ハッシュを返します。
+
+    Args:
+        filepath (str | pathlib.Path): file
+        blocksize (int, optional): size of a block read at once.
+            Defaults to 1 MiB.
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    with pathlib.Path(filepath).open("rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def rubric_key(rubric, modules=(), version=""):
+    """Returns the hash of a rubric and the check functions.
+
+    The key changes when the rubric, the source of the modules or version changes.
+    ルーブリック、モジュールのソース、version のいずれかが変わるとキーも変わります。
+
+    Args:
+        rubric (object): rubric which can be dumped as JSON
+        modules (sequence of module, optional): modules of the check functions
+            example: [util.excelutil]
+        version (str, optional): any extra version string
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps(rubric, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    for module in modules:
+        h.update(inspect.getsource(module).encode("utf-8"))
+    h.update(version.encode("utf-8"))
+    return h.hexdigest()
+
+
+class GradeCache:
+    """Persistent cache of result rows in an SQLite file.
+
+    When the stored rows exceed max_bytes,
+    the least recently used rows are removed.
+    保存した行が max_bytes を超えると、最も長く使われていない行から削除します。
+
+    Args:
+        dbpath (str | pathlib.Path): SQLite file
+        max_bytes (int, optional): maximum total size of the stored rows.
+            Defaults to 64 MiB. None means no limit.
+    """
+
+    def __init__(self, dbpath, max_bytes=64 * 1024 * 1024):
+        self.dbpath = str(dbpath)
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(self.dbpath)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS results (
+                file_hash TEXT NOT NULL,
+                rubric_key TEXT NOT NULL,
+                row BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (file_hash, rubric_key)
+            );
+            CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                file_hash TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def hash_of(self, filepath):
+        """Returns the hash of a file.
+
+        The hash is reused while the size and the mtime of the file do not change.
+        ファイルのサイズと更新日時が変わらない間は、前回のハッシュを再利用します。
+
+        Args:
+            filepath (str | pathlib.Path): file
+
+        Returns:
+            str: hex digest
+        """
+        path = str(pathlib.Path(filepath).absolute())
+        st = os.stat(path)
+        cur = self.conn.execute(
+            "SELECT file_hash FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (path, st.st_size, st.st_mtime_ns))
+        found = cur.fetchone()
+        if found is not None:
+            return found[0]
+        digest = file_hash(path)
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                          (path, st.st_size, st.st_mtime_ns, digest))
+        self.conn.commit()
+        return digest
+
+    def get(self, filepath, key):
+        """Returns the stored row or None.
+
+        保存した行を返します。無ければ None を返します。
+
+        Args:
+            filepath (str | pathlib.Path): submitted file
+            key (str): key made by rubric_key
+
+        Returns:
+            dict | None: result row
+        """
+        digest = self.hash_of(filepath)
+        cur = self.conn.execute(
+            "SELECT row FROM results WHERE file_hash = ? AND rubric_key = ?", (digest, key))
+        found = cur.fetchone()
+        if found is None:
+            return None
+        self.conn.execute(
+            "UPDATE results SET last_used = ? WHERE file_hash = ? AND rubric_key = ?",
+            (time.time(), digest, key))
+        self.conn.commit()
+        return pickle.loads(found[0])
+
+    def put(self, filepath, key, row):
+        """Store a row.
+
+        行を保存します。
+
+        Args:
+            filepath (str | pathlib.Path): submitted file
+            key (str): key made by rubric_key
+            row (dict): result row
+        """
+        digest = self.hash_of(filepath)
+        blob = pickle.dumps(row)
+        self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                          (digest, key, blob, len(blob), time.time()))
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used rows until the size is within max_bytes.
+
+        サイズが max_bytes 以下になるまで、最も長く使われていない行を削除します。
+        """
+        if self.max_bytes is None:
+            return
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        cur = self.conn.execute("SELECT file_hash, rubric_key, size FROM results ORDER BY last_used")
+        removed = []
+        for digest, key, size in cur:
+            if total <= self.max_bytes:
+                break
+            removed.append((digest, key))
+            total -= size
+        self.conn.executemany("DELETE FROM results WHERE file_hash = ? AND rubric_key = ?", removed)
+        self.conn.commit()
+
+    def invalidate(self, key=None):
+        """Remove stored rows.
+
+        保存した行を削除します。
+
+        Args:
+            key (str, optional): remove only the rows of this key.
+                Defaults to None, which means all rows.
+
+        Returns:
+            int: number of removed rows
+        """
+        if key is None:
+            cur = self.conn.execute("DELETE FROM results")
+            self.conn.execute("DELETE FROM files")
+        else:
+            cur = self.conn.execute("DELETE FROM results WHERE rubric_key = ?", (key,))
+        self.conn.commit()
+        return cur.rowcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m util.gradecache",
+                                     description="Grading result cache")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_inv = sub.add_parser("invalidate", help="remove stored rows")
+    p_inv.add_argument("dbpath")
+    p_inv.add_argument("--key", default=None, help="remove only the rows of this rubric key")
+    args = parser.parse_args(argv)
+    if args.command == "invalidate":
+        with GradeCache(args.dbpath) as cache:
+            print("removed {} rows".format(cache.invalidate(args.key)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,570 @@
+"""Messages of a whole mailbox, read one by one.
+
+A course mailbox exported as one mbox file or one Maildir directory
+is read message by message without splitting it into .eml files.
+Only one message is held in memory at a time,
+and each message is given as a util.emailutil.ParsedEml
+with the same header, body and attachment accessors as an .eml file.
+Messages can be processed by worker processes with map_messages.
+Messages on an IMAP server are read with ImapSource,
+which fetches the headers first and the whole message only when the headers pass a filter.
+1つの mbox ファイルや Maildir ディレクトリとして書き出された授業のメールボックスを、
+.eml ファイルに分割せずにメッセージごとに読みます。
+メモリに保持するのは一度に1つのメッセージだけで、
+各メッセージは .eml ファイルと同じヘッダー、本文、添付ファイルの取得方法を持つ
+util.emailutil.ParsedEml として返します。
+map_messages を使うとワーカープロセスでメッセージを処理できます。
+IMAP サーバーのメッセージは ImapSource で読みます。
+ImapSource は先にヘッダーだけを取得し、ヘッダーが条件を満たすメッセージだけ全体を取得します。
+
+Example:
+    for key, eml in util.mailsource.iter_messages("course.mbox"):
+        headerdata = eml.get_header(["From", "To", "Cc", "Subject"])
+        messagedata = eml.get_messagebody()
+"""
+import collections
+import concurrent.futures
+import contextlib
+import email.parser
+import email.policy
+import imaplib
+import mailbox
+import os
+import pathlib
+import queue
+import re
+import sqlite3
+import threading
+import util.emailutil
+from logging import getLogger, StreamHandler, DEBUG, INFO
+logger = getLogger(__name__)
+handler = StreamHandler()
+loglevel = INFO
+handler.setLevel(loglevel)
+logger.setLevel(loglevel)
+logger.addHandler(handler)
+logger.propagate = False
+
+
+def iter_mbox(mboxpath):
+    """Yield the raw messages of an mbox file.
+
+    The file is read line by line and a message starts at a line beginning with "From ",
+    in the same way as mailbox.mbox.
+    ファイルを1行ずつ読み、mailbox.mbox と同じく "From " で始まる行をメッセージの始まりとします。
+
+    Args:
+        mboxpath (str | pathlib.Path): mbox file
+
+    Yields:
+        (key, data) : key (int) index of the message, data (bytes) message without the "From " line
+    """
+    key = 0
+    lines = None
+    with pathlib.Path(mboxpath).open("rb") as f:
+        for line in f:
+            if line.startswith(b"From "):
+                if lines is not None:
+                    yield key, _join_message(lines)
+                    key += 1
+                lines = []
+            elif lines is not None:
+                lines.append(line)
+    if lines is not None:
+        yield key, _join_message(lines)
+
+
+def _join_message(lines):
+    # メッセージの区切りの空行は含めない
+    if lines and lines[-1] in (b"\n", b"\r\n"):
+        lines.pop()
+    return b"".join(lines)
+
+
+def iter_maildir(maildirpath):
+    """Yield the raw messages of a Maildir directory in the order of the keys.
+
+    Maildir ディレクトリのメッセージをキーの順に返します。
+
+    Args:
+        maildirpath (str | pathlib.Path): Maildir directory with cur and new
+
+    Yields:
+        (key, data) : key (str) key of the message, data (bytes) message
+    """
+    box = mailbox.Maildir(str(maildirpath), factory=None, create=False)
+    for key in sorted(box.iterkeys()):
+        try:
+            data = box.get_bytes(key)
+        except KeyError:
+            # 読んでいる間に移動や削除されたメッセージ
+            logger.warning("Message {} was removed".format(key))
+            continue
+        yield key, data
+
+
+def is_maildir(path):
+    """Tells whether the path is a Maildir directory.
+
+    Maildir ディレクトリかどうかを返します。
+
+    Args:
+        path (str | pathlib.Path): mbox file or Maildir directory
+
+    Returns:
+        bool
+    """
+    path = pathlib.Path(path)
+    return (path / "cur").is_dir() and (path / "new").is_dir()
+
+
+def iter_raw(path):
+    """Yield the raw messages of an mbox file or a Maildir directory.
+
+    mbox ファイルか Maildir ディレクトリのメッセージをそのまま返します。
+
+    Args:
+        path (str | pathlib.Path): mbox file or Maildir directory
+
+    Yields:
+        (key, data) : key (int | str), data (bytes)
+    """
+    if is_maildir(path):
+        yield from iter_maildir(path)
+    else:
+        yield from iter_mbox(path)
+
+
+def iter_messages(path):
+    """Yield the parsed messages of an mbox file or a Maildir directory.
+
+    mbox ファイルか Maildir ディレクトリの解析したメッセージを返します。
+
+    Args:
+        path (str | pathlib.Path): mbox file or Maildir directory
+
+    Yields:
+        (key, eml) : key (int | str), eml (util.emailutil.ParsedEml)
+    """
+    for key, data in iter_raw(path):
+        yield key, util.emailutil.ParsedEml.from_bytes(data)
+
+
+def _apply(func, data):
+    return func(util.emailutil.ParsedEml.from_bytes(data))
+
+
+def map_messages(func, path, workers=None, max_pending=None, initializer=None, initargs=()):
+    """Process the messages of a mailbox with worker processes.
+
+    func is called with a util.emailutil.ParsedEml in a worker process.
+    Results are yielded in the order of the messages.
+    At most max_pending messages are sent to the workers at once,
+    so the mailbox is not read into memory.
+    If workers is 1, the messages are processed in this process.
+    func はワーカープロセスで util.emailutil.ParsedEml を引数に呼ばれます。
+    結果はメッセージの順番に返します。
+    ワーカーに一度に送るメッセージは max_pending 個までなので、
+    メールボックス全体をメモリに読み込むことはありません。
+    workers が 1 の場合はこのプロセスで処理します。
+
+    Example:
+        def check(eml):
+            return "teacher@example.com" in (eml.get_header(["To"])["To"] or "")
+
+        for key, result in util.mailsource.map_messages(check, "course.mbox"):
+            print(key, result)
+
+    Args:
+        func (callable): function defined at the top level of a module
+        path (str | pathlib.Path): mbox file or Maildir directory
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means os.cpu_count().
+        max_pending (int, optional): number of messages sent to the workers at once.
+            Defaults to None, which means 4 times workers.
+        initializer (callable, optional): called with initargs once in each worker.
+            Defaults to None.
+        initargs (tuple, optional): arguments of initializer. Defaults to ().
+
+    Yields:
+        (key, result) : key (int | str), result (object) return value of func
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for key, data in iter_raw(path):
+            yield key, _apply(func, data)
+        return
+    if max_pending is None:
+        max_pending = 4 * workers
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                                                initargs=initargs) as executor:
+        pending = collections.deque()
+        for key, data in iter_raw(path):
+            pending.append((key, executor.submit(_apply, func, data)))
+            if len(pending) >= max_pending:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+
+class ImapPool:
+    """Small pool of IMAP connections logged in and with the mailbox selected.
+
+    The mailbox is selected read-only, so fetching does not set the \\Seen flag.
+    A connection which raised an error is closed and not returned to the pool.
+    メールボックスは読み取り専用で選択するので、取得しても既読になりません。
+    エラーの起きた接続は閉じ、プールには戻しません。
+
+    Args:
+        host (str): IMAP server
+        user (str): user name
+        password (str): password
+        mailbox (str, optional): mailbox name. Defaults to "INBOX".
+        port (int, optional): port. Defaults to None, which means 993 with SSL and 143 without.
+        ssl (bool, optional): use IMAP over SSL. Defaults to True.
+        size (int, optional): maximum number of connections. Defaults to 4.
+        timeout (float, optional): socket timeout in seconds. Defaults to 60.
+    """
+
+    def __init__(self, host, user, password, mailbox="INBOX", port=None, ssl=True, size=4,
+                 timeout=60):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.mailbox = mailbox
+        self.port = port if port is not None else (993 if ssl else 143)
+        self.ssl = ssl
+        self.size = size
+        self.timeout = timeout
+        self.uidvalidity = None
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(size)
+
+    def _open(self):
+        if self.ssl:
+            conn = imaplib.IMAP4_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            conn = imaplib.IMAP4(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.login(self.user, self.password)
+            typ, data = conn.select(_quote(self.mailbox), readonly=True)
+            if typ != "OK":
+                raise imaplib.IMAP4.error("Cannot select {}: {}".format(self.mailbox, data))
+            typ, data = conn.response("UIDVALIDITY")
+            if data and data[0] is not None:
+                self.uidvalidity = int(data[0])
+        except Exception:
+            conn.shutdown()
+            raise
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection. Waits while all connections are in use.
+
+        接続を借ります。全ての接続が使われている間は待ちます。
+
+        Yields:
+            imaplib.IMAP4
+        """
+        with self._slots:
+            conn = None
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            if conn is None:
+                conn = self._open()
+            try:
+                yield conn
+            except BaseException:
+                _logout(conn)
+                raise
+            self._idle.put(conn)
+
+    def close(self):
+        """Log out of all idle connections.
+
+        使っていない全ての接続からログアウトします。
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _logout(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _quote(mailbox):
+    if re.fullmatch(r"[A-Za-z0-9_.\-/]+", mailbox):
+        return mailbox
+    return '"{}"'.format(mailbox.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def _logout(conn):
+    try:
+        conn.logout()
+    except Exception:
+        pass
+
+
+def _uid_set(uids):
+    # 連続した UID を 1:5 のようにまとめる
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(a) if a == b else "{}:{}".format(a, b) for a, b in ranges)
+
+
+_FETCH_UID = re.compile(rb"UID (\d+)")
+
+
+def _fetched(data):
+    # imaplib の FETCH の応答から UID とリテラルの組を取り出す
+    for item in data:
+        if isinstance(item, tuple):
+            found = _FETCH_UID.search(item[0])
+            if found is not None:
+                yield int(found.group(1)), item[1]
+
+
+class UidCheckpoint:
+    """Last fetched UID of each mailbox, saved in an SQLite file.
+
+    When the UIDVALIDITY of the mailbox changes, the UIDs are no longer valid
+    and the checkpoint starts again from the beginning.
+    メールボックスごとに最後に取得した UID を SQLite ファイルに保存します。
+    メールボックスの UIDVALIDITY が変わると UID は無効になるので、最初からやり直します。
+
+    Args:
+        dbpath (str | pathlib.Path): SQLite file
+    """
+
+    def __init__(self, dbpath):
+        self.conn = sqlite3.connect(str(dbpath), check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                mailbox TEXT PRIMARY KEY,
+                uidvalidity INTEGER NOT NULL,
+                last_uid INTEGER NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, mailbox, uidvalidity):
+        """Returns the last fetched UID, or 0.
+
+        最後に取得した UID を返します。無ければ 0 を返します。
+
+        Args:
+            mailbox (str): name like "user@host/INBOX"
+            uidvalidity (int | None): current UIDVALIDITY of the mailbox
+
+        Returns:
+            int
+        """
+        found = self.conn.execute(
+            "SELECT uidvalidity, last_uid FROM checkpoints WHERE mailbox = ?",
+            (mailbox,)).fetchone()
+        if found is None or found[0] != (uidvalidity or 0):
+            return 0
+        return found[1]
+
+    def put(self, mailbox, uidvalidity, last_uid):
+        """Save the last fetched UID.
+
+        最後に取得した UID を保存します。
+
+        Args:
+            mailbox (str): name like "user@host/INBOX"
+            uidvalidity (int | None): current UIDVALIDITY of the mailbox
+            last_uid (int): last fetched UID
+        """
+        self.conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)",
+                          (mailbox, uidvalidity or 0, last_uid))
+        self.conn.commit()
+
+
+class ImapSource:
+    """Messages of an IMAP mailbox, fetched header first.
+
+    The headers of new messages are fetched with BODY.PEEK[HEADER]
+    in batches over the pooled connections at the same time.
+    Only the messages whose headers pass header_filter are fetched whole with BODY.PEEK[].
+    With a UidCheckpoint, the messages fetched before are skipped.
+    新しいメッセージのヘッダーを BODY.PEEK[HEADER] で、
+    プールの接続を同時に使ってまとめて取得します。
+    header_filter を満たすメッセージだけを BODY.PEEK[] で全体を取得します。
+    UidCheckpoint を使うと、前に取得したメッセージは飛ばします。
+
+    Example:
+        with util.mailsource.ImapPool("imap.example.com", "course", "secret") as pool, \\
+                util.mailsource.UidCheckpoint("imap.sqlite3") as checkpoint:
+            source = util.mailsource.ImapSource(pool, checkpoint)
+            wanted = lambda headers: "teacher@example.com" in str(headers["To"] or "")
+            for uid, eml in source.iter_messages(header_filter=wanted):
+                print(uid, eml.get_header(["From", "Subject"]))
+
+    Args:
+        pool (ImapPool): connections
+        checkpoint (UidCheckpoint, optional): last fetched UID. Defaults to None.
+        batch_size (int, optional): number of messages fetched by one command.
+            Defaults to 100.
+    """
+
+    def __init__(self, pool, checkpoint=None, batch_size=100):
+        self.pool = pool
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.name = "{}@{}/{}".format(pool.user, pool.host, pool.mailbox)
+
+    def last_uid(self):
+        """Returns the last UID in the checkpoint, or 0.
+
+        チェックポイントの最後の UID を返します。無ければ 0 を返します。
+
+        Returns:
+            int
+        """
+        if self.checkpoint is None:
+            return 0
+        return self.checkpoint.get(self.name, self.pool.uidvalidity)
+
+    def new_uids(self):
+        """Returns the UIDs of the messages after the checkpoint.
+
+        チェックポイントより後のメッセージの UID を返します。
+
+        Returns:
+            list of int: sorted UIDs
+        """
+        with self.pool.connection() as conn:
+            last = self.last_uid()
+            typ, data = conn.uid("SEARCH", None, "UID {}:*".format(last + 1))
+        if typ != "OK":
+            raise imaplib.IMAP4.error("UID SEARCH failed: {}".format(data))
+        # n:* は n より大きい UID が無くても最大の UID を返すので除く
+        return sorted(uid for uid in map(int, b" ".join(data).split()) if uid > last)
+
+    def _fetch_batch(self, uids, item):
+        with self.pool.connection() as conn:
+            typ, data = conn.uid("FETCH", _uid_set(uids), "(UID {})".format(item))
+        if typ != "OK":
+            raise imaplib.IMAP4.error("UID FETCH failed: {}".format(data))
+        return dict(_fetched(data))
+
+    def _batches(self, uids):
+        return [uids[i:i + self.batch_size] for i in range(0, len(uids), self.batch_size)]
+
+    def _fetch(self, uids, item):
+        # バッチを同時に取得し、UID の順にバッチごとに返す
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            futures = [(batch, executor.submit(self._fetch_batch, batch, item))
+                       for batch in self._batches(uids)]
+            for batch, future in futures:
+                yield batch, future.result()
+
+    def fetch_headers(self, uids):
+        """Fetch the headers of messages.
+
+        メッセージのヘッダーを取得します。
+
+        Args:
+            uids (list of int): UIDs
+
+        Returns:
+            dict: UID to email.message.EmailMessage with only the headers
+        """
+        parser = email.parser.BytesHeaderParser(policy=email.policy.default)
+        headers = {}
+        for _, fetched in self._fetch(sorted(uids), "BODY.PEEK[HEADER]"):
+            for uid, data in fetched.items():
+                headers[uid] = parser.parsebytes(data)
+        return headers
+
+    def fetch_messages(self, uids):
+        """Fetch whole messages.
+
+        メッセージ全体を取得します。
+
+        Args:
+            uids (list of int): UIDs
+
+        Yields:
+            (uid, data) : uid (int), data (bytes) in the order of the UIDs
+        """
+        for batch, fetched in self._fetch(sorted(uids), "BODY.PEEK[]"):
+            for uid in batch:
+                if uid in fetched:
+                    yield uid, fetched[uid]
+
+    def iter_messages(self, header_filter=None):
+        """Yield new messages which pass the header filter.
+
+        The checkpoint is saved after the messages of each batch are yielded,
+        so messages after the last saved batch are fetched again after a crash.
+        ヘッダーが条件を満たす新しいメッセージを返します。
+        チェックポイントはバッチごとにメッセージを返した後で保存するので、
+        途中で止まった場合は最後に保存したバッチより後のメッセージを再び取得します。
+
+        Args:
+            header_filter (callable, optional): function which takes the headers
+                (email.message.EmailMessage) and returns bool. Defaults to None.
+
+        Yields:
+            (uid, eml) : uid (int), eml (util.emailutil.ParsedEml)
+        """
+        uids = self.new_uids()
+        if not uids:
+            return
+        if header_filter is not None:
+            headers = self.fetch_headers(uids)
+            wanted = [uid for uid in uids if uid in headers and header_filter(headers[uid])]
+        else:
+            wanted = uids
+        wanted_set = set(wanted)
+        # 本文はプールの接続の数だけ先にバッチを取得し、UID の順に返す
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            pending = collections.deque()
+            batches = iter(self._batches(uids))
+            while True:
+                while len(pending) < self.pool.size:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    selected = [uid for uid in batch if uid in wanted_set]
+                    future = executor.submit(self._fetch_batch, selected, "BODY.PEEK[]") \
+                        if selected else None
+                    pending.append((batch, selected, future))
+                if not pending:
+                    break
+                batch, selected, future = pending.popleft()
+                fetched = future.result() if future is not None else {}
+                for uid in selected:
+                    if uid in fetched:
+                        yield uid, util.emailutil.ParsedEml.from_bytes(fetched[uid])
+                if self.checkpoint is not None:
+                    self.checkpoint.put(self.name, self.pool.uidvalidity, batch[-1])
@@ -1,7 +1,21 @@
 from pathlib import Path
 import os
+import collections
+import concurrent.futures
+import fnmatch
+import functools
+import hashlib
+import io
+import sqlite3
+import struct
+import threading
+import time
 import msoffcrypto
+import msoffcrypto.exceptions
+import olefile
 from msoffcrypto.format.ooxml import OOXMLFile
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+import util.gradecache
 from logging import getLogger, StreamHandler, DEBUG, INFO
 logger = getLogger(__name__)
 handler = StreamHandler()
@@ -13,6 +27,16 @@ logger.propagate = False
 # reference https://qiita.com/amedama/items/b856b2f30c2f38665701
 # https://docs.python.org/ja/3/howto/logging.html
 
+# 暗号化・復号の結果
+STATUS_OK = "ok"
+STATUS_WRONG_PASSWORD = "wrong password"
+STATUS_NOT_ENCRYPTED = "not encrypted"
+STATUS_ALREADY_ENCRYPTED = "already encrypted"
+STATUS_CORRUPT = "corrupt"
+STATUS_ERROR = "error"
+
+OFFICE_EXTENSIONS = (".xlsx", ".docx", ".pptx")
+
 
 def listfiles(rootdir, ext=None):
     """List all files in some directory.
@@ -23,20 +47,400 @@ def listfiles(rootdir, ext=None):
         filelist = listfiles("./", ".py")
     Args:
         rootdir (str | pathlib.Path): directory name 
-        ext (str, optional): file extention which you want to list.
+        ext (str | tuple of str, optional): file extention which you want to list.
             Defaults to None.
 
     Returns:
         list(pathlib.Path): list of files
     """
-    adir = Path(rootdir).absolute()
+    return list(iterfiles(rootdir, ext=ext))
+
+
+def _matches(name, relpath, patterns):
+    return any(fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(relpath, pattern)
+               for pattern in patterns)
+
 
+def _scan_entries(adir):
+    try:
+        with os.scandir(adir) as it:
+            return sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        logger.warning("Cannot list {}: {}".format(adir, e))
+        return []
+
+
+def _lower_ext(ext):
+    # Windows と同じく拡張子の大文字と小文字を区別しない
     if ext is None:
-        filelist = list(adir.glob("**/*"))
-    else:
-        filelist = list(adir.glob("**/*{}".format(ext)))
+        return None
+    if isinstance(ext, str):
+        return ext.lower()
+    return tuple(e.lower() for e in ext)
+
+
+def _scan(adir, relative, ext, ignore):
+    # DirEntry が持つ種類と stat の情報を使い、Path.is_file() による stat を避ける
+    for entry in _scan_entries(adir):
+        relpath = relative + entry.name
+        if ignore and _matches(entry.name, relpath, ignore):
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _scan(entry.path, relpath + "/", ext, ignore)
+            elif entry.is_file() and (ext is None or entry.name.lower().endswith(ext)):
+                yield entry
+        except OSError as e:
+            logger.warning("Cannot stat {}: {}".format(entry.path, e))
+
+
+def iterfiles(rootdir, ext=None, ignore=None, manifest=None):
+    """Yield files in some directory one by one.
+
+    Files are listed recursively with os.scandir, in the order of the names.
+    The file type known from the directory listing is reused,
+    so files on a network share are listed without stat of each file.
+    With a manifest, only new or changed files are yielded.
+    A yielded file is recorded and saved in the manifest when the next file is requested
+    or the listing finishes, so a file whose processing raised an error is yielded again
+    while the files processed before it are not.
+    os.scandir でディレクトリ以下のファイルを再帰的に、名前の順に1つずつ返します。
+    ディレクトリの一覧から分かるファイルの種類を再利用するので、
+    ネットワーク上の共有フォルダーでもファイルごとに stat をせずに一覧できます。
+    manifest を指定すると、新しいファイルか変更されたファイルだけを返します。
+    返したファイルは次のファイルを求められたときか一覧が終わったときに manifest に記録して保存するので、
+    処理中にエラーになったファイルは再び返し、それより前に処理したファイルは返しません。
+
+    Example:
+        with FileManifest("manifest.sqlite3") as manifest:
+            for filepath in iterfiles("submissions", ext=(".xlsx", ".docx"),
+                                      ignore=["~$*", ".git"], manifest=manifest):
+                grade(filepath)
+
+    Args:
+        rootdir (str | pathlib.Path): directory name
+        ext (str | tuple of str, optional): file extentions which you want to list.
+            Upper and lower cases are not distinguished.
+            Defaults to None, which means all files.
+        ignore (list of str, optional): glob patterns of names or relative paths
+            (with "/" as the separator) of files and directories which are skipped.
+            Defaults to None.
+        manifest (FileManifest, optional): manifest of the files seen before.
+            Defaults to None.
+
+    Yields:
+        pathlib.Path: absolute path of a file
+    """
+    adir = Path(rootdir).absolute()
+    ignore = tuple(ignore) if ignore else ()
+    for entry in _scan(str(adir), "", _lower_ext(ext), ignore):
+        if manifest is None:
+            yield Path(entry.path)
+            continue
+        record = manifest.check(entry)
+        if record is None:
+            continue
+        yield Path(entry.path)
+        # 呼び出し側が次のファイルを求めたので、このファイルの処理は終わっている
+        # 後のファイルでエラーになっても残るように、ファイルごとに保存する
+        manifest.record(record)
+        manifest.commit()
+    if manifest is not None:
+        manifest.commit()
+
+
+class FileManifest:
+    """Persistent manifest of listed files in an SQLite file.
+
+    The path, the size, the mtime and the sha256 hash of each file are stored.
+    A file whose size and mtime have not changed is not read again.
+    A file whose mtime has changed but whose contents are the same is not yielded.
+    The changes are saved when iterfiles has processed each file or commit is called.
+    Uncommitted changes are discarded by close,
+    and by the with statement if an exception is raised.
+    各ファイルのパス、サイズ、更新日時、sha256 ハッシュを保存します。
+    サイズと更新日時が変わっていないファイルは読み直しません。
+    更新日時が変わっても中身が同じファイルは返しません。
+    変更は iterfiles が各ファイルを処理したときか commit を呼んだときに保存されます。
+    保存していない変更は close を呼ぶと破棄されます。
+    with 文で例外が起きた場合も破棄されます。
+
+    Args:
+        dbpath (str | pathlib.Path): SQLite file
+    """
+
+    def __init__(self, dbpath):
+        self.dbpath = str(dbpath)
+        self.conn = sqlite3.connect(self.dbpath)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                file_hash TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        """Close the SQLite file without saving uncommitted changes.
+
+        保存していない変更を破棄して SQLite ファイルを閉じます。
+        """
+        self.conn.rollback()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # 例外が起きなければ保存し、起きた場合は処理が終わっていない記録を破棄する
+        if exc_type is None:
+            self.conn.commit()
+        self.close()
+
+    def commit(self):
+        """Save the changes.
+
+        変更を保存します。
+        """
+        self.conn.commit()
+
+    def get(self, filepath):
+        """Returns the stored (size, mtime_ns, file_hash) of a file or None.
+
+        保存した (size, mtime_ns, file_hash) を返します。無ければ None を返します。
+
+        Args:
+            filepath (str | pathlib.Path): file
+
+        Returns:
+            tuple | None
+        """
+        return self.conn.execute(
+            "SELECT size, mtime_ns, file_hash FROM files WHERE path = ?",
+            (str(Path(filepath).absolute()),)).fetchone()
+
+    def check(self, entry):
+        """Tell whether a file is new or changed, without recording it.
+
+        A file whose mtime has changed but whose contents are the same
+        is recorded with the new mtime, because its contents were processed before.
+        ファイルを記録せずに、新しいか変更されたかどうかを調べます。
+        更新日時が変わっても中身が同じファイルは、その中身を処理済みなので新しい更新日時で記録します。
+
+        Args:
+            entry (os.DirEntry | str | pathlib.Path): file
+
+        Returns:
+            tuple | None: (path, size, mtime_ns, file_hash) to be given to record
+                if the file is new or changed, or None
+        """
+        if isinstance(entry, os.DirEntry):
+            path = entry.path
+            st = entry.stat()
+        else:
+            path = str(Path(entry).absolute())
+            st = os.stat(path)
+        found = self.get(path)
+        if found is not None and found[0] == st.st_size and found[1] == st.st_mtime_ns:
+            return None
+        record = (path, st.st_size, st.st_mtime_ns, util.gradecache.file_hash(path))
+        if found is not None and found[2] == record[3]:
+            self.record(record)
+            return None
+        return record
+
+    def record(self, record):
+        """Record a file returned by check after it is processed.
+
+        check が返したファイルを、処理した後に記録します。
+
+        Args:
+            record (tuple): (path, size, mtime_ns, file_hash) returned by check
+        """
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", record)
 
-    return list(filter(lambda p: p.is_file(), filelist))
+    def update(self, entry):
+        """Record a file and tell whether it is new or changed.
+
+        ファイルを記録し、新しいか変更されたかどうかを返します。
+
+        Args:
+            entry (os.DirEntry | str | pathlib.Path): file
+
+        Returns:
+            bool: True if the file is new or changed
+        """
+        record = self.check(entry)
+        if record is None:
+            return False
+        self.record(record)
+        return True
+
+    def forget(self, filepath):
+        """Remove a file from the manifest so that it is yielded again.
+
+        ファイルを記録から削除し、再び返されるようにします。
+
+        Args:
+            filepath (str | pathlib.Path): file
+        """
+        self.conn.execute("DELETE FROM files WHERE path = ?", (str(Path(filepath).absolute()),))
+
+
+class DirectoryWatcher:
+    """Poll a directory for new or changed files.
+
+    Each poll stats only the directories.
+    A directory whose mtime has not changed is not listed again,
+    so the work of a poll is proportional to the number of directories
+    and the changed files, not to the number of files.
+    A file overwritten in place does not change the mtime of its directory,
+    so all directories are listed again every full_scan_interval seconds.
+    A file is reported after its size and mtime have not changed
+    for settle seconds, so files still being copied are not reported.
+    Reported files are recorded in the manifest when commit is called after they are processed,
+    and a file whose contents have not changed is not reported again.
+    ポーリングのたびに stat するのはディレクトリだけです。
+    更新日時が変わっていないディレクトリは一覧を取り直さないので、
+    1回のポーリングの処理はファイルの数ではなく、ディレクトリの数と変更されたファイルの数に比例します。
+    ファイルをその場で上書きしてもディレクトリの更新日時は変わらないので、
+    full_scan_interval 秒ごとに全てのディレクトリの一覧を取り直します。
+    サイズと更新日時が settle 秒変わらなくなってから報告するので、
+    コピー中のファイルは報告しません。
+    報告したファイルは処理した後に commit を呼ぶと manifest に記録し、中身が変わらなければ再び報告しません。
+
+    Example:
+        with FileManifest("manifest.sqlite3") as manifest:
+            watcher = DirectoryWatcher("submissions", ext=".xlsx", manifest=manifest)
+            while True:
+                for filepath in watcher.poll():
+                    grade(filepath)
+                watcher.commit()
+                time.sleep(2)
+
+    Args:
+        rootdir (str | pathlib.Path): directory name
+        ext (str | tuple of str, optional): file extentions, without distinguishing
+            upper and lower cases. Defaults to None.
+        ignore (list of str, optional): glob patterns of skipped names or relative paths.
+            Defaults to None.
+        manifest (FileManifest, optional): manifest of the reported files.
+            Defaults to None, which means a manifest in memory.
+        settle (float, optional): seconds for which a file must not change.
+            Defaults to 2.0.
+        full_scan_interval (float, optional): seconds between full scans.
+            Defaults to 60.0.
+    """
+
+    def __init__(self, rootdir, ext=None, ignore=None, manifest=None, settle=2.0,
+                 full_scan_interval=60.0):
+        self.rootdir = Path(rootdir).absolute()
+        self.ext = _lower_ext(ext)
+        self.ignore = tuple(ignore) if ignore else ()
+        self.manifest = manifest if manifest is not None else FileManifest(":memory:")
+        self.settle = settle
+        self.full_scan_interval = full_scan_interval
+        # ディレクトリのパス -> (更新日時, サブディレクトリ, {ファイルのパス: (サイズ, 更新日時)})
+        self._dirs = {}
+        # 書き込みが終わるのを待っているファイルのパス -> (サイズ, 更新日時)
+        self._pending = {}
+        # 報告したが commit していないファイルのパス -> manifest の記録
+        self._reported = {}
+        self._last_full_scan = None
+
+    def _scan_dir(self, path, relative, full, found):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            self._dirs.pop(path, None)
+            return
+        known = self._dirs.get(path)
+        if known is not None and known[0] == mtime_ns and not full:
+            for subpath, subrelative in known[1]:
+                self._scan_dir(subpath, subrelative, full, found)
+            return
+        old_files = known[2] if known is not None else {}
+        subdirs = []
+        files = {}
+        for entry in _scan_entries(path):
+            relpath = relative + entry.name
+            if self.ignore and _matches(entry.name, relpath, self.ignore):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append((entry.path, relpath + "/"))
+                elif entry.is_file() and (self.ext is None or
+                                          entry.name.lower().endswith(self.ext)):
+                    st = entry.stat()
+                    files[entry.path] = (st.st_size, st.st_mtime_ns)
+            except OSError as e:
+                logger.warning("Cannot stat {}: {}".format(entry.path, e))
+        for filepath, stat in files.items():
+            if old_files.get(filepath) != stat:
+                found[filepath] = stat
+        self._dirs[path] = (mtime_ns, subdirs, files)
+        for subpath, subrelative in subdirs:
+            self._scan_dir(subpath, subrelative, full, found)
+
+    def poll(self):
+        """Returns the files which are new or changed and no longer being written.
+
+        新しいか変更されたファイルのうち、書き込みが終わったものを返します。
+
+        Returns:
+            list of pathlib.Path: files in the order of the paths
+        """
+        now = time.time()
+        full = (self._last_full_scan is None
+                or now - self._last_full_scan >= self.full_scan_interval)
+        if full:
+            self._last_full_scan = now
+        found = {}
+        self._scan_dir(str(self.rootdir), "", full, found)
+        self._pending.update(found)
+        ready = []
+        for filepath, stat in sorted(self._pending.items()):
+            if filepath in found:
+                # 見つけたばかりのファイルは次のポーリングで確かめる
+                continue
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                del self._pending[filepath]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != stat or now - st.st_mtime_ns / 1e9 < self.settle:
+                self._pending[filepath] = current
+                continue
+            del self._pending[filepath]
+            record = self.manifest.check(filepath)
+            if record is not None:
+                self._reported[filepath] = record
+                ready.append(Path(filepath))
+        return ready
+
+    def commit(self, files=None):
+        """Record the processed files reported by poll in the manifest and save it.
+
+        Call this after the reported files are processed.
+        Files which are not committed are reported again after a restart.
+        poll で報告したファイルのうち処理したものを manifest に記録して保存します。
+        報告したファイルを処理した後に呼びます。
+        commit していないファイルは再起動した後に再び報告されます。
+
+        Args:
+            files (list of str | pathlib.Path, optional): processed files.
+                Defaults to None, which means all files reported by poll.
+        """
+        if files is None:
+            files = list(self._reported)
+        for filepath in files:
+            record = self._reported.pop(str(filepath), None)
+            if record is not None:
+                self.manifest.record(record)
+        self.manifest.commit()
 
 
 def makedirs(rootdir, id_sequence):
@@ -60,7 +464,201 @@ def makedirs(rootdir, id_sequence):
         os.makedirs(dir1, exist_ok=True)
 
 
-def encript_xlsxs(rootdir, password, flag_delete=False):
+def _crypt_result(filepath, output, status, error=None):
+    return {"file": str(filepath), "output": str(output) if output is not None else None,
+            "status": status, "error": error}
+
+
+def encrypt_file(filepath, password, flag_delete=False):
+    """Encrypt an Office file.
+
+    The encrypted file is saved as "<name>_enc<ext>" in the same directory.
+    Office ファイルを暗号化し、同じディレクトリに "<名前>_enc<拡張子>" として保存します。
+
+    Args:
+        filepath (str | pathlib.Path): xlsx, docx or pptx file
+        password (str): password to encrypt
+        flag_delete (bool, optional): flag to delete the original file if encrypted.
+            Defaults to False.
+
+    Returns:
+        dict: "file", "output" (encrypted file or None),
+            "status" (STATUS_OK, STATUS_ALREADY_ENCRYPTED, STATUS_CORRUPT or STATUS_ERROR)
+            and "error" (message or None)
+    """
+    filepath = Path(filepath)
+    outfilepath = filepath.parent / (filepath.stem + "_enc" + filepath.suffix)
+    created = False
+    try:
+        with filepath.open("rb") as f:
+            file = OOXMLFile(f)
+            if file.type != "plain":
+                return _crypt_result(filepath, None, STATUS_ALREADY_ENCRYPTED)
+            with outfilepath.open("wb") as f_enc:
+                created = True
+                file.encrypt(password, f_enc)
+    except Exception as e:
+        if created:
+            # 書きかけのファイルは残さない
+            outfilepath.unlink(missing_ok=True)
+        status = STATUS_ERROR if isinstance(e, OSError) else STATUS_CORRUPT
+        return _crypt_result(filepath, None, status, "{}: {}".format(type(e).__name__, e))
+    if flag_delete:
+        # 元データ削除
+        logger.info("Delete " + str(filepath))
+        filepath.unlink()
+    return _crypt_result(filepath, outfilepath, STATUS_OK)
+
+
+def decrypt_file(filepath, password, flag_delete=False):
+    """Decrypt an encrypted Office file.
+
+    The decrypted file is saved as "<name>_dec<ext>" in the same directory.
+    暗号化された Office ファイルを復号し、同じディレクトリに "<名前>_dec<拡張子>" として保存します。
+
+    Args:
+        filepath (str | pathlib.Path): encrypted xlsx, docx or pptx file
+        password (str): password to decrypt
+        flag_delete (bool, optional): flag to delete the original file if decrypted.
+            Defaults to False.
+
+    Returns:
+        dict: "file", "output" (decrypted file or None),
+            "status" (STATUS_OK, STATUS_WRONG_PASSWORD, STATUS_NOT_ENCRYPTED,
+            STATUS_CORRUPT or STATUS_ERROR) and "error" (message or None)
+    """
+    filepath = Path(filepath)
+    outfilepath = filepath.parent / (filepath.stem + "_dec" + filepath.suffix)
+    created = False
+    try:
+        with filepath.open("rb") as f_enc:
+            file = msoffcrypto.OfficeFile(f_enc)
+            if not file.is_encrypted():
+                return _crypt_result(filepath, None, STATUS_NOT_ENCRYPTED)
+            # パスワードを先に確かめて、間違っていればファイルを作らない
+            file.load_key(password=password, verify_password=True)
+            with outfilepath.open("wb") as f_dec:
+                created = True
+                file.decrypt(f_dec)
+    except Exception as e:
+        if created:
+            outfilepath.unlink(missing_ok=True)
+        if isinstance(e, msoffcrypto.exceptions.InvalidKeyError):
+            status = STATUS_WRONG_PASSWORD
+        elif isinstance(e, OSError):
+            status = STATUS_ERROR
+        else:
+            status = STATUS_CORRUPT
+        return _crypt_result(filepath, None, status, "{}: {}".format(type(e).__name__, e))
+    if flag_delete:
+        # 元データ削除
+        logger.info("Delete " + str(filepath))
+        filepath.unlink()
+    return _crypt_result(filepath, outfilepath, STATUS_OK)
+
+
+def _crypt_files(func, filelist, password, flag_delete, workers):
+    filelist = list(filelist)
+    task = functools.partial(func, password=password, flag_delete=flag_delete)
+    if (workers is not None and workers <= 1) or len(filelist) <= 1:
+        results = [task(filepath) for filepath in filelist]
+    else:
+        # 鍵の導出は CPU を使うのでプロセスで並列に処理する
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(task, filelist))
+    for result in results:
+        if result["status"] != STATUS_OK:
+            logger.warning("{} for {}".format(result["status"], result["file"]))
+    return results
+
+
+def encrypt_files(filelist, password, flag_delete=False, workers=None):
+    """Encrypt Office files with worker processes.
+
+    ワーカープロセスで Office ファイルを暗号化します。
+
+    Args:
+        filelist (list of str | pathlib.Path): xlsx, docx or pptx files
+        password (str): password to encrypt
+        flag_delete (bool, optional): flag to delete the original files.
+            Defaults to False.
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means the number of CPUs. 1 means no worker process.
+
+    Returns:
+        list of dict: results of encrypt_file in the order of filelist
+    """
+    return _crypt_files(encrypt_file, filelist, password, flag_delete, workers)
+
+
+def decrypt_files(filelist, password, flag_delete=False, workers=None):
+    """Decrypt Office files with worker processes.
+
+    ワーカープロセスで Office ファイルを復号します。
+
+    Args:
+        filelist (list of str | pathlib.Path): encrypted xlsx, docx or pptx files
+        password (str): password to decrypt
+        flag_delete (bool, optional): flag to delete the original encrypted files.
+            Defaults to False.
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means the number of CPUs. 1 means no worker process.
+
+    Returns:
+        list of dict: results of decrypt_file in the order of filelist
+    """
+    return _crypt_files(decrypt_file, filelist, password, flag_delete, workers)
+
+
+def _listfiles_ext(rootdir, ext):
+    if isinstance(ext, str):
+        ext = (ext,)
+    ext = tuple(e.lower() for e in ext)
+    # Office が作る一時ファイル (~$ で始まる) は除く
+    return [p for p in iterfiles(rootdir, ignore=["~$*"]) if p.suffix.lower() in ext]
+
+
+def encrypt_directory(rootdir, password, flag_delete=False, ext=OFFICE_EXTENSIONS, workers=None):
+    """Encrypt all Office files in a directory with worker processes.
+
+    ディレクトリ以下の全ての Office ファイルをワーカープロセスで暗号化します。
+
+    Args:
+        rootdir (str | pathlib.Path): directory, searched recursively
+        password (str): password to encrypt
+        flag_delete (bool, optional): flag to delete the original files.
+            Defaults to False.
+        ext (str | tuple of str, optional): file extensions. Defaults to OFFICE_EXTENSIONS.
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means the number of CPUs. 1 means no worker process.
+
+    Returns:
+        list of dict: results of encrypt_file
+    """
+    return encrypt_files(_listfiles_ext(rootdir, ext), password, flag_delete, workers)
+
+
+def decrypt_directory(rootdir, password, flag_delete=False, ext=OFFICE_EXTENSIONS, workers=None):
+    """Decrypt all Office files in a directory with worker processes.
+
+    ディレクトリ以下の全ての Office ファイルをワーカープロセスで復号します。
+
+    Args:
+        rootdir (str | pathlib.Path): directory, searched recursively
+        password (str): password to decrypt
+        flag_delete (bool, optional): flag to delete the original encrypted files.
+            Defaults to False.
+        ext (str | tuple of str, optional): file extensions. Defaults to OFFICE_EXTENSIONS.
+        workers (int, optional): number of worker processes.
+            Defaults to None, which means the number of CPUs. 1 means no worker process.
+
+    Returns:
+        list of dict: results of decrypt_file
+    """
+    return decrypt_files(_listfiles_ext(rootdir, ext), password, flag_delete, workers)
+
+
+def encript_xlsxs(rootdir, password, flag_delete=False, workers=1):
     """Encript all xlsx files in a directory.
 
     Encript the encrypted xlsx file located under rootdir.
@@ -72,6 +670,11 @@ def encript_xlsxs(rootdir, password, flag_delete=False):
         password (str): password to encript
         flag_delete (bool, optional): flag to delete original files.
             Defaults to False. 
+        workers (int, optional): number of worker processes.
+            Defaults to 1, which means no worker process. None means the number of CPUs.
+
+    Returns:
+        list of dict: results of encrypt_file
 
     In order to test this function
     copy files in "sampledata/exceldir1" to "sampledata/exceldir1_enc"
@@ -79,72 +682,288 @@ def encript_xlsxs(rootdir, password, flag_delete=False):
     encript_xlsxs("sampledata/exceldir1_enc", password="hoge", flag_delete=True)
 
     """
-    # list all xlsx files
-    filelist = listfiles(rootdir, ext=".xlsx")
-
-    for filepath in filelist:
-        logger.debug("Encript " + str(filepath))
-        # 暗号化
-        try:
-            f = filepath.open("rb")
-            file = msoffcrypto.format.ooxml.OOXMLFile(f)
-
-            # 保存
-            outfilename = filepath.stem + "_enc.xlsx"
-            outfilepath = filepath.parent / Path(outfilename)
-            with outfilepath.open("wb") as f_enc:
-                file.encrypt(password, f_enc)
-
-            f.close()
-            if flag_delete:
-                # 元データ削除
-                logger.info("Delete " + str(filepath))
-                filepath.unlink()
-        except:
-            logger.warning("Something is wrong for " + str(filepath.resolve()))
+    return encrypt_directory(rootdir, password, flag_delete=flag_delete, ext=".xlsx",
+                             workers=workers)
 
 
-def decript_xlsxs(rootdir, password, flag_delete=False):
+def decript_xlsxs(rootdir, password, flag_delete=False, workers=1):
     """Decript all xlsx files in a directory.
 
     Decrypt the encrypted xlsx file located under rootdir.
     If flag_delete is set to True, the encrypted files will be deleted.
-    An exception will be thrown if there is an unencrypted xlsx file under rootdir.
+    Unencrypted xlsx files under rootdir are reported as STATUS_NOT_ENCRYPTED.
     rootdir 以下にある暗号化されたxlsxファイルを復号します。
     flag_delete を True にすると、暗号化前のファイルは削除されます。
-    rootdir 以下に暗号化されていないxlsxファイルがあると例外を出します。
+    rootdir 以下の暗号化されていないxlsxファイルは STATUS_NOT_ENCRYPTED とします。
     Args:
         rootdir (str | pathlib.Path): directory where the encripted files exist
         password (str): password to decript
         flag_delete (bool, optional): flag to delete original encripted files.
             Defaults to False.
+        workers (int, optional): number of worker processes.
+            Defaults to 1, which means no worker process. None means the number of CPUs.
+
+    Returns:
+        list of dict: results of decrypt_file
 
     In order to test this function
     copy files in "sampledata/exceldir1_enc" to "sampledata/exceldir1_enc_dec"
     and run 
     decript_xlsxs("sampledata/exceldir1_enc_dec", password="hoge", flag_delete=True)
     """
-    # list all xlsx files
-    filelist = listfiles(rootdir, ext=".xlsx")
+    return decrypt_directory(rootdir, password, flag_delete=flag_delete, ext=".xlsx",
+                             workers=workers)
+
+
+class DecryptedCache:
+    """Bounded LRU of decrypted files in memory.
+
+    Decrypted files are kept with the hash of the encrypted file and the password,
+    so the same submission is decrypted only once.
+    When the total size exceeds max_bytes, the least recently used files are removed.
+    復号したファイルを、暗号化されたファイルのハッシュとパスワードをキーとして保持するので、
+    同じ提出ファイルは1回だけ復号されます。
+    合計のサイズが max_bytes を超えると、最も長く使われていないものから削除します。
+
+    Args:
+        max_bytes (int, optional): maximum total size of the decrypted files.
+            Defaults to 256 MiB.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._buffers = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def get(self, key):
+        with self._lock:
+            data = self._buffers.get(key)
+            if data is not None:
+                self._buffers.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            if key in self._buffers:
+                return
+            self._buffers[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self._buffers) > 1:
+                _, removed = self._buffers.popitem(last=False)
+                self.size -= len(removed)
+
+    def clear(self):
+        with self._lock:
+            self._buffers.clear()
+            self.size = 0
+
+
+def decrypt_to_buffer(filepath, password, cache=None):
+    """Decrypt an Office file into memory.
+
+    No decrypted file is written to the disk.
+    The returned buffer can be given to openpyxl.load_workbook, docx.Document,
+    pptx.Presentation and util.xlsxreader.load_dual_workbook.
+    A file which is not encrypted is returned as it is.
+    復号したファイルをディスクに書かずにメモリ上に作ります。
+    返されたバッファは openpyxl.load_workbook、docx.Document、pptx.Presentation、
+    util.xlsxreader.load_dual_workbook にそのまま渡せます。
+    暗号化されていないファイルはそのまま返します。
+
+    Example:
+        wb = openpyxl.load_workbook(util.misc.decrypt_to_buffer(filepath, "abc"))
+
+    Args:
+        filepath (str | pathlib.Path): encrypted xlsx, docx or pptx file
+        password (str): password to decrypt
+        cache (DecryptedCache, optional): cache of decrypted files. Defaults to None.
+
+    Returns:
+        io.BytesIO: decrypted file
+
+    Raises:
+        msoffcrypto.exceptions.InvalidKeyError: if the password is wrong
+        msoffcrypto.exceptions.FileFormatError: if the file is not an Office file
+    """
+    raw = Path(filepath).read_bytes()
+    key = None
+    if cache is not None:
+        key = (hashlib.sha256(raw).hexdigest(), password)
+        data = cache.get(key)
+        if data is not None:
+            # 呼び出し側ごとに読み込み位置が独立するように新しいバッファを返す
+            return io.BytesIO(data)
+    file = msoffcrypto.OfficeFile(io.BytesIO(raw))
+    if file.is_encrypted():
+        file.load_key(password=password, verify_password=True)
+        out = io.BytesIO()
+        file.decrypt(out)
+        data = out.getvalue()
+    else:
+        data = raw
+    if cache is not None:
+        cache.put(key, data)
+    return io.BytesIO(data)
+
+
+# 暗号化されたパッケージはこの長さのセグメントごとに暗号化されている
+SEGMENT_LENGTH = 4096
+
+
+class DecryptingReader(io.RawIOBase):
+    """Seekable file object which decrypts an encrypted OOXML package on demand.
+
+    ECMA-376 encryption stores the package in independently encrypted
+    4096-byte segments of the EncryptedPackage stream.
+    This reader reads and decrypts only the segments which are read,
+    so zipfile can fetch the central directory and a few parts
+    (e.g. docProps/core.xml or one sheet) without decrypting the whole package.
+    The password is verified once when the reader is opened.
+    ECMA-376 の暗号化では、パッケージは EncryptedPackage ストリームの
+    4096 バイトのセグメントごとに独立して暗号化されています。
+    このリーダーは読まれたセグメントだけを読み込んで復号するので、
+    zipfile はパッケージ全体を復号せずに、中央ディレクトリといくつかのパート
+    (docProps/core.xml や1つのシートなど) を取り出せます。
+    パスワードはリーダーを開くときに1回だけ確かめます。
+
+    Example:
+        with util.misc.DecryptingReader("report_enc.xlsx", "abc") as f:
+            book = util.xlsxreader.load_dual_workbook(f, ranges={"Sheet1": ["E4:E19"]})
+
+    Args:
+        filepath (str | pathlib.Path): encrypted xlsx, docx or pptx file
+        password (str): password to decrypt
+        max_segments (int, optional): number of decrypted segments kept in memory.
+            Defaults to 64.
+
+    Raises:
+        msoffcrypto.exceptions.InvalidKeyError: if the password is wrong
+        msoffcrypto.exceptions.DecryptionError: if the file is not encrypted
+        msoffcrypto.exceptions.FileFormatError: if the file is not an Office file
+    """
 
-    for filepath in filelist:
-        logger.debug("Decript " + str(filepath))
-        # 暗号化解除
+    def __init__(self, filepath, password, max_segments=64):
+        super().__init__()
+        self.max_segments = max_segments
+        # 復号したセグメントの数 (統計用)
+        self.decrypted_segments = 0
+        self._fp = Path(filepath).open("rb")
         try:
-            f_enc = filepath.open("rb")
-            file = msoffcrypto.OfficeFile(f_enc)
-            file.load_key(password=password)
+            officefile = OOXMLFile(self._fp)
+            if officefile.type == "plain":
+                raise msoffcrypto.exceptions.DecryptionError("Document is not encrypted")
+            if officefile.type not in ("agile", "standard"):
+                raise msoffcrypto.exceptions.DecryptionError("Unsupported encryption method")
+            officefile.load_key(password=password, verify_password=True)
+            self._type = officefile.type
+            self._key = officefile.secret_key
+            if self._type == "agile":
+                self._salt = officefile.info["keyDataSalt"]
+                self._hash = officefile.info["keyDataHashAlgorithm"].lower()
+                self._blocksize = officefile.info["keyDataBlockSize"]
+            self._open_stream(officefile.file)
+            self.size = struct.unpack("<Q", self._read_stream(0, 8))[0]
+        except Exception:
+            self._fp.close()
+            raise
+        self._pos = 0
+        self._segments = collections.OrderedDict()
 
-            # 保存
-            outfilename = filepath.stem + "_dec.xlsx"
-            outfilepath = filepath.parent / Path(outfilename)
-            with outfilepath.open("wb") as f_dec:
-                file.decrypt(f_dec)
+    def _open_stream(self, ole):
+        entry = next(e for e in ole.direntries
+                     if e is not None and e.name == "EncryptedPackage")
+        self._stream_size = entry.size
+        if entry.size < ole.minisectorcutoff:
+            # 小さいストリームは MiniFAT にあるのでまとめて読む
+            with ole.openstream("EncryptedPackage") as stream:
+                self._data = stream.read()
+            self._chain = None
+            return
+        # FAT をたどってストリームのセクターの並びを求め、必要なセクターだけを読む
+        self._data = None
+        self._sectorsize = ole.sectorsize
+        self._chain = []
+        sect = entry.isectStart
+        while sect != olefile.ENDOFCHAIN and len(self._chain) * ole.sectorsize < entry.size:
+            self._chain.append(sect)
+            sect = ole.fat[sect]
+
+    def _read_stream(self, offset, length):
+        if self._chain is None:
+            return self._data[offset:offset + length]
+        parts = []
+        end = min(offset + length, self._stream_size)
+        while offset < end:
+            index, inner = divmod(offset, self._sectorsize)
+            n = min(self._sectorsize - inner, end - offset)
+            self._fp.seek(self._sectorsize * (self._chain[index] + 1) + inner)
+            parts.append(self._fp.read(n))
+            offset += n
+        return b"".join(parts)
+
+    def _segment(self, index):
+        data = self._segments.get(index)
+        if data is not None:
+            self._segments.move_to_end(index)
+            return data
+        start = 8 + index * SEGMENT_LENGTH
+        encrypted = self._read_stream(start, SEGMENT_LENGTH)
+        encrypted = encrypted[:len(encrypted) - len(encrypted) % 16]
+        if self._type == "agile":
+            iv = hashlib.new(self._hash, self._salt + struct.pack("<I", index)).digest()
+            mode = modes.CBC(iv[:self._blocksize])
+        else:
+            mode = modes.ECB()
+        decryptor = Cipher(algorithms.AES(self._key), mode).decryptor()
+        data = decryptor.update(encrypted) + decryptor.finalize()
+        data = data[:min(SEGMENT_LENGTH, self.size - index * SEGMENT_LENGTH)]
+        self.decrypted_segments += 1
+        self._segments[index] = data
+        if len(self._segments) > self.max_segments:
+            self._segments.popitem(last=False)
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence {}".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        written = 0
+        # zipfile は要求した長さが返ることを期待するので、セグメントをまたいで読む
+        while written < len(view) and self._pos < self.size:
+            index, inner = divmod(self._pos, SEGMENT_LENGTH)
+            chunk = self._segment(index)[inner:inner + len(view) - written]
+            view[written:written + len(chunk)] = chunk
+            written += len(chunk)
+            self._pos += len(chunk)
+        return written
 
-            f_enc.close()
-            if flag_delete:
-                # 元データ削除
-                logger.info("Delete " + str(filepath))
-                filepath.unlink()
-        except:
-            logger.warning("something is wrong for " + str(filepath.resolve()))
+    def close(self):
+        if not self.closed:
+            self._fp.close()
+            self._segments.clear()
+        super().close()
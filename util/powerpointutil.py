@@ -1,6 +1,5 @@
-import datetime
-import zoneinfo
 import pptx
+import util.docprops
 
 
 def get_creator_lastmodify(presentation):
@@ -39,21 +38,9 @@ def get_createtime_modifiedtime(presentation, iana_key='Asia/Tokyo'):
             The datatimes are isoformat strings.
     """
     # get datetime with "Z", (UTC)
-    createdtime = presentation.core_properties.created
-    modifiedtime = presentation.core_properties.modified
     # ただし、時間帯情報　timezone はNULLである　つまりシステム依存の時間に見えてしまう。
-    # 日本時間に変換
-    # 強引にUTCと認識させ、そこから日本時間帯に変換させる
-    if createdtime:
-        tmp = createdtime.replace(tzinfo=datetime.timezone.utc)
-        createdtimeJST = tmp.astimezone(tz=zoneinfo.ZoneInfo(key=iana_key))
-    else:
-        createdtimeJST = "Empty DateTime"
-    if modifiedtime:
-        tmp = modifiedtime.replace(tzinfo=datetime.timezone.utc)
-        modifiedtimeJST = tmp.astimezone(tz=zoneinfo.ZoneInfo(key=iana_key))
-    else:
-        modifiedtimeJST = "Empty DateTime"
-    return (createdtimeJST, modifiedtimeJST)
+    # UTCと認識させ、そこから指定された時間帯に変換させる
+    return (util.docprops.localtime(presentation.core_properties.created, iana_key),
+            util.docprops.localtime(presentation.core_properties.modified, iana_key))
 
 
@@ -0,0 +1,227 @@
+"""Declarative rubric for Excel assignments.
+
+A rubric is data, not code. It is a dict (or a JSON file) like the following:
+採点基準 (ルーブリック) はコードではなくデータで、次のような dict (または JSON ファイル) です。
+
+    {
+        "sheet": "Sheet1",
+        "checks": [
+            {"name": "value1", "check": "is_given_value", "addr": "E4", "value": 46},
+            {"name": "formula1", "check": "is_formula", "addr": "E4"},
+            {"name": "function4", "check": "check_func_in_range",
+             "range_string": "E19", "func_string": "AVERAGE"},
+            {"name": ["creator", "modifiedby"], "check": "get_creator_lastmodify"}
+        ]
+    }
+
+"check" is the name of a function in util.excelutil
+(or a style check in util.excelutil_exp)
+and the other keys are passed to it as keyword arguments.
+"sheet" in a check overrides the default sheet of the rubric.
+Range checks give countTrue/countCells by default,
+and the (countCells, countTrue) tuple if "result" is "count".
+If "name" is a list, the returned tuple is unpacked into the names.
+Formula cells without cached values (e.g. files written by a script)
+are computed by util.formulaeval unless "evaluate" of the rubric is false.
+"check" は util.excelutil の関数名 (または util.excelutil_exp の書式のチェックの名前) で、
+その他のキーはキーワード引数として渡されます。
+チェックの "sheet" はルーブリックのデフォルトのシートを上書きします。
+範囲のチェックはデフォルトで countTrue/countCells を返し、
+"result" が "count" なら (countCells, countTrue) のタプルを返します。
+"name" がリストなら、戻り値のタプルを展開してそれぞれの名前に入れます。
+値が保存されていない数式のセル (スクリプトで作ったファイルなど) は、
+ルーブリックの "evaluate" が false でなければ util.formulaeval で計算します。
+
+The rubric is compiled into a plan.
+The plan merges the ranges of all checks into one bounding box per sheet,
+reads each box once and runs all checks against the cells in memory.
+ルーブリックは実行計画にコンパイルされます。
+実行計画は全てのチェックのセル範囲をシートごとに1つの範囲にまとめ、
+その範囲を1回だけ読み込み、メモリ上のセルに対して全てのチェックを実行します。
+
+Example:
+    plan = util.rubric.compile_rubric(util.rubric.load_rubric("rubric02.json"))
+    row = plan.grade("exceldata3_student5.xlsx")
+"""
+import json
+import pathlib
+import openpyxl
+import util.excelutil
+import util.excelutil_exp
+import util.xlsxreader
+
+# チェック関数とセル範囲を表す引数の名前
+SHEET_CHECKS = {
+    "is_given_value": (util.excelutil.is_given_value, "addr"),
+    "is_formula": (util.excelutil.is_formula, "addr"),
+    "is_integer": (util.excelutil.is_integer, "addr"),
+    "is_equivalent_formula": (util.excelutil.is_equivalent_formula, "addr"),
+    "check_values_in_range": (util.excelutil.check_values_in_range, "range_string"),
+    "check_values_in_range_float": (util.excelutil.check_values_in_range_float, "range_string"),
+    "check_num_formulas_in_range": (util.excelutil.check_num_formulas_in_range, "range_string"),
+    "check_func_in_range": (util.excelutil.check_func_in_range, "range_string"),
+    "check_comp_abs_ref_in_range": (util.excelutil.check_comp_abs_ref_in_range, "range_string"),
+    "is_aligned_h": (util.excelutil_exp.is_aligned_h, "addr"),
+    "is_aligned_v": (util.excelutil_exp.is_aligned_v, "addr"),
+    "is_solidfill": (util.excelutil_exp.is_solidfill, "addr"),
+    "is_numberformat": (util.excelutil_exp.is_numberformat, "addr"),
+    "is_font": (util.excelutil_exp.is_font, "addr"),
+    "is_bordered": (util.excelutil_exp.is_bordered, "addr"),
+    "check_aligned_h_in_range": (util.excelutil_exp.check_aligned_h_in_range, "range_string"),
+    "check_aligned_v_in_range": (util.excelutil_exp.check_aligned_v_in_range, "range_string"),
+    "check_solidfill_in_range": (util.excelutil_exp.check_solidfill_in_range, "range_string"),
+    "check_numberformat_in_range": (util.excelutil_exp.check_numberformat_in_range, "range_string"),
+    "check_font_in_range": (util.excelutil_exp.check_font_in_range, "range_string"),
+    "check_border_in_range": (util.excelutil_exp.check_border_in_range, "range_string"),
+}
+
+# ブック全体に対するチェック関数
+BOOK_CHECKS = {
+    "get_creator_lastmodify": util.excelutil.get_creator_lastmodify,
+    "get_createtime_modifiedtime": util.excelutil.get_createtime_modifiedtime,
+}
+
+
+def load_rubric(path):
+    """Load a rubric from a JSON file.
+
+    JSON ファイルからルーブリックを読み込みます。
+
+    Args:
+        path (str | pathlib.Path): JSON file
+
+    Returns:
+        dict: rubric
+    """
+    with pathlib.Path(path).open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compile_rubric(rubric):
+    """Compile a rubric into a plan.
+
+    ルーブリックを実行計画にコンパイルします。
+
+    Args:
+        rubric (dict | list of dict): rubric
+            A list is treated as the "checks" of a rubric without a default sheet.
+
+    Returns:
+        RubricPlan
+
+    Raises:
+        ValueError: if a check is unknown or has no sheet or range
+    """
+    if isinstance(rubric, list):
+        rubric = {"checks": rubric}
+    default_sheet = rubric.get("sheet")
+    steps = []
+    boxes = {}
+    for check in rubric["checks"]:
+        args = dict(check)
+        name = args.pop("name")
+        checkname = args.pop("check")
+        result = args.pop("result", "ratio")
+        sheet = args.pop("sheet", default_sheet)
+        if checkname in BOOK_CHECKS:
+            steps.append((name, BOOK_CHECKS[checkname], None, args, result))
+            continue
+        if checkname not in SHEET_CHECKS:
+            raise ValueError("Unknown check {} for {}".format(checkname, name))
+        func, rangearg = SHEET_CHECKS[checkname]
+        if sheet is None:
+            raise ValueError("No sheet for {}".format(name))
+        if rangearg not in args:
+            raise ValueError("No {} for {}".format(rangearg, name))
+        # "E:E" のような列全体の範囲も読み込む範囲に含める
+        min_col, min_row, max_col, max_row = util.xlsxreader._range_bounds(args[rangearg])
+        if sheet in boxes:
+            box = boxes[sheet]
+            boxes[sheet] = (min(box[0], min_col), min(box[1], min_row),
+                            max(box[2], max_col), max(box[3], max_row))
+        else:
+            boxes[sheet] = (min_col, min_row, max_col, max_row)
+        if rangearg == "addr":
+            result = "value"
+        steps.append((name, func, sheet, args, result))
+    return RubricPlan(steps, boxes, evaluate=rubric.get("evaluate", True))
+
+
+class RubricPlan:
+    """Compiled rubric.
+
+    `ranges` is the bounding box of each sheet
+    and `fieldnames` is the list of the keys of a result row.
+    If `evaluate` is True, missing cached values of formulas are computed.
+    `ranges` はシートごとに読み込むセル範囲、`fieldnames` は結果の行のキーのリストです。
+    `evaluate` が True なら、保存されていない数式の値を計算します。
+    """
+
+    def __init__(self, steps, boxes, evaluate=True):
+        self.steps = steps
+        self.evaluate = evaluate
+        self.ranges = {}
+        for sheet, (min_col, min_row, max_col, max_row) in boxes.items():
+            self.ranges[sheet] = ["{}{}:{}{}".format(
+                openpyxl.utils.get_column_letter(min_col), min_row,
+                openpyxl.utils.get_column_letter(max_col), max_row)]
+        self.fieldnames = []
+        for name, _, _, _, _ in steps:
+            if isinstance(name, (list, tuple)):
+                self.fieldnames.extend(name)
+            else:
+                self.fieldnames.append(name)
+
+    def load(self, filename):
+        """Read the cells needed by the plan.
+
+        実行計画に必要なセルだけを読み込みます。
+
+        Args:
+            filename (str | pathlib.Path | file-like object): xlsx file
+
+        Returns:
+            DualWorkbook
+        """
+        return util.xlsxreader.load_dual_workbook(filename, ranges=self.ranges,
+                                                  evaluate=self.evaluate)
+
+    def grade_book(self, book):
+        """Run all checks against a loaded book.
+
+        読み込み済みのブックに対して全てのチェックを実行します。
+
+        Args:
+            book (DualWorkbook): book loaded by `load`
+
+        Returns:
+            dict: result row
+        """
+        row = {}
+        for name, func, sheet, args, result in self.steps:
+            if sheet is None:
+                retval = func(book, **args)
+            else:
+                sheetdata, sheetmath = book[sheet]
+                retval = func(sheetdata=sheetdata, sheetmath=sheetmath, **args)
+                if result == "ratio":
+                    countCells, countTrue = retval
+                    retval = countTrue / countCells if countCells else 0.0
+            if isinstance(name, (list, tuple)):
+                row.update(zip(name, retval))
+            else:
+                row[name] = retval
+        return row
+
+    def grade(self, filename):
+        """Grade one file.
+
+        1つのファイルを採点します。
+
+        Args:
+            filename (str | pathlib.Path | file-like object): xlsx file
+
+        Returns:
+            dict: result row
+        """
+        return self.grade_book(self.load(filename))
@@ -0,0 +1,176 @@
+"""NumPy snapshot of a cell range.
+
+A snapshot reads a range once and holds the values, the numeric values,
+the numeric mask, the formula mask and the types as arrays.
+The range checks in util.excelutil count cells with vectorized comparisons on it.
+スナップショットはセル範囲を1回だけ読み込み、値、数値、数値のマスク、
+数式のマスク、型を配列として保持します。
+util.excelutil の範囲のチェックはこれを使ってベクトル化した比較でセルを数えます。
+
+Example:
+    snapshot = util.sheetsnapshot.take_snapshot(sheetData, sheetMath, "B8:C10")
+    countCells, countTrue, mask = snapshot.count_equal([["aaa", 1290], ["bbb", 456], ["ccc", 789]])
+"""
+import datetime
+import numpy as np
+import openpyxl
+
+
+def _type_code(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "b"
+    if isinstance(value, (int, float)):
+        return "n"
+    if isinstance(value, str):
+        return "s"
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)):
+        return "d"
+    return "o"
+
+
+def _object_array(rows, shape):
+    # 行ごとに長さが違うデータも入るように object の配列にする
+    array = np.empty(shape, dtype=object)
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            array[i, j] = value
+    return array
+
+
+class SheetSnapshot:
+    """Arrays of a cell range.
+
+    Attributes:
+        values (numpy.ndarray): cached values (object)
+        formulas (numpy.ndarray): formulas, or values if the cell is not a formula (object)
+        numbers (numpy.ndarray): values as float64, NaN if not numeric
+        is_numeric (numpy.ndarray): True if the value is int or float (bool is included as in Python)
+        is_formula (numpy.ndarray): True if the cell is a formula
+        types (numpy.ndarray): type codes
+            "" (empty), "n" (number), "b" (bool), "s" (str), "d" (datetime), "o" (other)
+    """
+
+    def __init__(self, values, formulas):
+        self.values = values
+        self.formulas = formulas
+        self.shape = values.shape
+        self.types = np.vectorize(_type_code, otypes=["<U1"])(values) \
+            if values.size else np.empty(values.shape, dtype="<U1")
+        self.is_numeric = (self.types == "n") | (self.types == "b")
+        self.numbers = np.full(self.shape, np.nan)
+        self.numbers[self.is_numeric] = values[self.is_numeric].astype(float)
+        # 保存されている値とセルに書かれているデータが違う　→　セルに書かれているのは数式
+        self.is_formula = np.asarray(values != formulas, dtype=bool)
+
+    def _reference(self, refvalues):
+        # 与えられた値を範囲と同じ形の配列にし、値のあるセルのマスクを作る
+        # zip と同じく、範囲からはみ出した値や足りない値は数えない
+        ref = np.empty(self.shape, dtype=object)
+        valid = np.zeros(self.shape, dtype=bool)
+        for i, row in zip(range(self.shape[0]), refvalues):
+            row = list(row)[:self.shape[1]]
+            ref[i, :len(row)] = row
+            valid[i, :len(row)] = True
+        return ref, valid
+
+    def count_equal(self, refvalues):
+        """Count cells whose values are equal to the given values.
+
+        与えられた値と同じ値を持つセルを数えます。
+
+        Args:
+            refvalues (list of list): Row-major two dimensional values
+
+        Returns:
+            (countCells, countTrue, mask) : countCells (int), countTrue (int), mask (numpy.ndarray of bool)
+        """
+        ref, valid = self._reference(refvalues)
+        mask = np.asarray(self.values == ref, dtype=bool) & valid
+        return (int(valid.sum()), int(mask.sum()), mask)
+
+    def count_close(self, refvalues, abstol=0.01, reltol=0.0):
+        """Count numeric cells whose values are close to the given values.
+
+        A cell passes if |value - ref| <= abstol + reltol * |ref|.
+        与えられた値に近い数値を持つセルを数えます。
+        |value - ref| <= abstol + reltol * |ref| であれば合格とします。
+
+        Args:
+            refvalues (list of list): Row-major two dimensional values
+            abstol (float, optional): absolute tolerance. Defaults to 0.01.
+            reltol (float, optional): relative tolerance. Defaults to 0.0.
+
+        Returns:
+            (countCells, countTrue, mask) : countCells (int), countTrue (int), mask (numpy.ndarray of bool)
+        """
+        ref, valid = self._reference(refvalues)
+        refnumbers = np.full(self.shape, np.nan)
+        refnumeric = np.vectorize(lambda v: _type_code(v) in ("n", "b"), otypes=[bool])(ref) \
+            if ref.size else valid.copy()
+        refnumbers[refnumeric] = ref[refnumeric].astype(float)
+        with np.errstate(invalid="ignore"):
+            mask = np.abs(self.numbers - refnumbers) <= abstol + reltol * np.abs(refnumbers)
+        mask &= self.is_numeric & valid
+        return (int(valid.sum()), int(mask.sum()), mask)
+
+    def count_formulas(self):
+        """Count cells which are formulas.
+
+        数式であるセルを数えます。
+
+        Returns:
+            (countCells, countTrue, mask) : countCells (int), countTrue (int), mask (numpy.ndarray of bool)
+        """
+        return (int(self.is_formula.size), int(self.is_formula.sum()), self.is_formula.copy())
+
+
+def range_bounds(sheet, range_string):
+    """Returns the bounds of a range, limiting whole columns and rows to the used cells.
+
+    Like Worksheet.iter_rows, the missing bounds of ranges like "E:E" and "4:4"
+    are 1 and the max_row or max_column of the sheet.
+    セル範囲の境界を返します。Worksheet.iter_rows と同じく、
+    "E:E" や "4:4" のような範囲の無い境界は 1 か、シートの max_row または max_column とします。
+
+    Args:
+        sheet (Worksheet | util.xlsxreader.SheetView): sheet
+        range_string (str): Excel style cell range.
+            example: `A1:B3`, `E:E`
+
+    Returns:
+        (min_col, min_row, max_col, max_row): tuple of ints
+    """
+    (min_col, min_row, max_col,
+     max_row) = openpyxl.utils.cell.range_boundaries(range_string)
+    return (min_col or 1, min_row or 1,
+            max_col or sheet.max_column or 0, max_row or sheet.max_row or 0)
+
+
+def take_snapshot(sheetdata, sheetmath, range_string):
+    """Read a cell range into a SheetSnapshot.
+
+    セル範囲を SheetSnapshot に読み込みます。
+
+    Args:
+        sheetdata (Worksheet): Worksheet instance of the openpyxl
+            whose book are opened with data_only set to True
+        sheetmath (Worksheet): Worksheet instance of the openpyxl
+            whose book are opened with data_only set to False
+        range_string (str): Excel style cell range.
+            Whole columns and rows like `E:E` are limited to the used cells.
+            example: `A1:B3`
+
+    Returns:
+        SheetSnapshot
+    """
+    min_col, min_row, max_col, max_row = range_bounds(sheetdata, range_string)
+    shape = (max(0, max_row - min_row + 1), max(0, max_col - min_col + 1))
+    values = _object_array(sheetdata.iter_rows(min_row=min_row, max_row=max_row,
+                                               min_col=min_col, max_col=max_col, values_only=True),
+                           shape)
+    formulas = _object_array(sheetmath.iter_rows(min_row=min_row, max_row=max_row,
+                                                 min_col=min_col, max_col=max_col, values_only=True),
+                             shape)
+    return SheetSnapshot(values, formulas)
@@ -0,0 +1,255 @@
+"""Style index of a workbook.
+
+The style of a cell is stored as a style id which points to entries
+of the fonts, fills, borders, alignments and number formats in styles.xml.
+The index resolves each style id once per workbook into a compact CellStyle
+and the style checks in util.excelutil_exp look up the CellStyle of each cell.
+Range checks read the style ids of all cells in one pass.
+Cells of an openpyxl worksheet are not created by the lookup.
+セルの書式はスタイル ID として保存され、styles.xml のフォント、塗りつぶし、
+罫線、配置、表示形式を指しています。
+このインデックスは各スタイル ID をブックごとに1回だけ CellStyle に変換し、
+util.excelutil_exp の書式のチェックは各セルの CellStyle を参照します。
+範囲のチェックは全てのセルのスタイル ID を1回で読みます。
+参照によって openpyxl のワークシートに空のセルが作られることはありません。
+
+Both openpyxl worksheets and sheets loaded by util.xlsxreader are supported.
+In merged cells, openpyxl replaces the styles of the cells except the top-left one,
+while util.xlsxreader keeps the styles saved in the file.
+openpyxl のワークシートと util.xlsxreader で読み込んだシートの両方に対応しています。
+結合したセルでは、openpyxl は左上以外のセルの書式を置き換えますが、
+util.xlsxreader はファイルに保存された書式をそのまま使います。
+
+Example:
+    style = util.styleindex.style_at(sheetData, 60, 5)
+    style.horizontal    # 'center'
+    countCells, countTrue = util.styleindex.count_styles(
+        sheetData, "B2:F30", lambda style: style.fill_type == "solid")
+"""
+import weakref
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.styles.numbers import BUILTIN_FORMATS, BUILTIN_FORMATS_MAX_SIZE
+import util.sheetsnapshot
+
+BORDER_SIDES = ("left", "right", "top", "bottom")
+
+
+def _color(color):
+    # "FFFF0000" のような RGB か "theme:1" のような文字列にする
+    if color is None:
+        return None
+    if color.type == "rgb":
+        return color.rgb
+    return "{}:{}".format(color.type, color.value)
+
+
+class CellStyle:
+    """Resolved style of a cell.
+
+    Attributes:
+        horizontal (str | None): horizontal alignment like "center"
+        vertical (str | None): vertical alignment like "center"
+        fill_type (str | None): pattern type of the fill like "solid"
+        fill_color (str | None): foreground color of the fill
+        number_format (str): number format like "0.0_ "
+        font_name (str | None): font name
+        font_size (float | None): font size
+        bold (bool): bold
+        italic (bool): italic
+        underline (str | None): underline like "single"
+        strike (bool): strikethrough
+        font_color (str | None): font color like "FFFF0000" or "theme:1"
+        border (tuple of str | None): border styles of (left, right, top, bottom) like "thin"
+    """
+
+    __slots__ = ("horizontal", "vertical", "fill_type", "fill_color", "number_format",
+                 "font_name", "font_size", "bold", "italic", "underline", "strike",
+                 "font_color", "border")
+
+    def __init__(self, workbook, style_array):
+        alignment = workbook._alignments[style_array.alignmentId]
+        self.horizontal = alignment.horizontal
+        self.vertical = alignment.vertical
+        fill = workbook._fills[style_array.fillId]
+        self.fill_type = getattr(fill, "patternType", None)
+        self.fill_color = _color(getattr(fill, "fgColor", None)) if self.fill_type else None
+        # openpyxl の Cell.number_format と同じ方法で表示形式を求める
+        fmt_id = style_array.numFmtId
+        if fmt_id < BUILTIN_FORMATS_MAX_SIZE:
+            self.number_format = BUILTIN_FORMATS.get(fmt_id, "General")
+        else:
+            self.number_format = workbook._number_formats[fmt_id - BUILTIN_FORMATS_MAX_SIZE]
+        font = workbook._fonts[style_array.fontId]
+        self.font_name = font.name
+        self.font_size = font.sz
+        self.bold = bool(font.b)
+        self.italic = bool(font.i)
+        self.underline = font.u
+        self.strike = bool(font.strike)
+        self.font_color = _color(font.color)
+        border = workbook._borders[style_array.borderId]
+        self.border = tuple(getattr(getattr(border, side), "style", None) for side in BORDER_SIDES)
+
+    def __repr__(self):
+        return "<CellStyle {}>".format(
+            ", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class StyleIndex:
+    """CellStyles of a workbook, resolved once for each style.
+
+    ブックの CellStyle を、書式ごとに1回だけ変換して保持します。
+
+    Args:
+        workbook (Workbook): openpyxl workbook whose stylesheet is loaded
+    """
+
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self._by_array = {}
+        self._by_id = {}
+
+    def get(self, style_array):
+        """Returns the CellStyle of a StyleArray.
+
+        StyleArray の CellStyle を返します。
+
+        Args:
+            style_array (StyleArray | None): style of a cell. None means the default style.
+
+        Returns:
+            CellStyle
+        """
+        key = tuple(style_array) if style_array is not None else tuple(StyleArray())
+        style = self._by_array.get(key)
+        if style is None:
+            style = CellStyle(self.workbook, StyleArray(key))
+            self._by_array[key] = style
+        return style
+
+    def by_id(self, style_id):
+        """Returns the CellStyle of a style id in styles.xml.
+
+        styles.xml のスタイル ID の CellStyle を返します。
+
+        Args:
+            style_id (int): index of the cell style
+
+        Returns:
+            CellStyle
+        """
+        style = self._by_id.get(style_id)
+        if style is None:
+            style = self.get(self.workbook._cell_styles[style_id])
+            self._by_id[style_id] = style
+        return style
+
+
+# openpyxl のブックごとのインデックス
+_indexes = weakref.WeakKeyDictionary()
+
+
+def index_of(workbook):
+    """Returns the StyleIndex of an openpyxl workbook, made once for each workbook.
+
+    openpyxl のブックの StyleIndex を返します。ブックごとに1回だけ作ります。
+
+    Args:
+        workbook (Workbook): openpyxl workbook
+
+    Returns:
+        StyleIndex
+    """
+    index = _indexes.get(workbook)
+    if index is None:
+        index = StyleIndex(workbook)
+        _indexes[workbook] = index
+    return index
+
+
+def _style_of_cell(index, cell):
+    # 通常のセルは _style、読み取り専用のセルは style_array を持つ
+    style_array = getattr(cell, "_style", None)
+    if style_array is None:
+        style_array = getattr(cell, "style_array", None)
+    return index.get(style_array)
+
+
+def style_at(sheetdata, row, column):
+    """Returns the CellStyle of a cell.
+
+    セルの CellStyle を返します。
+
+    Args:
+        sheetdata (Worksheet | util.xlsxreader.SheetView): sheet
+        row (int): row number
+        column (int): column number
+
+    Returns:
+        CellStyle
+    """
+    if hasattr(sheetdata, "style_at"):
+        return sheetdata.style_at(row, column)
+    index = index_of(sheetdata.parent)
+    cells = getattr(sheetdata, "_cells", None)
+    if cells is not None:
+        # sheetdata[addr] は空のセルを作ってしまうので直接参照する
+        return _style_of_cell(index, cells.get((row, column)))
+    return _style_of_cell(index, sheetdata.cell(row=row, column=column))
+
+
+def iter_styles(sheetdata, range_string):
+    """Yield the CellStyle of each cell in a range, row by row.
+
+    範囲の各セルの CellStyle を行ごとに順に返します。
+
+    Args:
+        sheetdata (Worksheet | util.xlsxreader.SheetView): sheet
+        range_string (str): Excel style cell range.
+            Whole columns and rows like "E:E" are limited to the used cells.
+            example: "B2:F30"
+
+    Yields:
+        CellStyle
+    """
+    min_col, min_row, max_col, max_row = util.sheetsnapshot.range_bounds(sheetdata, range_string)
+    if hasattr(sheetdata, "style_at") or hasattr(sheetdata, "_cells"):
+        for row in range(min_row, max_row + 1):
+            for column in range(min_col, max_col + 1):
+                yield style_at(sheetdata, row, column)
+        return
+    # 読み取り専用のワークシートは1回で読む
+    index = index_of(sheetdata.parent)
+    for cells in sheetdata.iter_rows(min_row=min_row, max_row=max_row,
+                                     min_col=min_col, max_col=max_col):
+        for cell in cells:
+            yield _style_of_cell(index, cell)
+
+
+def count_styles(sheetdata, range_string, predicate):
+    """Count cells in a range whose styles satisfy the predicate.
+
+    範囲の中で、書式が条件を満たすセルを数えます。
+
+    Args:
+        sheetdata (Worksheet | util.xlsxreader.SheetView): sheet
+        range_string (str): Excel style cell range.
+            example: "B2:F30"
+        predicate (callable): function which takes a CellStyle and returns bool
+
+    Returns:
+        (countCells, countTrue) : countCells (int), countTrue (int)
+    """
+    countCells = 0
+    countTrue = 0
+    # 同じ書式のセルが多いので、書式ごとに1回だけ判定する
+    results = {}
+    for style in iter_styles(sheetdata, range_string):
+        countCells += 1
+        result = results.get(id(style))
+        if result is None:
+            result = bool(predicate(style))
+            results[id(style)] = result
+        if result:
+            countTrue += 1
+    return (countCells, countTrue)
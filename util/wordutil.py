@@ -1,8 +1,6 @@
 import os
-import datetime
-import zoneinfo
-import win32com.client
 import time
+import util.docprops
 
 
 
@@ -45,22 +43,12 @@ def get_createtime_modifiedtime(document, iana_key='Asia/Tokyo'):
             The datatimes are isoformat strings.
     """
     # get datetime with "Z", (UTC)
-    createdtime = document.core_properties.created
-    modifiedtime = document.core_properties.modified
     # ただし、時間帯情報　timezone はNULLである　つまりシステム依存の時間に見えてしまう。
-    # 日本時間に変換
-    # 強引にUTCと認識させ、そこから日本時間帯に変換させる
-    if createdtime:
-        tmp = createdtime.replace(tzinfo=datetime.timezone.utc)
-        createdtimeJST = tmp.astimezone(tz=zoneinfo.ZoneInfo(key=iana_key))
-    else:
-        createdtimeJST = "Empty Datetime"
-    if modifiedtime:
-        tmp = modifiedtime.replace(tzinfo=datetime.timezone.utc)
-        modifiedtimeJST = tmp.astimezone(tz=zoneinfo.ZoneInfo(key=iana_key))
-    else:
-        modifiedtimeJST = "Empty Datetime"
-    return (createdtimeJST, modifiedtimeJST)
+    # UTCと認識させ、そこから指定された時間帯に変換させる
+    return (util.docprops.localtime(document.core_properties.created, iana_key,
+                                    empty="Empty Datetime"),
+            util.docprops.localtime(document.core_properties.modified, iana_key,
+                                    empty="Empty Datetime"))
 
 
 
@@ -70,6 +58,11 @@ def get_createtime_modifiedtime(document, iana_key='Asia/Tokyo'):
 def create_word_diff(original_doc_path, students_filelist, sleeptime = 10):
     """Compare two document with Word's compare document
 
+    This needs Windows and Word.
+    util.docxdiff.compare_files compares docx files without Word on any platform.
+    Windows と Word が必要です。
+    util.docxdiff.compare_files は Word を使わずにどのプラットフォームでも docx ファイルを比較します。
+
     Args:
         original_doc_path (Path): filename for the original file
         students_filelist (list of Path): filenames submitted by students 
@@ -78,6 +71,9 @@ def create_word_diff(original_doc_path, students_filelist, sleeptime = 10):
     # I learned many things from https://stackoverflow.com/questions/47212459/automating-comparison-of-word-documents-using-python
     # Thanks to the authors.
 
+    # win32com は Windows にしか無いので、使うときに読み込む
+    import win32com.client
+
     absorig = str(original_doc_path.resolve())
     app1 = win32com.client.gencache.EnsureDispatch("Word.Application")
     orig_doc = app1.Documents.Open(absorig)
@@ -0,0 +1,340 @@
+"""Single-parse workbook loader.
+
+The checks in util.excelutil take a pair of worksheets (sheetdata, sheetmath)
+which are usually made by calling openpyxl.load_workbook twice,
+once with data_only=True and once with data_only=False.
+This module opens the xlsx file once and parses each sheet once,
+keeping both the cached value and the formula of every cell.
+excelutil のチェック関数は (sheetdata, sheetmath) の組を受け取るため、
+通常は openpyxl.load_workbook を data_only=True と False で2回呼び出しています。
+このモジュールは xlsx ファイルを1回だけ開き、各シートを1回だけ解析して、
+セルの保存済みの値と数式の両方を保持します。
+
+Example:
+    book = util.xlsxreader.load_dual_workbook("exceldata2.xlsx")
+    sheetData, sheetMath = book["Sheet1"]
+    util.excelutil.is_formula(sheetdata=sheetData, sheetmath=sheetMath, addr="E4")
+    util.excelutil.get_creator_lastmodify(book)
+
+When only a few ranges are checked, give them as `ranges`.
+Only those sheets are parsed and each sheet is read only up to the last needed row.
+チェックするセル範囲が少ない場合は `ranges` で指定します。
+指定したシートだけを解析し、必要な最後の行まで読んだら読み込みを止めます。
+
+    book = util.xlsxreader.load_dual_workbook("exceldata2.xlsx",
+                                              ranges={"Sheet1": ["E4", "C12:E13", "E19"]})
+
+The style id of each cell is also kept,
+so the style checks in util.excelutil_exp work on the loaded sheets.
+各セルのスタイル ID も保持するので、
+util.excelutil_exp の書式のチェックも読み込んだシートに使えます。
+"""
+import openpyxl
+from openpyxl.reader.excel import ExcelReader
+from openpyxl.styles.stylesheet import apply_stylesheet
+from openpyxl.worksheet._reader import WorkSheetParser, FORMULA_TAG
+from openpyxl.utils.cell import coordinate_to_tuple, get_column_letter
+import util.styleindex
+
+# Excel のシートの最大の行と列 (XFD1048576)
+MAX_ROW = 1048576
+MAX_COLUMN = 16384
+
+
+class _DualSheetParser(WorkSheetParser):
+    """Worksheet parser which keeps both the cached value and the formula.
+
+    If `bounds` is given, cells in rows outside the bounds are not parsed.
+    `bounds` が与えられた場合、範囲外の行のセルは解析しません。
+    """
+
+    def __init__(self, src, shared_strings, bounds=None, **kw):
+        super().__init__(src, shared_strings, **kw)
+        self.bounds = bounds
+
+    def parse_row(self, row):
+        if self.bounds is None:
+            return super().parse_row(row)
+        r = row.get("r")
+        if r is None:
+            return super().parse_row(row)
+        rownum = int(float(r))
+        if any(min_row <= rownum <= max_row for (_, min_row, _, max_row) in self.bounds):
+            return super().parse_row(row)
+        # 範囲外の行は読み飛ばす
+        # ただし共有数式の元の数式は後のセルで使うので登録しておく
+        self.row_counter = rownum
+        self.col_counter = 0
+        for element in row:
+            formula = element.find(FORMULA_TAG)
+            if formula is not None and formula.get("t") == "shared" and formula.text:
+                self.parse_cell(element)
+        return rownum, []
+
+    def parse_cell(self, element):
+        # data_only=True で保存されている値を読み、数式があれば別に読む
+        cell = super().parse_cell(element)
+        if element.find(FORMULA_TAG) is not None:
+            cell["formula"] = self.parse_formula(element)
+        else:
+            cell["formula"] = cell["value"]
+        return cell
+
+
+class CellView:
+    """Read-only cell with the same `value` attribute as openpyxl's Cell."""
+
+    __slots__ = ("row", "column", "value")
+
+    def __init__(self, row, column, value):
+        self.row = row
+        self.column = column
+        self.value = value
+
+    @property
+    def coordinate(self):
+        return "{}{}".format(get_column_letter(self.column), self.row)
+
+    def __repr__(self):
+        return "<CellView {}={!r}>".format(self.coordinate, self.value)
+
+
+class SheetView:
+    """One view (values or formulas) of a DualSheet.
+
+    It provides the subset of the openpyxl Worksheet interface
+    used by util.excelutil: `sheet["A3"].value` and `iter_rows`.
+    util.excelutil が使う openpyxl Worksheet の一部
+    (`sheet["A3"].value` と `iter_rows`) を提供します。
+    """
+
+    def __init__(self, dualsheet, index):
+        self._dualsheet = dualsheet
+        self._index = index
+
+    @property
+    def title(self):
+        return self._dualsheet.title
+
+    @property
+    def max_row(self):
+        return self._dualsheet.max_row
+
+    @property
+    def max_column(self):
+        return self._dualsheet.max_column
+
+    def style_at(self, row, column):
+        """Returns the util.styleindex.CellStyle of a cell.
+
+        セルの util.styleindex.CellStyle を返します。
+        """
+        dualsheet = self._dualsheet
+        return dualsheet.style_index.by_id(dualsheet.styles.get((row, column), 0))
+
+    def cell_value(self, row, column):
+        pair = self._dualsheet.cells.get((row, column))
+        if pair is None:
+            return None
+        return pair[self._index]
+
+    def __getitem__(self, key):
+        if ":" in key:
+            (min_col, min_row, max_col,
+             max_row) = openpyxl.utils.cell.range_boundaries(key)
+            return tuple(self.iter_rows(min_row=min_row, max_row=max_row,
+                                        min_col=min_col, max_col=max_col))
+        row, column = coordinate_to_tuple(key)
+        return CellView(row, column, self.cell_value(row, column))
+
+    def iter_rows(self, min_row=None, max_row=None, min_col=None, max_col=None,
+                  values_only=False):
+        min_row = min_row or 1
+        min_col = min_col or 1
+        max_row = max_row or self.max_row
+        max_col = max_col or self.max_column
+        for row in range(min_row, max_row + 1):
+            if values_only:
+                yield tuple(self.cell_value(row, col)
+                            for col in range(min_col, max_col + 1))
+            else:
+                yield tuple(CellView(row, col, self.cell_value(row, col))
+                            for col in range(min_col, max_col + 1))
+
+
+class DualSheet:
+    """Worksheet holding the cached values and the formulas at once.
+
+    `data` is used as sheetdata and `math` as sheetmath.
+    The sheet can also be unpacked as `sheetData, sheetMath = dualsheet`.
+    `data` を sheetdata として、`math` を sheetmath として使います。
+    `sheetData, sheetMath = dualsheet` のように展開することもできます。
+    """
+
+    def __init__(self, title, style_index=None):
+        self.title = title
+        # {(row, column): (cached value, formula or value)}
+        self.cells = {}
+        # {(row, column): style id} 標準の書式 (0) のセルは含まない
+        self.styles = {}
+        self.style_index = style_index
+        self.max_row = 0
+        self.max_column = 0
+        self.data = SheetView(self, 0)
+        self.math = SheetView(self, 1)
+
+    def __iter__(self):
+        return iter((self.data, self.math))
+
+
+class DualWorkbook:
+    """Workbook made of DualSheets.
+
+    `properties` is the same object as openpyxl's Workbook.properties,
+    so it can be passed to util.excelutil.get_creator_lastmodify.
+    `properties` は openpyxl の Workbook.properties と同じものなので、
+    util.excelutil.get_creator_lastmodify にそのまま渡せます。
+    `style_index` is the util.styleindex.StyleIndex of the workbook.
+    `style_index` はブックの util.styleindex.StyleIndex です。
+    """
+
+    def __init__(self, properties, sheets, style_index=None):
+        self.properties = properties
+        self._sheets = sheets
+        self.style_index = style_index
+
+    @property
+    def sheetnames(self):
+        return list(self._sheets)
+
+    @property
+    def worksheets(self):
+        return list(self._sheets.values())
+
+    def __getitem__(self, name):
+        return self._sheets[name]
+
+    def __contains__(self, name):
+        return name in self._sheets
+
+
+def load_dual_workbook(filename, ranges=None, evaluate=False):
+    """Load a workbook once for both sheetdata and sheetmath.
+
+    The xlsx file is opened once and every sheet is parsed once.
+    Cached values are the same as `load_workbook(data_only=True)`
+    and formulas are the same as `load_workbook(data_only=False)`.
+    If ranges is given, only the given sheets are parsed,
+    only the cells in the ranges are kept
+    and parsing of a sheet stops after the last needed row.
+    Cells outside the ranges are read as None.
+    xlsx ファイルを1回だけ開き、各シートを1回だけ解析します。
+    値は `load_workbook(data_only=True)` と、数式は `load_workbook(data_only=False)` と同じです。
+    ranges を与えると、指定したシートだけを解析し、範囲内のセルだけを保持し、
+    必要な最後の行を過ぎるとシートの解析を止めます。
+    範囲外のセルは None として読まれます。
+    If evaluate is True, formula cells in the ranges which have no cached value
+    are computed by util.formulaeval.
+    Cells outside the ranges are still read as None.
+    evaluate が True の場合、範囲内の値が保存されていない数式のセルを
+    util.formulaeval で計算します。範囲外のセルはその場合も None として読まれます。
+
+    Args:
+        filename (str | pathlib.Path | file-like object): xlsx file
+        ranges (dict, optional): sheet name to sequence of Excel style cell ranges.
+            example: {"Sheet1": ["E4", "C12:E13", "E19"]}
+            Defaults to None, which means all cells of all sheets.
+        evaluate (bool, optional): compute formula cells without cached values.
+            Defaults to False.
+
+    Returns:
+        DualWorkbook
+    """
+    if not hasattr(filename, "read"):
+        filename = str(filename)
+    book = _load(filename, ranges)
+    if evaluate:
+        # 循環 import を避けるためここで import する
+        import util.formulaeval
+        if util.formulaeval.missing_values(book, ranges):
+            if ranges is None:
+                util.formulaeval.fill_missing_values(book)
+            else:
+                # 参照先のセルが範囲外にあるかもしれないので全体を読み直して計算し、
+                # 計算した範囲内の値だけを範囲を指定したブックに移す
+                if hasattr(filename, "seek"):
+                    filename.seek(0)
+                full = _load(filename, None)
+                for sheet, row, column in util.formulaeval.fill_missing_values(full, ranges):
+                    cells = book[sheet].cells
+                    cells[(row, column)] = (full[sheet].cells[(row, column)][0],
+                                            cells[(row, column)][1])
+    return book
+
+
+def _load(filename, ranges):
+    reader = ExcelReader(filename, read_only=True, data_only=True)
+    try:
+        reader.read_manifest()
+        reader.read_strings()
+        reader.read_workbook()
+        reader.read_properties()
+        apply_stylesheet(reader.archive, reader.wb)
+        wb = reader.wb
+        style_index = util.styleindex.StyleIndex(wb)
+        sheets = {}
+        for sheet, rel in reader.parser.find_sheets():
+            if rel.target not in reader.valid_files or "chartsheet" in rel.Type:
+                continue
+            bounds = None
+            if ranges is not None:
+                if sheet.name not in ranges:
+                    continue
+                bounds = [_range_bounds(range_string) for range_string in ranges[sheet.name]]
+            dualsheet = DualSheet(sheet.name, style_index)
+            with reader.archive.open(rel.target) as src:
+                parser = _DualSheetParser(src, reader.shared_strings, bounds=bounds,
+                                          data_only=True,
+                                          epoch=wb.epoch,
+                                          date_formats=wb._date_formats,
+                                          timedelta_formats=wb._timedelta_formats)
+                _read_cells(parser, dualsheet, bounds)
+            sheets[sheet.name] = dualsheet
+    finally:
+        reader.archive.close()
+    return DualWorkbook(wb.properties, sheets, style_index)
+
+
+def _range_bounds(range_string):
+    # "E:E" や "4:4" のような行全体・列全体の範囲にも対応する
+    (min_col, min_row, max_col,
+     max_row) = openpyxl.utils.cell.range_boundaries(range_string)
+    return (min_col or 1, min_row or 1,
+            max_col or MAX_COLUMN, max_row or MAX_ROW)
+
+
+def _read_cells(parser, dualsheet, bounds=None):
+    cells = dualsheet.cells
+    styles = dualsheet.styles
+    if bounds is not None:
+        last_row = max((max_row for (_, _, _, max_row) in bounds), default=0)
+    for row, rowcells in parser.parse():
+        if bounds is not None and row > last_row:
+            # 必要な行を全て読んだので残りは読まない
+            break
+        for cell in rowcells:
+            column = cell["column"]
+            if bounds is not None and \
+                not any(min_col <= column <= max_col and min_row <= row <= max_row
+                        for (min_col, min_row, max_col, max_row) in bounds):
+                continue
+            if cell["style_id"]:
+                # 値の無いセルにも書式はある
+                styles[(row, column)] = cell["style_id"]
+            if cell["value"] is None and cell["formula"] is None:
+                continue
+            cells[(row, column)] = (cell["value"], cell["formula"])
+            if row > dualsheet.max_row:
+                dualsheet.max_row = row
+            if column > dualsheet.max_column:
+                dualsheet.max_column = column